@@ -0,0 +1,88 @@
+"""
+Client import-time and cold-start benchmark.
+
+Imports each client-side entry module in a fresh interpreter with `python -X importtime`, takes the
+median cumulative import time over several runs and checks it against IMPORT_BUDGET_US. It also fails
+if any server-only or third-party module (SQLAlchemy, server.*) is pulled in, and reports peak RSS.
+
+    python -m benchmarks.bench_import [--runs 7]
+
+Exits with status 1 when a budget is exceeded.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module -> cumulative import budget in microseconds (stdlib asyncio alone is ~50ms on a cold cache)
+IMPORT_BUDGET_US = {
+    'common.protocol': 30_000,
+    'client.client': 150_000,
+}
+
+# Module prefixes that must never be imported by the client path
+FORBIDDEN = ('sqlalchemy', 'aiosqlite', 'greenlet', 'server')
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)')
+
+_PROBE = """
+import resource, sys
+import {module}
+print('RSS_KB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+print('MODULES', ' '.join(sorted(sys.modules)))
+"""
+
+
+def measure(module: str):
+    """Returns (cumulative import us, peak RSS KB, set of loaded modules) for one cold import."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _PROBE.format(module=module)],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match and match.group(4) == module:
+            cumulative = int(match.group(2))
+    rss = modules = None
+    for line in proc.stdout.splitlines():
+        if line.startswith('RSS_KB'):
+            rss = int(line.split()[1])
+        elif line.startswith('MODULES'):
+            modules = set(line.split()[1:])
+    return cumulative, rss, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<20}{'median us':>12}{'budget us':>12}{'peak RSS KB':>14}")
+    for module, budget in IMPORT_BUDGET_US.items():
+        samples, rss_samples, modules = [], [], set()
+        for _ in range(args.runs):
+            cumulative, rss, loaded = measure(module)
+            samples.append(cumulative)
+            rss_samples.append(rss)
+            modules |= loaded
+        median = statistics.median(samples)
+        status = 'ok' if median <= budget else 'OVER BUDGET'
+        print(f"{module:<20}{median:>12.0f}{budget:>12}{statistics.median(rss_samples):>14.0f}  {status}")
+        failed |= median > budget
+
+        leaked = sorted(m for m in modules if m.split('.')[0] in FORBIDDEN)
+        if leaked:
+            print(f"  forbidden modules imported: {', '.join(leaked)}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
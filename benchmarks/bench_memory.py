@@ -0,0 +1,191 @@
+"""
+Memory per idle connection benchmark.
+
+Starts a ChatServer in a child process on a scratch database with --connections users, opens one
+connection per user, authenticates it with 'resume' (auth token, so no PBKDF2 cost) and leaves it idle.
+The growth of the server's RSS between a warm-up sample and the full set of connections, divided by
+the number of connections, is the user-space cost of one idle authenticated connection; kernel socket
+buffers are reported separately from /proc/net/sockstat.
+
+    python -m benchmarks.bench_memory                        # 10k connections
+    python -m benchmarks.bench_memory --connections 100000   # needs `ulimit -n` above 2x connections
+
+Exits with status 1 when the cost per connection exceeds BUDGET_BYTES_PER_CONNECTION.
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from common.protocol import HEADER_FORMAT, HEADER_LEN, protocol
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# User-space bytes per idle authenticated connection (Connection, transport, StreamReader, handler task).
+# 100k idle connections therefore fit in 100_000 * BUDGET_BYTES_PER_CONNECTION (~1.2 GB) plus the base process.
+BUDGET_BYTES_PER_CONNECTION = 12 * 1024
+WARMUP = 500
+BATCH = 500
+
+_SERVE = """
+import asyncio, logging, sys
+from server import config
+config.MAX_CONNECTIONS = {max_connections}
+config.SHED_LOOP_LAG = float('inf')
+config.SHED_QUEUE_DEPTH = 1 << 30
+# Thousands of concurrent resumes queue behind each other by design; a slow-request warning for each would
+# flood the output and the logging itself would skew the measurement
+config.SLOW_REQUEST_THRESHOLD = None
+from server.db import session as db_session
+from server.server import ChatServer
+logging.getLogger().setLevel(logging.WARNING)
+
+async def main():
+    db_session.configure_engine('sqlite+aiosqlite:///{db}')
+    await db_session.create_db_and_tables()
+    server = ChatServer(port=0)
+    task = asyncio.create_task(server.start())
+    while server.server is None:
+        await asyncio.sleep(0.01)
+    print(server.server.sockets[0].getsockname()[1], flush=True)
+    await task
+
+asyncio.run(main())
+"""
+
+
+def create_users(path: str, count: int):
+    from sqlalchemy import create_engine
+    from server.models import Base
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    with sqlite3.connect(path) as conn:
+        conn.executemany("INSERT INTO users (id, username, password_hash, status, is_admin, create_time) "
+                         "VALUES (?, ?, '', 1, 0, '2024-01-01')",
+                         ((i, f"u{i}") for i in range(1, count + 1)))
+        conn.executemany("INSERT INTO user_sessions (token, user_id, create_time) VALUES (?, ?, '2024-01-01')",
+                         ((f"token-{i}", i) for i in range(1, count + 1)))
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def tcp_kernel_bytes() -> int:
+    """Memory the kernel holds for TCP sockets, in bytes (Linux only)."""
+    try:
+        with open('/proc/net/sockstat') as f:
+            for line in f:
+                if line.startswith('TCP:'):
+                    fields = line.split()
+                    return int(fields[fields.index('mem') + 1]) * resource.getpagesize()
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def read_frame(sock: socket.socket) -> bytes:
+    data = b''
+    while len(data) < HEADER_LEN:
+        data += sock.recv(4096)
+    _, _, payload_len = struct.unpack(HEADER_FORMAT, data[:HEADER_LEN])
+    while len(data) < HEADER_LEN + payload_len:
+        data += sock.recv(4096)
+    return data[HEADER_LEN:HEADER_LEN + payload_len]
+
+
+def open_connections(port: int, first: int, count: int) -> list:
+    """Opens and authenticates users first..first+count-1, pipelined BATCH at a time."""
+    sockets = []
+    for offset in range(0, count, BATCH):
+        batch = []
+        for user_id in range(first + offset, first + min(offset + BATCH, count)):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(protocol.create_payload('resume', {'auth_token': f"token-{user_id}", 'last_seq': 0}))
+            batch.append(sock)
+        for sock in batch:
+            reply = json.loads(read_frame(sock))
+            if not reply['payload'].get('ok'):
+                raise RuntimeError(f"resume failed: {reply['payload']}")
+        sockets += batch
+    return sockets
+
+
+def settle(pid: int) -> int:
+    time.sleep(1)
+    return rss_bytes(pid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=10_000)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    # Both ends of every connection live on this machine
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.connections + 100 > hard:
+        parser.error(f"--connections {args.connections} needs more file descriptors than the limit of {hard}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'memory.db')
+        create_users(db, WARMUP + args.connections)
+        server = subprocess.Popen(
+            [sys.executable, '-c', _SERVE.format(db=db, max_connections=WARMUP + args.connections + 100)],
+            cwd=ROOT, stdout=subprocess.PIPE, text=True,
+            preexec_fn=lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)),
+        )
+        try:
+            port = int(server.stdout.readline())
+            # Warm-up connections fill caches (DB pages, metric series, allocator arenas) before the baseline
+            sockets = open_connections(port, 1, WARMUP)
+            base_rss, base_kernel = settle(server.pid), tcp_kernel_bytes()
+            start = time.perf_counter()
+            sockets += open_connections(port, WARMUP + 1, args.connections)
+            elapsed = time.perf_counter() - start
+            rss, kernel = settle(server.pid), tcp_kernel_bytes()
+        finally:
+            server.terminate()
+            server.wait()
+            for sock in locals().get('sockets', ()):
+                sock.close()
+
+    per_connection = (rss - base_rss) / args.connections
+    results = {
+        'connections': args.connections,
+        'connect_per_second': round(args.connections / elapsed),
+        'base_rss_bytes': base_rss,
+        'rss_bytes': rss,
+        'bytes_per_connection': round(per_connection),
+        'kernel_tcp_bytes_per_connection': round((kernel - base_kernel) / args.connections),
+        'budget_bytes_per_connection': BUDGET_BYTES_PER_CONNECTION,
+        'projected_100k_bytes': round(base_rss + per_connection * 100_000),
+    }
+    print(f"connections              {args.connections:>12,}  ({results['connect_per_second']:,}/s)")
+    print(f"server RSS               {base_rss / 1e6:>12.1f} MB -> {rss / 1e6:.1f} MB")
+    print(f"per idle connection      {per_connection:>12,.0f} B  (budget {BUDGET_BYTES_PER_CONNECTION:,} B)")
+    print(f"kernel TCP per connection{results['kernel_tcp_bytes_per_connection']:>12,} B  (both ends, not in RSS)")
+    print(f"projected RSS at 100k    {results['projected_100k_bytes'] / 1e6:>12.1f} MB")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+    sys.exit(1 if per_connection > BUDGET_BYTES_PER_CONNECTION else 0)
+
+
+if __name__ == '__main__':
+    main()
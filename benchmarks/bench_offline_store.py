@@ -0,0 +1,86 @@
+"""
+Offline store benchmark: the offline_messages table versus the segment spool (server/repository/spool.py).
+
+Both stores run behind the SQLAlchemy backend exactly as the server uses them, on a scratch database:
+
+    enqueue  --messages offline messages to --users recipients, one transaction per message (the
+             'send' path for an offline recipient)
+    drain    every recipient's backlog read in order and deleted, one transaction per user (the login path)
+
+    python -m benchmarks.bench_offline_store [--messages 20000] [--users 200] [--fsync]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from common.protocol import protocol
+from server.db import session as db_session
+from server.repository.backend import SqlAlchemyBackend
+from server.repository.spool import OfflineSpool
+
+
+async def run_store(store: str, directory: str, args) -> dict:
+    db_session.configure_engine(f"sqlite+aiosqlite:///{os.path.join(directory, store + '.db')}")
+    await db_session.create_db_and_tables()
+    spool = OfflineSpool(os.path.join(directory, 'spool'), fsync=args.fsync) if store == 'spool' else None
+    backend = SqlAlchemyBackend(spool)
+    rng = random.Random(args.seed)
+    frames = [protocol.create_client_user_send_message(f"u{i}", 'x' * args.size, 0).hex() for i in range(16)]
+    try:
+        start = time.perf_counter()
+        for seq in range(1, args.messages + 1):
+            async with backend.transaction() as repos:
+                await repos.offline.save(rng.randint(1, args.users), rng.choice(frames), seq)
+        enqueue = time.perf_counter() - start
+
+        drained = 0
+        start = time.perf_counter()
+        for user_id in range(1, args.users + 1):
+            async with backend.transaction() as repos:
+                messages = await repos.offline.get_for_user(user_id)
+                # Decode the frames as the replay in UserService._attach does
+                frames_out = [bytes.fromhex(m.message_payload) for m in messages]
+                drained += len(frames_out)
+                await repos.offline.delete_many([m.id for m in messages])
+        drain = time.perf_counter() - start
+        assert drained == args.messages, f"{store}: drained {drained} of {args.messages}"
+    finally:
+        await backend.close()
+    return {
+        'enqueue_per_second': round(args.messages / enqueue),
+        'drain_per_second': round(args.messages / drain),
+        'enqueue_us': round(enqueue / args.messages * 1e6, 1),
+        'drain_us': round(drain / args.messages * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--size', type=int, default=100, help='message text length')
+    parser.add_argument('--fsync', action='store_true', help='fsync every spool write (SPOOL_FSYNC)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    results = {'messages': args.messages, 'users': args.users, 'size': args.size, 'fsync': args.fsync}
+    print(f"{'store':<10}{'enqueue/s':>12}{'us/msg':>10}{'drain/s':>12}{'us/msg':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for store in ('database', 'spool'):
+            r = results[store] = asyncio.run(run_store(store, tmp, args))
+            print(f"{store:<10}{r['enqueue_per_second']:>12}{r['enqueue_us']:>10.1f}"
+                  f"{r['drain_per_second']:>12}{r['drain_us']:>10.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Protocol microbenchmarks with regression thresholds.
+
+Measures protocol.serialize_message and AsyncProtocol.deserialize_stream for each supported codec:
+
+    serialize_small / serialize_large       build one frame (chat-sized / 64 KiB payload)
+    deserialize_small / deserialize_large   decode one frame delivered in a single read
+    deserialize_multi                       decode 10 frames that arrived in one read
+    deserialize_fragmented                  decode one frame delivered in 16-byte reads
+    deserialize_garbage                     decode one frame preceded by junk before MAGIC_HEADER
+
+ns/op is the median over several repeats. alloc/op is the peak extra memory (tracemalloc) one op needs,
+which catches buffer-copy regressions such as quadratic re-concatenation.
+
+    python -m benchmarks.bench_protocol                    # compare with the stored baseline
+    python -m benchmarks.bench_protocol --update-baseline  # record a new baseline
+
+Exits with status 1 if any case regresses beyond the tolerances. Baselines are machine-specific:
+record one on the machine that runs the comparison.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from common.protocol import AsyncProtocol, MAGIC_HEADER, protocol
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'protocol.json')
+
+# codec name -> (encode(msgtype, payload) -> bytes, async decode(stream, buffer) -> (message, rest)).
+# The wire format currently has a single JSON codec; new codecs register here to join the suite.
+CODECS = {
+    'json': (protocol.serialize_message, AsyncProtocol.deserialize_stream),
+}
+
+SMALL_PAYLOAD = {'username': 'alice', 'message': 'hello, how are you today?'}
+LARGE_PAYLOAD = {'username': 'alice', 'message': 'x' * 64 * 1024}
+
+
+class ChunkedStream:
+    """In-memory stand-in for a StreamReader that hands out data in fixed-size reads."""
+    __slots__ = ('data', 'pos', 'chunk')
+
+    def __init__(self, data: bytes, chunk: int = 1 << 30):
+        self.data = data
+        self.pos = 0
+        self.chunk = chunk
+
+    async def read(self, n: int = -1) -> bytes:
+        size = self.chunk if n < 0 else min(n, self.chunk)
+        piece = self.data[self.pos:self.pos + size]
+        self.pos += len(piece)
+        return piece
+
+
+def build_cases(encode, decode):
+    small = encode('send', SMALL_PAYLOAD)
+    large = encode('send', LARGE_PAYLOAD)
+    multi = small * 10
+    garbage = os.urandom(256).replace(MAGIC_HEADER[:1], b'\x00') + small
+
+    async def decode_all(data, frames, chunk=1 << 30):
+        stream = ChunkedStream(data, chunk)
+        buffer = b''
+        for _ in range(frames):
+            _, buffer = await decode(stream, buffer)
+
+    return {
+        'serialize_small': (lambda: encode('send', SMALL_PAYLOAD), False),
+        'serialize_large': (lambda: encode('send', LARGE_PAYLOAD), False),
+        'deserialize_small': (lambda: decode_all(small, 1), True),
+        'deserialize_large': (lambda: decode_all(large, 1), True),
+        'deserialize_multi': (lambda: decode_all(multi, 10), True),
+        'deserialize_fragmented': (lambda: decode_all(small, 1, chunk=16), True),
+        'deserialize_garbage': (lambda: decode_all(garbage, 1), True),
+    }
+
+
+async def _run_async(fn, iterations):
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        await fn()
+    return time.perf_counter_ns() - start
+
+
+def _run_sync(fn, iterations):
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        fn()
+    return time.perf_counter_ns() - start
+
+
+def measure(loop, fn, is_async, min_time=0.2, repeats=5):
+    """Returns (median ns/op, peak alloc bytes/op)."""
+    run = (lambda n: loop.run_until_complete(_run_async(fn, n))) if is_async else (lambda n: _run_sync(fn, n))
+    # Calibrate the iteration count so each repeat runs for about min_time
+    iterations = 1
+    while True:
+        elapsed = run(iterations)
+        if elapsed >= min_time * 1e9 / 10 or iterations >= 1 << 20:
+            break
+        iterations *= 2
+    iterations = max(1, int(iterations * min_time * 1e9 / max(elapsed, 1)))
+    samples = [run(iterations) / iterations for _ in range(repeats)]
+
+    tracemalloc.start()
+    try:
+        run(1)  # warm any lazily created state
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run(1)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(samples), max(0, peak - current)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='allowed ns/op regression (0.25 = +25%%)')
+    parser.add_argument('--alloc-tolerance', type=float, default=0.10, help='allowed alloc/op regression')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per repeat')
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    for codec, (encode, decode) in CODECS.items():
+        for case, (fn, is_async) in build_cases(encode, decode).items():
+            ns, alloc = measure(loop, fn, is_async, args.min_time)
+            results[f"{codec}/{case}"] = {'ns_per_op': round(ns, 1), 'alloc_bytes_per_op': alloc}
+    loop.close()
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                      f, indent=2, sort_keys=True)
+        for name, r in results.items():
+            print(f"{name:<34}{r['ns_per_op']:>12.0f} ns/op{r['alloc_bytes_per_op']:>10} B/op")
+        print(f"baseline written to {args.baseline}")
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf8') as f:
+            baseline = json.load(f)['results']
+
+    failed = False
+    print(f"{'case':<34}{'ns/op':>10}{'base':>10}{'delta':>8}{'B/op':>9}{'base':>9}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name:<34}{r['ns_per_op']:>10.0f}{'-':>10}{'':>8}{r['alloc_bytes_per_op']:>9}{'-':>9}  (new)")
+            continue
+        delta = r['ns_per_op'] / base['ns_per_op'] - 1
+        slow = delta > args.time_tolerance
+        # Small absolute alloc changes (interning, freelists) are noise; require 64 bytes as well
+        alloc_limit = base['alloc_bytes_per_op'] * (1 + args.alloc_tolerance) + 64
+        heavy = r['alloc_bytes_per_op'] > alloc_limit
+        flag = '  REGRESSION' if slow or heavy else ''
+        print(f"{name:<34}{r['ns_per_op']:>10.0f}{base['ns_per_op']:>10.0f}{delta:>+8.0%}"
+              f"{r['alloc_bytes_per_op']:>9}{base['alloc_bytes_per_op']:>9}{flag}")
+        failed |= slow or heavy
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
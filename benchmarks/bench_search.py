@@ -0,0 +1,181 @@
+"""
+Full-text search benchmark at message-history scale.
+
+Builds a scratch database with --messages synthetic private messages spread over --users users, then
+measures, with the same SQL the server runs (server.repository.search_repository):
+
+    build        indexing the whole history from scratch in SEARCH_SYNC_BATCH-sized transactions
+    incremental  cost per message of syncing newly written messages, for several batch sizes
+    query        latency of 'search' for random users and terms (first page and a deeper page)
+
+    python -m benchmarks.bench_search                         # 10M messages; needs several GB of disk
+    python -m benchmarks.bench_search --messages 200000 --output search.json
+
+Generating the dataset is not part of any measurement. Use --db to keep the database between runs;
+an existing database is reused as is and the build phase is then skipped.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from server import config
+from server.models import Base
+from server.repository.search_repository import (
+    FTS_DDL, INDEXED_UPTO_SQL, INSERT_SQL, PENDING_SQL, SEARCH_SQL, build_query, index_row,
+)
+from tools.stats import percentile
+
+CHUNK = 50_000
+
+
+def make_vocabulary(rng: random.Random, size: int = 5000) -> list:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = {''.join(rng.choices(letters, k=rng.randint(3, 9))) for _ in range(size)}
+    return sorted(words) + list('你好世界今天明天发布上线会议')
+
+
+def message_text(rng: random.Random, vocabulary: list, weights: list) -> str:
+    return ' '.join(rng.choices(vocabulary, weights, k=rng.randint(3, 15)))
+
+
+def create_schema(path: str):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    with sqlite3.connect(path) as conn:
+        for statement in FTS_DDL:
+            conn.execute(statement)
+
+
+def populate(conn, rng, vocabulary, weights, users: int, messages: int):
+    conn.executemany("INSERT INTO users (id, username, password_hash, status, is_admin, create_time) "
+                     "VALUES (?, ?, '', 1, 0, '2024-01-01')", ((i, f"u{i}") for i in range(1, users + 1)))
+    written = 0
+    while written < messages:
+        rows = []
+        for _ in range(min(CHUNK, messages - written)):
+            a, b = rng.sample(range(1, users + 1), 2)
+            rows.append((min(a, b), max(a, b), a, message_text(rng, vocabulary, weights)))
+        conn.executemany("INSERT INTO chat_messages (user_low_id, user_high_id, sender_id, message, create_time) "
+                         "VALUES (?, ?, ?, ?, datetime('now'))", rows)
+        conn.commit()
+        written += len(rows)
+        print(f"\r  generated {written:,}/{messages:,}", end='', flush=True)
+    print()
+
+
+def sync(conn, batch: int) -> int:
+    """One server-style sync pass: batches of `batch` rows, one transaction each."""
+    total = 0
+    while True:
+        indexed_upto = (conn.execute(INDEXED_UPTO_SQL).fetchone() or (0,))[0]
+        rows = conn.execute(PENDING_SQL, {'after': indexed_upto, 'limit': batch}).fetchall()
+        if rows:
+            conn.executemany(INSERT_SQL, [index_row(*row) for row in rows])
+        conn.commit()
+        total += len(rows)
+        if len(rows) < batch:
+            return total
+
+
+def bench_incremental(conn, rng, vocabulary, weights, users: int, count: int) -> dict:
+    results = {}
+    for batch in (1, 100, config.SEARCH_SYNC_BATCH):
+        rows = []
+        for _ in range(count):
+            a, b = rng.sample(range(1, users + 1), 2)
+            rows.append((min(a, b), max(a, b), a, message_text(rng, vocabulary, weights)))
+        conn.executemany("INSERT INTO chat_messages (user_low_id, user_high_id, sender_id, message, create_time) "
+                         "VALUES (?, ?, ?, ?, datetime('now'))", rows)
+        conn.commit()
+        start = time.perf_counter()
+        sync(conn, batch)
+        elapsed = time.perf_counter() - start
+        results[f"batch_{batch}"] = {'us_per_message': round(elapsed / count * 1e6, 1)}
+        print(f"  incremental batch={batch:<6} {elapsed / count * 1e6:>10.1f} us/message")
+    return results
+
+
+def bench_queries(conn, rng, vocabulary, weights, users: int, count: int) -> dict:
+    results = {}
+    for name, offset in (('page_1', 0), ('page_5', 4 * config.SEARCH_PAGE_SIZE)):
+        latencies, hits = [], 0
+        for _ in range(count):
+            user_id = rng.randint(1, users)
+            query = build_query(rng.choices(vocabulary, weights)[0], user_id)
+            start = time.perf_counter()
+            rows = conn.execute(SEARCH_SQL, {'user_id': user_id, 'query': query,
+                                             'limit': config.SEARCH_PAGE_SIZE + 1, 'offset': offset}).fetchall()
+            latencies.append(time.perf_counter() - start)
+            hits += len(rows)
+        latencies.sort()
+        results[name] = {
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+            'mean_hits': round(hits / count, 1),
+        }
+        r = results[name]
+        print(f"  query {name:<7} p50 {r['p50_ms']:>8.2f} ms  p99 {r['p99_ms']:>8.2f} ms  "
+              f"max {r['max_ms']:>8.2f} ms  ({r['mean_hits']} hits)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--incremental', type=int, default=2000, help='messages written per incremental round')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help='database path to create or reuse (default: a temporary file)')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng)
+    # Zipf-like term frequencies, as in natural text
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    tmp = None
+    path = args.db
+    if path is None:
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, 'search.db')
+    try:
+        fresh = not os.path.exists(path)
+        if fresh:
+            create_schema(path)
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode = WAL")
+        results = {'messages': args.messages, 'users': args.users}
+        if fresh:
+            print(f"generating {args.messages:,} messages for {args.users:,} users...")
+            populate(conn, rng, vocabulary, weights, args.users, args.messages)
+            start = time.perf_counter()
+            indexed = sync(conn, config.SEARCH_SYNC_BATCH)
+            elapsed = time.perf_counter() - start
+            results['build'] = {'seconds': round(elapsed, 2), 'messages_per_second': round(indexed / elapsed)}
+            print(f"  build {indexed:,} messages in {elapsed:.1f}s ({indexed / elapsed:,.0f} messages/s)")
+        results['incremental'] = bench_incremental(conn, rng, vocabulary, weights, args.users, args.incremental)
+        results['query'] = bench_queries(conn, rng, vocabulary, weights, args.users, args.queries)
+        results['db_bytes'] = os.path.getsize(path)
+        conn.close()
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+TLS reconnect benchmark: full versus resumed handshakes.
+
+Runs a TLS echo server (common.tls.server_context, self-signed certificate from the openssl CLI) in a
+child process and hammers it with a reconnect storm: --concurrency clients each reconnect in a loop,
+exchanging one small frame per connection, until --connections connections have been made. For each mode
+it reports connections/s, connect latency and the server CPU time per connection:
+
+    plain    TCP without TLS, the floor
+    full     a fresh client context per connection, i.e. a full handshake every time
+    resumed  one ResumingSSLContext per client, so reconnects resume the previous session
+
+    python -m benchmarks.bench_tls [--connections 2000] [--concurrency 50] [--key rsa:2048|ec]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common.protocol import AsyncProtocol, protocol
+from common.tls import client_context, generate_self_signed_cert
+from tools.stats import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SERVE = """
+import asyncio, sys
+from common.tls import server_context
+
+async def echo(reader, writer):
+    try:
+        while data := await reader.read(4096):
+            writer.write(data)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def main():
+    context = server_context({certfile!r}, {keyfile!r}) if {tls!r} else None
+    server = await asyncio.start_server(echo, '127.0.0.1', 0, ssl=context, backlog=4096)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    await server.serve_forever()
+
+asyncio.run(main())
+"""
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def storm(port: int, mode: str, certfile: str, connections: int, concurrency: int) -> dict:
+    frame = protocol.create_payload('ping', {'message': 'x'})
+    latencies, reused = [], 0
+    remaining = connections
+
+    async def client():
+        nonlocal remaining, reused
+        context = client_context(certfile) if mode == 'resumed' else None
+        if context is not None:
+            await connect_once(context)  # prime the session, not measured
+        while remaining > 0:
+            remaining -= 1
+            if mode == 'full':
+                context = client_context(certfile, resume=False)
+            start = time.perf_counter()
+            ssl_object = await connect_once(context)
+            latencies.append(time.perf_counter() - start)
+            reused += bool(ssl_object and ssl_object.session_reused)
+
+    async def connect_once(context):
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', port, ssl=context, server_hostname='localhost' if context else None)
+        writer.write(frame)
+        await writer.drain()
+        await AsyncProtocol.deserialize_stream(reader)
+        ssl_object = writer.get_extra_info('ssl_object')
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        return ssl_object
+
+    # Client setup (priming) happens before the clock starts
+    tasks = [client() for _ in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'connections_per_second': round(len(latencies) / elapsed),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'resumed': reused,
+    }
+
+
+def run_mode(mode: str, certfile: str, keyfile: str, connections: int, concurrency: int) -> dict:
+    server = subprocess.Popen(
+        [sys.executable, '-c', _SERVE.format(certfile=certfile, keyfile=keyfile, tls=mode != 'plain')],
+        cwd=ROOT, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        port = int(server.stdout.readline())
+        cpu_before = cpu_seconds(server.pid)
+        result = asyncio.run(storm(port, mode, certfile, connections, concurrency))
+        # Priming connections are included: one per client, small next to --connections
+        result['server_cpu_us_per_connection'] = round(
+            (cpu_seconds(server.pid) - cpu_before) / connections * 1e6, 1)
+    finally:
+        server.terminate()
+        server.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--key', default='rsa:2048', help="certificate key: 'rsa:<bits>' or 'ec'")
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    results = {'connections': args.connections, 'concurrency': args.concurrency, 'key': args.key}
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile, keyfile = generate_self_signed_cert(tmp, key=args.key)
+        print(f"{'mode':<10}{'conn/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'server CPU us/conn':>20}{'resumed':>10}")
+        for mode in ('plain', 'full', 'resumed'):
+            r = results[mode] = run_mode(mode, certfile, keyfile, args.connections, args.concurrency)
+            print(f"{mode:<10}{r['connections_per_second']:>10}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+                  f"{r['server_cpu_us_per_connection']:>20.1f}{r['resumed']:>10}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
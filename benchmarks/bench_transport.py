@@ -0,0 +1,116 @@
+"""
+Transport tuning benchmark.
+
+Runs an echo server built on AsyncProtocol and measures round-trip latency (sequential ping/pong)
+and pipelined throughput for each tuning knob in common.transport.
+
+    python -m benchmarks.bench_transport [--rounds 2000] [--frames 20000] [--size 256]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from common.protocol import AsyncProtocol, protocol
+from common.transport import install_event_loop, tune_writer
+
+# name -> (use_uvloop, tune_writer kwargs, listen backlog)
+SCENARIOS = {
+    'default': (False, {}, 100),
+    'nodelay_off': (False, {'nodelay': False}, 100),
+    'nodelay_on': (False, {'nodelay': True}, 100),
+    'small_sockbuf': (False, {'nodelay': True, 'sndbuf': 8 * 1024, 'rcvbuf': 8 * 1024}, 100),
+    'large_sockbuf': (False, {'nodelay': True, 'sndbuf': 1024 * 1024, 'rcvbuf': 1024 * 1024}, 100),
+    'low_watermark': (False, {'nodelay': True, 'write_high': 4 * 1024, 'write_low': 1024}, 100),
+    'high_watermark': (False, {'nodelay': True, 'write_high': 1024 * 1024, 'write_low': 256 * 1024}, 100),
+    'backlog_1024': (False, {'nodelay': True}, 1024),
+    'uvloop': (True, {'nodelay': True}, 1024),
+}
+
+
+async def _echo(reader, writer, tuning):
+    tune_writer(writer, **tuning)
+    buffer = b''
+    try:
+        while True:
+            message, buffer = await AsyncProtocol.deserialize_stream(reader, buffer)
+            if message is None:
+                break
+            writer.write(protocol.create_payload('echo', message['payload']))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _run_scenario(tuning, backlog, rounds, frames, size):
+    server = await asyncio.start_server(lambda r, w: _echo(r, w, tuning), '127.0.0.1', 0, backlog=backlog)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    tune_writer(writer, **tuning)
+    small = protocol.create_payload('ping', {'message': 'x' * 16})
+    big = protocol.create_payload('bulk', {'message': 'x' * size})
+
+    # Latency: one frame in flight at a time.
+    latencies = []
+    buffer = b''
+    for _ in range(rounds):
+        start = time.perf_counter()
+        writer.write(small)
+        await writer.drain()
+        _, buffer = await AsyncProtocol.deserialize_stream(reader, buffer)
+        latencies.append(time.perf_counter() - start)
+
+    # Throughput: writer and reader run concurrently, many frames in flight.
+    async def produce():
+        for _ in range(frames):
+            writer.write(big)
+            await writer.drain()
+
+    async def consume():
+        buf = b''
+        for _ in range(frames):
+            _, buf = await AsyncProtocol.deserialize_stream(reader, buf)
+
+    start = time.perf_counter()
+    await asyncio.gather(produce(), consume())
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+    await writer.wait_closed()
+    server.close()
+    await server.wait_closed()
+
+    latencies.sort()
+    return {
+        'p50_us': statistics.median(latencies) * 1e6,
+        'p99_us': latencies[int(len(latencies) * 0.99) - 1] * 1e6,
+        'msgs_per_s': frames / elapsed,
+        'mb_per_s': frames * len(big) / elapsed / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=2000, help='sequential ping/pong round trips')
+    parser.add_argument('--frames', type=int, default=20000, help='pipelined frames for the throughput run')
+    parser.add_argument('--size', type=int, default=256, help='payload size of throughput frames')
+    parser.add_argument('--only', nargs='*', help='run only these scenarios')
+    args = parser.parse_args()
+
+    print(f"{'scenario':<16}{'p50 us':>10}{'p99 us':>10}{'msgs/s':>12}{'MB/s':>9}")
+    for name, (use_uvloop, tuning, backlog) in SCENARIOS.items():
+        if args.only and name not in args.only:
+            continue
+        if use_uvloop:
+            if not install_event_loop(True):
+                print(f"{name:<16}  skipped (uvloop not installed)")
+                continue
+        else:
+            asyncio.set_event_loop_policy(None)
+        result = asyncio.run(_run_scenario(tuning, backlog, args.rounds, args.frames, args.size))
+        print(f"{name:<16}{result['p50_us']:>10.1f}{result['p99_us']:>10.1f}"
+              f"{result['msgs_per_s']:>12.0f}{result['mb_per_s']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Unix domain socket versus TCP loopback benchmark.
+
+Starts one ChatServer in a child process listening on both a TCP port and a Unix socket (memory
+repositories and no rate limiting, so the transport and dispatch dominate), then for each transport
+connects a sender and a receiver that are friends and measures:
+
+    latency     sequential 'send' round trips: request written -> response read by the sender
+    throughput  pipelined 'send' requests with --window in flight, until the receiver got them all
+
+    python -m benchmarks.bench_uds [--rounds 5000] [--messages 50000] [--window 64]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common.protocol import AsyncProtocol, protocol
+from common.transport import open_connection
+from tools.stats import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRANSPORTS = ('tcp', 'unix')
+
+_SERVE = """
+import asyncio, logging
+from server import config
+config.REPOSITORY_BACKEND = 'memory'
+config.RATE_LIMIT_ENABLED = False
+config.UNIX_SOCKET_PATHS = ({path!r},)
+from server.server import ChatServer
+logging.getLogger().setLevel(logging.WARNING)
+
+async def main():
+    server = ChatServer(port=0)
+    task = asyncio.create_task(server.start())
+    while server.server is None:
+        await asyncio.sleep(0.01)
+    print(server.server.sockets[0].getsockname()[1], flush=True)
+    await task
+
+asyncio.run(main())
+"""
+
+
+class Peer:
+    def __init__(self, reader, writer):
+        self.reader, self.writer, self.buffer = reader, writer, b''
+        self.auth_token = None
+
+    @classmethod
+    async def connect(cls, transport: str, port: int, path: str) -> 'Peer':
+        return cls(*await open_connection('127.0.0.1', port, path if transport == 'unix' else None))
+
+    def frame(self, msg_type: str, **payload) -> bytes:
+        return protocol.create_payload(msg_type, {**payload, 'auth_token': self.auth_token})
+
+    async def receive(self) -> dict:
+        message, self.buffer = await AsyncProtocol.deserialize_stream(self.reader, self.buffer)
+        if message is None:
+            raise ConnectionError('server closed the connection')
+        return message
+
+    async def request(self, msg_type: str, **payload) -> dict:
+        self.writer.write(self.frame(msg_type, **payload))
+        await self.writer.drain()
+        return await self.receive()
+
+    async def login(self, username: str):
+        await self.request('reg', username=username, password='pw')
+        self.auth_token = (await self.request('login', username=username, password='pw'))['payload']['auth_token']
+
+
+async def run_transport(transport: str, port: int, path: str, args) -> dict:
+    sender = await Peer.connect(transport, port, path)
+    receiver = await Peer.connect(transport, port, path)
+    await sender.login(f"{transport}-sender")
+    await receiver.login(f"{transport}-receiver")
+    await sender.request('add_friend', username=f"{transport}-receiver")
+    await receiver.request('accept_friend', username=f"{transport}-sender")
+    await sender.receive()  # acceptance notification
+
+    delivered = 0
+    all_delivered = asyncio.Event()
+    expected = args.rounds + args.messages
+
+    async def drain_receiver():
+        nonlocal delivered
+        while delivered < expected:
+            if (await receiver.receive())['type'] == 'usersend':
+                delivered += 1
+        all_delivered.set()
+
+    receiving = asyncio.create_task(drain_receiver())
+    send = sender.frame('send', username=f"{transport}-receiver", message='x' * args.size)
+
+    latencies = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        sender.writer.write(send)
+        await sender.writer.drain()
+        await sender.receive()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    window = asyncio.Semaphore(args.window)
+
+    async def produce():
+        for _ in range(args.messages):
+            await window.acquire()
+            sender.writer.write(send)
+            await sender.writer.drain()
+
+    async def consume():
+        for _ in range(args.messages):
+            await sender.receive()
+            window.release()
+
+    start = time.perf_counter()
+    await asyncio.gather(produce(), consume())
+    await asyncio.wait_for(all_delivered.wait(), timeout=60)
+    elapsed = time.perf_counter() - start
+    await receiving
+
+    for peer in (sender, receiver):
+        peer.writer.close()
+    return {
+        'p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 1),
+        'messages_per_second': round(args.messages / elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5000, help='sequential round trips for latency')
+    parser.add_argument('--messages', type=int, default=50_000, help='pipelined messages for throughput')
+    parser.add_argument('--window', type=int, default=64, help='requests in flight during the throughput run')
+    parser.add_argument('--size', type=int, default=100, help='message text length')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    results = {'rounds': args.rounds, 'messages': args.messages, 'window': args.window, 'size': args.size}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'chat.sock')
+        server = subprocess.Popen([sys.executable, '-c', _SERVE.format(path=path)], cwd=ROOT,
+                                  stdout=subprocess.PIPE, text=True)
+        try:
+            port = int(server.stdout.readline())
+            print(f"{'transport':<10}{'p50 us':>10}{'p99 us':>10}{'msgs/s':>12}")
+            for transport in TRANSPORTS:
+                r = results[transport] = asyncio.run(run_transport(transport, port, path, args))
+                print(f"{transport:<10}{r['p50_us']:>10.1f}{r['p99_us']:>10.1f}{r['messages_per_second']:>12}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Load generator: drives many simulated clients against a ChatServer.
+
+Registers and logs in N users, builds a ring-shaped friend graph (every user befriends the next K users),
+keeps a fraction of the users offline, then runs a weighted mix of operations for a fixed duration:
+
+    send       private message to an online friend
+    offline    private message to an offline friend (stored as an offline message)
+    myfriends  friend list query
+    broadcast  admin broadcast to everyone online
+
+Throughput, p50/p99/p999 latency and error counts are printed per operation and saved as JSON so runs can
+be compared across commits. By default a local server is started in a subprocess on a scratch database.
+
+    python -m benchmarks.loadgen --users 500 --duration 30 --mix send=70,offline=10,myfriends=15,broadcast=5
+    python -m benchmarks.loadgen --port 18888 --users 100        # against an already running server
+    python -m benchmarks.loadgen --backend memory                # local server on the in-memory repositories
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from common.protocol import AsyncProtocol, protocol
+from tools.stats import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PUSH_TYPES = ('usersend', 'sysmsg', 'userbroadcast')
+PASSWORD = 'loadgen-pw'
+
+
+class LoadClient:
+    """One simulated user: a connection plus a reader task matching responses to requests in order."""
+    def __init__(self, username: str):
+        self.username = username
+        self.auth_token = None
+        self.pushes = 0
+        self._pending = deque()
+        self._reader_task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        buffer = b''
+        try:
+            while True:
+                message, buffer = await AsyncProtocol.deserialize_stream(self.reader, buffer)
+                if message is None:
+                    break
+                if message['type'] in PUSH_TYPES:
+                    self.pushes += 1
+                elif self._pending:
+                    # The server answers each connection's requests in order
+                    future = self._pending.popleft()
+                    if not future.done():
+                        future.set_result(message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError('connection closed'))
+
+    async def request(self, msg_type: str, timeout: float = 30, **payload) -> dict:
+        payload['auth_token'] = self.auth_token
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self.writer.write(protocol.create_payload(msg_type, payload))
+        await self.writer.drain()
+        return await asyncio.wait_for(future, timeout)
+
+    async def request_retrying(self, msg_type: str, attempts: int = 20, **payload) -> dict:
+        """Retries requests that were shed or throttled, honouring the retry-after hint."""
+        for _ in range(attempts):
+            response = await self.request(msg_type, **payload)
+            if response['type'] not in ('shed', 'throttled'):
+                return response
+            await asyncio.sleep(response['payload'].get('retry_after', 1) * random.uniform(1, 1.5))
+        return response
+
+    async def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+async def setup(args, host, port):
+    clients = [LoadClient(f"{args.prefix}{i}") for i in range(args.users)]
+    sem = asyncio.Semaphore(args.setup_concurrency)
+
+    async def register_and_login(client):
+        async with sem:
+            await client.connect(host, port)
+            await client.request_retrying('reg', username=client.username, password=PASSWORD)
+            response = await client.request_retrying('login', username=client.username, password=PASSWORD)
+            if response['type'] != 'login_success':
+                raise RuntimeError(f"login failed for {client.username}: {response}")
+            client.auth_token = response['payload']['auth_token']
+
+    started = time.perf_counter()
+    await asyncio.gather(*(register_and_login(c) for c in clients))
+    print(f"registered and logged in {len(clients)} users in {time.perf_counter() - started:.1f}s")
+
+    # Ring friend graph: i -> i+1 .. i+K
+    friends = defaultdict(set)
+    by_name = {c.username: c for c in clients}
+    started = time.perf_counter()
+
+    async def befriend(i):
+        async with sem:
+            for step in range(1, args.friends + 1):
+                j = (i + step) % len(clients)
+                if j == i or clients[j].username in friends[clients[i].username]:
+                    continue
+                await clients[i].request_retrying('add_friend', username=clients[j].username)
+                friends[clients[i].username].add(clients[j].username)
+                friends[clients[j].username].add(clients[i].username)
+
+    await asyncio.gather(*(befriend(i) for i in range(len(clients))))
+
+    async def accept_all(client):
+        async with sem:
+            for other in sorted(friends[client.username]):
+                await client.request_retrying('accept_friend', username=other)
+
+    await asyncio.gather(*(accept_all(c) for c in clients))
+    print(f"built friend graph ({args.friends} per user) in {time.perf_counter() - started:.1f}s")
+
+    # Take a fraction of the users offline so 'offline' sends hit the offline store
+    offline_count = int(len(clients) * args.offline_fraction)
+    offline = set(c.username for c in clients[-offline_count:]) if offline_count else set()
+    for client in clients[-offline_count:] if offline_count else []:
+        await client.close()
+    online = [c for c in clients if c.username not in offline]
+    return online, offline, friends, by_name
+
+
+async def run_mix(args, online, offline, friends, admin_name):
+    mix = parse_mix(args.mix)
+    if admin_name is None:
+        mix.pop('broadcast', None)
+    names, weights = zip(*mix.items())
+    latencies = defaultdict(list)
+    errors = defaultdict(lambda: defaultdict(int))
+    deadline = time.perf_counter() + args.duration
+
+    async def worker(client):
+        rng = random.Random(client.username)
+        online_friends = [f for f in friends[client.username] if f not in offline]
+        offline_friends = [f for f in friends[client.username] if f in offline]
+        while time.perf_counter() < deadline:
+            op = rng.choices(names, weights)[0]
+            if op == 'send' and online_friends:
+                msg_type, payload = 'send', {'username': rng.choice(online_friends), 'message': 'hello'}
+            elif op == 'offline' and offline_friends:
+                msg_type, payload = 'send', {'username': rng.choice(offline_friends), 'message': 'are you there?'}
+            elif op == 'broadcast' and client.username == admin_name:
+                msg_type, payload = 'broadcast', {'message': 'load test'}
+            elif op in ('myfriends', 'send', 'offline', 'broadcast'):
+                op, msg_type, payload = 'myfriends', 'myfriends', {}
+            else:
+                continue
+            start = time.perf_counter()
+            try:
+                response = await client.request(msg_type, timeout=args.timeout, **payload)
+            except asyncio.TimeoutError:
+                errors[op]['timeout'] += 1
+                continue
+            except ConnectionError:
+                errors[op]['disconnected'] += 1
+                return
+            elapsed = time.perf_counter() - start
+            message = response['payload'].get('message', '')
+            if response['type'] in ('throttled', 'shed'):
+                errors[op][response['type']] += 1
+            elif message.startswith('Server error'):
+                errors[op]['server_error'] += 1
+            else:
+                latencies[op].append(elapsed)
+            if args.think_time:
+                await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(c) for c in online))
+    return latencies, errors, time.perf_counter() - started
+
+
+def report(latencies, errors, elapsed) -> dict:
+    results = {'elapsed_s': elapsed, 'operations': {}}
+    total = 0
+    print(f"\n{'op':<11}{'count':>8}{'ops/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}  errors")
+    for op in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies.get(op, []))
+        total += len(values)
+        stats = {
+            'count': len(values),
+            'ops_per_s': len(values) / elapsed,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'p999_ms': percentile(values, 99.9) * 1000,
+            'errors': dict(errors.get(op, {})),
+        }
+        results['operations'][op] = stats
+        print(f"{op:<11}{stats['count']:>8}{stats['ops_per_s']:>10.0f}{stats['p50_ms']:>9.2f}"
+              f"{stats['p99_ms']:>9.2f}{stats['p999_ms']:>9.2f}  {stats['errors'] or ''}")
+    results['total_ops_per_s'] = total / elapsed
+    print(f"total throughput: {results['total_ops_per_s']:.0f} ops/s")
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def start_local_server(db_path: str, rate_limit: bool, backend: str = 'sqlalchemy', admin: str = None):
+    """Starts a ChatServer on a scratch database (or in-memory repositories) in a subprocess; returns (process, port)."""
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.loadgen', '--serve', '--db', db_path, '--backend', backend]
+        + (['--rate-limit'] if rate_limit else []) + (['--admin', admin] if admin else []),
+        cwd=ROOT, stdout=subprocess.PIPE, text=True,
+    )
+    line = proc.stdout.readline()
+    if not line.startswith('PORT'):
+        proc.kill()
+        raise RuntimeError('local server failed to start')
+    return proc, int(line.split()[1])
+
+
+def serve(db_path: str, rate_limit: bool, backend: str = 'sqlalchemy', admin: str = None):
+    """Subprocess entry point: runs a ChatServer on an ephemeral port and prints it."""
+    import logging
+    from server import config
+    from server.db import session as db_session
+    from server.server import ChatServer
+
+    logging.disable(logging.WARNING)
+    config.RATE_LIMIT_ENABLED = rate_limit
+    config.REPOSITORY_BACKEND = backend
+    # The memory backend has no database to promote the admin in afterwards
+    config.MEMORY_ADMINS = (admin,) if admin else ()
+
+    async def main():
+        db_session.configure_engine(f"sqlite+aiosqlite:///{db_path}")
+        server = ChatServer(port=0)
+        await server.backend.create()
+        task = asyncio.create_task(server.start())
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        print('PORT', server.server.sockets[0].getsockname()[1], flush=True)
+        await task
+
+    asyncio.run(main())
+
+
+async def main_async(args):
+    proc = None
+    host, port = args.host, args.port
+    tmp = tempfile.TemporaryDirectory()
+    db_path = os.path.join(tmp.name, 'loadgen.db')
+    if port is None:
+        # The first user stays online and is the one promoted to admin below
+        proc, port = start_local_server(db_path, args.rate_limit, args.backend, f"{args.prefix}0")
+    try:
+        online, offline, friends, by_name = await setup(args, host, port)
+
+        admin_name = None
+        if proc is not None and online:
+            # Local scratch server: promote one online user to admin so broadcasts can be driven
+            admin_name = online[0].username
+            if args.backend == 'sqlalchemy':
+                with sqlite3.connect(db_path) as conn:
+                    conn.execute("UPDATE users SET is_admin = 1 WHERE username = ?", (admin_name,))
+
+        print(f"running mix {args.mix} for {args.duration}s with {len(online)} online / {len(offline)} offline users")
+        latencies, errors, elapsed = await run_mix(args, online, offline, friends, admin_name)
+        results = report(latencies, errors, elapsed)
+        results.update({
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {k: v for k, v in vars(args).items() if k not in ('serve', 'db', 'admin')},
+        })
+        if args.output:
+            with open(args.output, 'w', encoding='utf8') as f:
+                json.dump(results, f, indent=2)
+            print(f"results written to {args.output}")
+        for client in online:
+            await client.close()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        tmp.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help='target an existing server instead of a local one')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=5, help='friends per user (ring graph)')
+    parser.add_argument('--offline-fraction', type=float, default=0.1)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--mix', default='send=70,offline=10,myfriends=15,broadcast=5')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds between requests per user')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--setup-concurrency', type=int, default=64)
+    parser.add_argument('--prefix', default='lg', help='username prefix')
+    parser.add_argument('--rate-limit', action='store_true', help='keep rate limiting enabled on the local server')
+    parser.add_argument('--backend', choices=('sqlalchemy', 'memory'), default='sqlalchemy',
+                        help='repository backend of the local server')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--admin', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.db, args.rate_limit, args.backend, args.admin)
+    else:
+        asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
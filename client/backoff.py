@@ -0,0 +1,11 @@
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: float = 0.0) -> float:
+    """
+    Exponential backoff with full jitter for the given (0-based) attempt.
+    A server retry-after hint is a lower bound; up to 50% jitter is added on top of it
+    so clients shed together do not all reconnect in the same instant.
+    """
+    import random  # deferred: only needed once a reconnect actually happens
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after:
+        delay = max(delay, retry_after + random.uniform(0, retry_after * 0.5))
+    return delay
@@ -1,12 +1,17 @@
 import asyncio
 import logging
+import os
 import sys
-import time
-from common.protocol import AsyncProtocol
+from common.protocol import AsyncProtocol, protocol
+from common.transport import install_event_loop, open_connection, tune_writer
 from client.handler import ClientMessageHandler
+from client.backoff import backoff_delay
+from client.outbox import Outbox
+from client import config
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Parameter names ending in '?' are optional; a required last parameter takes the rest of the line.
 CMD_MAP = {
     'reg': ['username', 'password'],
     'login': ['username', 'password'],
@@ -14,16 +19,28 @@ CMD_MAP = {
     'accept_friend': ['username'],
     'myfriends': [],
     'send': ['username', 'message'],
+    'history': ['username', 'before_id?', 'limit?'],
+    'search': ['keyword', 'page?'],
     'broadcast': ['message'],
     'ban_user': ['username'],
     'permit_user': ['username'],
+    'ban_users': ['usernames'],
+    'permit_users': ['usernames'],
+    'import_users': ['path'],
+    'ratelimit_stats': [],
+    'stats': [],
+    'profile': ['seconds'],
+    'maintenance': ['action?'],
     'logout': [],
 }
 
 class ChatClient:
-    def __init__(self, host='127.0.0.1', port=8888, reconnect_delay=5):
+    def __init__(self, host=config.SERVER_HOST, port=config.SERVER_PORT, reconnect_delay=config.RECONNECT_BASE_DELAY,
+                 path=config.SERVER_UNIX_PATH):
         self.host = host
         self.port = port
+        # Unix domain socket path; when set it is used instead of host:port
+        self.path = path
         self.reader = None
         self.writer = None
         self.handler = ClientMessageHandler(self)
@@ -32,26 +49,70 @@ class ChatClient:
         self._is_connected = False
         self._reconnect_delay = reconnect_delay
         self._listener_task = None
+        # Earliest time (loop clock) the server asked us to reconnect at, from a 'shed' frame
+        self._retry_not_before = 0.0
+        # Frames typed while disconnected, replayed in order once the connection is back
+        self.outbox = Outbox(config.OUTBOX_MAX_MESSAGES, config.OUTBOX_SPILL_PATH)
+        self._reconnect_task = None
+        # Highest delivery sequence number received for the logged-in user, and the last one acked
+        self.username = None
+        self.last_seq = 0
+        self._acked_seq = 0
+        self._ack_handle = None
+        # One context for all reconnects, so each reconnect can resume the previous TLS session
+        self._ssl_context = None
+        if config.TLS_ENABLED:
+            from common.tls import client_context
+            self._ssl_context = client_context(config.TLS_CAFILE, config.TLS_SESSION_RESUMPTION)
+
+    def defer_reconnect(self, retry_after: float):
+        """Records a server retry-after hint; the next connect() waits at least that long."""
+        loop = asyncio.get_running_loop()
+        self._retry_not_before = max(self._retry_not_before, loop.time() + retry_after)
 
     async def connect(self):
-        """Tries to connect to the server with retries."""
-        logging.info(f"正在连接到服务器 {self.host}:{self.port}...")
-        for attempt in range(3):
+        """Tries to connect to the server, backing off exponentially with jitter between attempts."""
+        loop = asyncio.get_running_loop()
+        logging.info(f"正在连接到服务器 {self.path or f'{self.host}:{self.port}'}...")
+        attempts = config.RECONNECT_ATTEMPTS
+        for attempt in range(attempts):
+            retry_after = self._retry_not_before - loop.time()
+            if retry_after > 0:
+                delay = backoff_delay(attempt, self._reconnect_delay, config.RECONNECT_MAX_DELAY, retry_after)
+                logging.info(f"服务器繁忙，{delay:.1f} 秒后重新连接...")
+                await asyncio.sleep(delay)
             try:
-                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                self.reader, self.writer = await open_connection(
+                    self.host, self.port, self.path, ssl=self._ssl_context,
+                    server_hostname=config.TLS_SERVER_HOSTNAME or self.host)
+                tune_writer(
+                    self.writer,
+                    nodelay=config.TCP_NODELAY,
+                    sndbuf=config.SOCKET_SNDBUF,
+                    rcvbuf=config.SOCKET_RCVBUF,
+                    write_high=config.WRITE_BUFFER_HIGH,
+                    write_low=config.WRITE_BUFFER_LOW,
+                )
                 self._is_connected = True
-                logging.info("成功连接到服务器。")
+                ssl_object = self.writer.get_extra_info('ssl_object')
+                if ssl_object is not None:
+                    logging.info(f"成功连接到服务器（{ssl_object.version()}，"
+                                 f"{'会话复用' if ssl_object.session_reused else '完整握手'}）。")
+                else:
+                    logging.info("成功连接到服务器。")
                 # Start the message listener upon successful connection
                 if self._listener_task:
                     self._listener_task.cancel()
                 self._listener_task = asyncio.create_task(self.listen_for_messages())
                 return True
             except ConnectionRefusedError:
-                logging.warning(f"连接被拒绝。将在 {self._reconnect_delay} 秒后重试... ({attempt + 1}/3)")
-                await asyncio.sleep(self._reconnect_delay)
+                delay = backoff_delay(attempt, self._reconnect_delay, config.RECONNECT_MAX_DELAY)
+                logging.warning(f"连接被拒绝。将在 {delay:.1f} 秒后重试... ({attempt + 1}/{attempts})")
+                await asyncio.sleep(delay)
             except Exception as e:
-                logging.error(f"连接失败: {e}。将在 {self._reconnect_delay} 秒后重试... ({attempt + 1}/3)")
-                await asyncio.sleep(self._reconnect_delay)
+                delay = backoff_delay(attempt, self._reconnect_delay, config.RECONNECT_MAX_DELAY)
+                logging.error(f"连接失败: {e}。将在 {delay:.1f} 秒后重试... ({attempt + 1}/{attempts})")
+                await asyncio.sleep(delay)
         
         logging.error("无法连接到服务器。请检查服务器地址或网络连接。")
         return False
@@ -73,7 +134,7 @@ class ChatClient:
                 self.writer = None
                 self.reader = None
                 # Do not attempt to reconnect here, let the next user action trigger it.
-                print("\n[系统提示] 与服务器断开连接。下次发送消息时将尝试自动重连。")
+                print("\n[系统提示] 与服务器断开连接。之后发送的消息会先进入发送队列，并在重连后自动发送。")
                 break # Exit the listening loop
             except Exception as e:
                 logging.error(f"接收消息时发生未知错误: {e}")
@@ -82,21 +143,71 @@ class ChatClient:
 
 
     async def send_message(self, message: bytes):
-        """Ensures connection is active before sending, attempts reconnect if not."""
-        if not self._is_connected:
-            print("[系统提示] 连接已断开，正在尝试重新连接...")
-            if not await self.connect():
-                print("[系统提示] 重连失败。请稍后再试。")
-                return False
-        
-        try:
-            self.writer.write(message)
-            await self.writer.drain()
-            return True
-        except ConnectionError as e:
-            logging.error(f"发送消息失败: {e}")
-            self._is_connected = False
+        """
+        Sends a frame. While the connection is down the frame is queued in the outbox instead and a
+        background reconnect is started, so the input loop never waits on reconnect attempts.
+        """
+        if self._is_connected and not self.outbox:
+            try:
+                self.writer.write(message)
+                await self.writer.drain()
+                return True
+            except ConnectionError as e:
+                # The frame may or may not have reached the server; replaying it is safe thanks to msg_id
+                logging.error(f"发送消息失败: {e}")
+                self._is_connected = False
+
+        if not self.outbox.put(message):
+            print("[系统提示] 发送队列已满，消息未能发送。")
             return False
+        print(f"[系统提示] 连接已断开，消息已加入发送队列（{len(self.outbox)} 条待发送），重连后将自动发送。")
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect_and_flush())
+        return True
+
+    async def _reconnect_and_flush(self):
+        if not await self.connect():
+            print("[系统提示] 重连失败，消息仍保留在发送队列中，下次发送时将再次尝试。")
+            return
+        self.resume_session()
+        self.flush_outbox()
+
+    def resume_session(self):
+        """After a reconnect, re-binds the connection to the session; the server replays messages after last_seq."""
+        if self.auth_token and self._is_connected:
+            self.writer.write(protocol.create_payload(
+                'resume', {'auth_token': self.auth_token, 'last_seq': self.last_seq}))
+
+    def accept_seq(self, seq: int) -> bool:
+        """
+        Records a received sequenced message. Returns False for a duplicate (already received before a reconnect).
+        Acks are cumulative and batched: sent once ACK_BATCH messages are pending or ACK_DELAY has passed.
+        """
+        if seq <= self.last_seq:
+            return False
+        self.last_seq = seq
+        if self.last_seq - self._acked_seq >= config.ACK_BATCH:
+            self.send_ack()
+        elif self._ack_handle is None:
+            self._ack_handle = asyncio.get_running_loop().call_later(config.ACK_DELAY, self.send_ack)
+        return True
+
+    def send_ack(self):
+        if self._ack_handle is not None:
+            self._ack_handle.cancel()
+            self._ack_handle = None
+        if self._is_connected and self.last_seq > self._acked_seq:
+            self.writer.write(protocol.create_ack(self.last_seq))
+            self._acked_seq = self.last_seq
+
+    def flush_outbox(self):
+        """Writes all queued frames as one coalesced write. Must run right after connect(), before any await."""
+        if not self.outbox or not self._is_connected:
+            return
+        count = len(self.outbox)
+        self.writer.write(self.outbox.peek())
+        self.outbox.clear()
+        print(f"[系统提示] 已重新连接，补发 {count} 条消息。")
 
     async def handle_user_input(self):
         """Generic command processor driven by CMD_MAP."""
@@ -122,24 +233,46 @@ class ChatClient:
                 continue
 
             param_names = CMD_MAP[command]
-            num_expected_params = len(param_names)
+            num_required_params = sum(1 for p in param_names if not p.endswith('?'))
             user_params = parts[1:]
 
-            if len(user_params) < num_expected_params:
-                usage = f"用法: {command} " + " ".join([f"<{p}>" for p in param_names])
+            if len(user_params) < num_required_params:
+                usage = f"用法: {command} " + " ".join(
+                    f"[{p[:-1]}]" if p.endswith('?') else f"<{p}>" for p in param_names)
                 print(usage)
                 continue
 
-            payload = {'auth_token': self.auth_token}
-            if num_expected_params > 0:
-                # Assign first N-1 parameters
-                for i in range(num_expected_params - 1):
-                    payload[param_names[i]] = user_params[i]
-                # Assign the rest to the last parameter
-                payload[param_names[-1]] = " ".join(user_params[num_expected_params - 1:])
+            # msg_id lets the server drop this message if it is replayed from the outbox after a reconnect
+            payload = {'auth_token': self.auth_token, 'msg_id': os.urandom(8).hex()}
+            for i, name in enumerate(param_names):
+                if name.endswith('?'):
+                    if i < len(user_params):
+                        payload[name[:-1]] = user_params[i]
+                elif i == len(param_names) - 1:
+                    # Assign the rest to the last parameter
+                    payload[name] = " ".join(user_params[i:])
+                else:
+                    payload[name] = user_params[i]
             
+            if command == 'import_users':
+                # The file is read locally and uploaded; the server reports progress as it imports
+                path = payload.pop('path')
+                try:
+                    with open(path, encoding='utf8') as f:
+                        payload['data'] = f.read()
+                except OSError as e:
+                    print(f"无法读取文件 '{path}': {e}")
+                    continue
+                payload['format'] = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+            if command == 'login':
+                if payload['username'] != self.username:
+                    # Sequence numbers are per user
+                    self.username, self.last_seq, self._acked_seq = payload['username'], 0, 0
+                payload['last_seq'] = self.last_seq
+
             if not await self.send_message(AsyncProtocol.create_payload(command, payload)):
-                continue # Don't proceed if sending failed
+                continue # Don't proceed if the message could neither be sent nor queued
 
             if command == 'logout':
                 self.auth_token = None
@@ -155,6 +288,8 @@ class ChatClient:
         await self.handle_user_input()
 
     async def close(self):
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
         if self.writer:
             self.writer.close()
             await self.writer.wait_closed()
@@ -170,6 +305,7 @@ async def main():
         await client.close()
 
 if __name__ == '__main__':
+    install_event_loop(config.USE_UVLOOP)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
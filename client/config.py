@@ -1 +1,47 @@
-  
+# Client-side configuration.
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8888
+# Connect to the server's Unix domain socket (its UNIX_SOCKET_PATHS) instead of SERVER_HOST:SERVER_PORT;
+# only for clients on the server host. None uses TCP.
+SERVER_UNIX_PATH = None
+
+# --- Event loop & transport tuning ---
+# Use uvloop when it is installed (pip install uvloop); falls back to the stock asyncio loop.
+USE_UVLOOP = True
+# Disable Nagle's algorithm so small chat frames are sent immediately.
+TCP_NODELAY = True
+# Kernel socket buffer sizes in bytes (None keeps the OS default).
+SOCKET_SNDBUF = None
+SOCKET_RCVBUF = None
+# Transport write-buffer watermarks: drain() blocks above HIGH and resumes below LOW.
+WRITE_BUFFER_HIGH = 64 * 1024
+WRITE_BUFFER_LOW = 16 * 1024
+
+# --- TLS ---
+# Connect over TLS; the server must have TLS_CERTFILE configured.
+TLS_ENABLED = False
+# CA/self-signed certificate to trust (PEM); None uses the system CAs.
+TLS_CAFILE = None
+# Name checked against the certificate; None uses SERVER_HOST.
+TLS_SERVER_HOSTNAME = None
+# Resume the previous TLS session on reconnect (abbreviated handshake).
+TLS_SESSION_RESUMPTION = True
+
+# --- Reconnect ---
+# Exponential backoff with full jitter: attempt n waits uniform(0, min(MAX, BASE * 2**n)) seconds.
+# A retry-after hint from the server is honoured as a lower bound.
+RECONNECT_ATTEMPTS = 5
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+# --- Outbound queue ---
+# Messages typed while disconnected are queued and sent in order once the connection is back.
+OUTBOX_MAX_MESSAGES = 1000
+# Optional file for frames beyond OUTBOX_MAX_MESSAGES; None drops them with a warning instead.
+OUTBOX_SPILL_PATH = None
+
+# --- Delivery acknowledgements ---
+# Received messages are acked cumulatively: after ACK_BATCH messages or ACK_DELAY seconds, whichever comes first.
+ACK_BATCH = 32
+ACK_DELAY = 0.2
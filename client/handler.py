@@ -30,10 +30,23 @@ class ClientMessageHandler:
         print(f"[Server]: {payload.get('message')}")
 
     async def handle_usersend(self, message: dict):
+        seq = message.get('payload', {}).get('seq')
+        if seq is not None and not self.client.accept_seq(seq):
+            return  # 重连后服务端补发的重复消息
         print(protocol.show_user_msg(message))
 
     async def handle_sysmsg(self, message: dict):
         print(protocol.show_user_msg(message))
 
+    async def handle_throttled(self, message: dict):
+        payload = message.get('payload', {})
+        print(f"[Server]: {payload.get('message')}")
+
+    async def handle_shed(self, message: dict):
+        # 服务器过载，记录 retry_after，下次重连时至少等待这么久
+        payload = message.get('payload', {})
+        self.client.defer_reconnect(payload.get('retry_after', 0))
+        print(f"[Server]: {payload.get('message')} (retry in {payload.get('retry_after')}s)")
+
     async def handle_unknown_message(self, message: dict):
         print(f"Unknown message type from server: {message}")
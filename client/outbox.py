@@ -0,0 +1,56 @@
+import logging
+import os
+from collections import deque
+
+
+class Outbox:
+    """
+    Bounded FIFO of encoded frames waiting for the connection to come back.
+    Up to max_messages frames are kept in memory; beyond that they are appended to spill_path
+    (if configured) so nothing typed during an outage is lost. Once spilling has started every
+    newer frame goes to disk as well, which keeps the replay order intact.
+    """
+    def __init__(self, max_messages: int = 1000, spill_path: str = None):
+        self.max_messages = max_messages
+        self.spill_path = spill_path
+        self._frames = deque()
+        self._spilled = 0
+        # Frames left over from a previous run carry a stale auth_token; start from an empty spill file
+        if spill_path and os.path.exists(spill_path):
+            os.remove(spill_path)
+
+    def __len__(self):
+        return len(self._frames) + self._spilled
+
+    def put(self, frame: bytes) -> bool:
+        """Queues a frame. Returns False if the outbox is full and there is no spill file."""
+        if not self._spilled and len(self._frames) < self.max_messages:
+            self._frames.append(frame)
+            return True
+        if not self.spill_path:
+            return False
+        try:
+            with open(self.spill_path, 'ab') as f:
+                f.write(frame)
+        except OSError as e:
+            logging.error(f"写入离线发送队列文件失败: {e}")
+            return False
+        self._spilled += 1
+        return True
+
+    def peek(self) -> bytes:
+        """All queued frames, oldest first, coalesced into one buffer for a single write."""
+        data = b''.join(self._frames)
+        if self._spilled:
+            with open(self.spill_path, 'rb') as f:
+                data += f.read()
+        return data
+
+    def clear(self):
+        self._frames.clear()
+        if self._spilled:
+            self._spilled = 0
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
@@ -0,0 +1,314 @@
+"""
+Programmatic asyncio client for bots and integrations.
+
+    client = AsyncChatClient('127.0.0.1', 8888)
+    await client.connect()
+    await client.login('bot1', 'secret')
+    await client.send('alice', 'hello')
+    print(await client.friends())
+    async for event in client.events():
+        print(event['type'], event['payload'])
+
+Requests are pipelined: each carries a req_id that the server echoes back, so any number of calls can be in
+flight on one connection and every awaitable resolves with its own response. Pushed messages (private
+messages, system notices, broadcasts) are delivered through events(). When the connection drops, in-flight
+calls fail with ConnectionLostError and the client reconnects in the background with exponential backoff
+and jitter, logging in again with the last credentials.
+
+Private messages carry a per-recipient sequence number. The client acks them cumulatively in batches and
+sends the last received number when logging in, so after a reconnect the server replays only the gap;
+messages replayed twice are dropped before they reach events().
+
+Pass path='/run/p2sp/chat.sock' to connect to a server's Unix domain socket (same host only) instead of TCP.
+Pass ssl_context=common.tls.client_context(cafile) (or set TLS_ENABLED in client/config.py) to connect over
+TLS; reconnects then resume the previous TLS session instead of doing a full handshake.
+"""
+import asyncio
+import itertools
+import logging
+from typing import AsyncIterator, Dict, Optional
+
+from common.exceptions import (
+    AuthenticationError, ConnectionLostError, RequestFailedError, ServerBusyError,
+)
+from common.protocol import AsyncProtocol, protocol
+from common.transport import open_connection
+from client.backoff import backoff_delay
+from client import config
+
+# Server-initiated frames; everything else is a response to a request
+PUSH_TYPES = frozenset(('usersend', 'sysmsg', 'userbroadcast'))
+
+
+class AsyncChatClient:
+    __slots__ = (
+        'host', 'port', 'path', 'ssl_context', 'server_hostname', 'auth_token', 'is_admin', 'user_id', 'reconnect',
+        '_reader', '_writer', '_pending', '_req_ids', '_events', '_reader_task',
+        '_reconnect_task', '_credentials', '_connected', '_ready', '_closed', '_retry_after',
+        '_last_seq', '_acked_seq', '_ack_handle',
+    )
+
+    def __init__(self, host: str = config.SERVER_HOST, port: int = config.SERVER_PORT,
+                 reconnect: bool = True, max_events: int = 1000, ssl_context=None, server_hostname: str = None,
+                 path: str = config.SERVER_UNIX_PATH):
+        self.host = host
+        self.port = port
+        # Unix domain socket path; when set it is used instead of host:port
+        self.path = path
+        # Reused across reconnects so a common.tls.client_context() resumes the previous session
+        if ssl_context is None and config.TLS_ENABLED:
+            from common.tls import client_context
+            ssl_context = client_context(config.TLS_CAFILE, config.TLS_SESSION_RESUMPTION)
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or config.TLS_SERVER_HOSTNAME or host
+        self.reconnect = reconnect
+        self.auth_token = None
+        self.is_admin = False
+        self.user_id = None
+        self._reader = None
+        self._writer = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._req_ids = itertools.count(1)
+        # Bounded so a bot that never reads events cannot grow without limit; oldest events are dropped
+        self._events: asyncio.Queue = asyncio.Queue(max_events)
+        self._reader_task = None
+        self._reconnect_task = None
+        self._credentials = None
+        self._connected = asyncio.Event()
+        # Connected and, once the client has logged in, logged in again: ordinary requests wait for this
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._retry_after = 0.0
+        self._last_seq = 0
+        self._acked_seq = 0
+        self._ack_handle = None
+
+    # --- connection management -------------------------------------------------
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    async def connect(self, attempts: int = config.RECONNECT_ATTEMPTS):
+        """Connects, retrying with exponential backoff and jitter. Raises ConnectionError when all attempts fail."""
+        last_error = None
+        for attempt in range(attempts):
+            if attempt or self._retry_after:
+                await asyncio.sleep(backoff_delay(
+                    attempt, config.RECONNECT_BASE_DELAY, config.RECONNECT_MAX_DELAY, self._retry_after))
+                self._retry_after = 0.0
+            try:
+                self._reader, self._writer = await open_connection(
+                    self.host, self.port, self.path, ssl=self.ssl_context, server_hostname=self.server_hostname)
+            except OSError as e:
+                last_error = e
+                continue
+            self._reader_task = asyncio.create_task(self._read_loop())
+            self._connected.set()
+            if not self._credentials:
+                self._ready.set()
+            return
+        raise ConnectionError(f"could not connect to {self.path or f'{self.host}:{self.port}'}: {last_error}")
+
+    async def close(self):
+        self._closed = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        await self._disconnect()
+        self._fail_pending(ConnectionLostError('client closed'))
+        # Wakes consumers blocked in events(); the bounded queue drops an old event to make room
+        if self._events.full():
+            self._events.get_nowait()
+        self._events.put_nowait(None)
+
+    async def _disconnect(self):
+        """Stops the reader task and closes the current connection, if any."""
+        self._connected.clear()
+        self._ready.clear()
+        if self._reader_task and self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+        self._reader_task = None
+        if self._writer:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _fail_pending(self, error: Exception):
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _read_loop(self):
+        buffer = b''
+        try:
+            while True:
+                message, buffer = await AsyncProtocol.deserialize_stream(self._reader, buffer)
+                if message is None:
+                    break
+                self._dispatch(message)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug(f"connection lost: {e}")
+        except asyncio.CancelledError:
+            return
+        except Exception:
+            logging.exception("unexpected error while reading from the server")
+        self._connected.clear()
+        self._ready.clear()
+        self._fail_pending(ConnectionLostError('connection to the server was lost'))
+        # A connection lost during a re-login is retried by the _reconnect() already running
+        if self.reconnect and not self._closed and (self._reconnect_task is None or self._reconnect_task.done()):
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    def _dispatch(self, message: dict):
+        payload = message.get('payload') or {}
+        req_id = payload.get('req_id')
+        if req_id is not None:
+            future = self._pending.pop(req_id, None)
+            if future is not None and not future.done():
+                future.set_result(message)
+            return
+        if message.get('type') == 'shed':
+            # Connection-level shed: the server closes the socket next; honour the hint on reconnect
+            self._retry_after = payload.get('retry_after', 0)
+        seq = payload.get('seq')
+        if seq is not None:
+            if seq <= self._last_seq:
+                return  # already delivered before a reconnect
+            self._last_seq = seq
+            self._schedule_ack()
+        if self._events.full():
+            self._events.get_nowait()
+        self._events.put_nowait(message)
+
+    def _schedule_ack(self):
+        if self._last_seq - self._acked_seq >= config.ACK_BATCH:
+            self._send_ack()
+        elif self._ack_handle is None:
+            self._ack_handle = asyncio.get_running_loop().call_later(config.ACK_DELAY, self._send_ack)
+
+    def _send_ack(self):
+        """Cumulative ack of everything received so far; acks get no response."""
+        if self._ack_handle is not None:
+            self._ack_handle.cancel()
+            self._ack_handle = None
+        if self._connected.is_set() and self._last_seq > self._acked_seq:
+            self._writer.write(protocol.create_ack(self._last_seq))
+            self._acked_seq = self._last_seq
+
+    async def _reconnect(self):
+        while not self._closed:
+            try:
+                await self.connect()
+                if self._credentials:
+                    await self.login(*self._credentials)
+                return
+            except ConnectionError as e:
+                logging.warning(f"reconnect failed: {e}")
+            except (ConnectionLostError, ServerBusyError) as e:
+                # The connection opened by connect() is not used again: close it before the next attempt
+                logging.warning(f"re-login failed: {e}")
+                if isinstance(e, ServerBusyError):
+                    self._retry_after = e.retry_after
+                await self._disconnect()
+            except AuthenticationError as e:
+                logging.error(f"re-login failed, giving up: {e}")
+                await self._disconnect()
+                return
+
+    # --- requests ---------------------------------------------------------------
+
+    async def request(self, msg_type: str, timeout: Optional[float] = 30, **payload) -> dict:
+        """
+        Sends one request and waits for its response message. Raises ServerBusyError when throttled or shed,
+        RequestFailedError when the server rejects it and ConnectionLostError if the connection drops first.
+        While the client reconnects, the request waits until the session is logged in again.
+        """
+        return await self._request(self._ready, msg_type, timeout, payload)
+
+    async def _request(self, ready: asyncio.Event, msg_type: str, timeout: Optional[float], payload: dict) -> dict:
+        if not ready.is_set():
+            await asyncio.wait_for(ready.wait(), timeout)
+        req_id = next(self._req_ids)
+        payload['auth_token'] = self.auth_token
+        payload['req_id'] = req_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = future
+        try:
+            self._writer.write(protocol.create_payload(msg_type, payload))
+            await self._writer.drain()
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(req_id, None)
+
+        body = response.get('payload') or {}
+        if response['type'] in ('throttled', 'shed'):
+            raise ServerBusyError(body.get('message', ''), body.get('retry_after', 0), response)
+        if body.get('ok') is False:
+            raise RequestFailedError(body.get('message', ''), response)
+        return body
+
+    async def register(self, username: str, password: str) -> str:
+        return (await self.request('reg', username=username, password=password))['message']
+
+    async def login(self, username: str, password: str) -> dict:
+        if self._credentials is None or self._credentials[0] != username:
+            # Sequence numbers are per user
+            self._last_seq = self._acked_seq = 0
+        try:
+            # Only needs the connection: the re-login after a reconnect is what makes the client ready
+            body = await self._request(self._connected, 'login', 30,
+                                       {'username': username, 'password': password, 'last_seq': self._last_seq})
+        except RequestFailedError as e:
+            if isinstance(e, ServerBusyError):
+                raise  # throttled or shed, not a rejection of the credentials
+            raise AuthenticationError(str(e)) from e
+        self.auth_token = body['auth_token']
+        self.is_admin = body.get('is_admin', False)
+        self.user_id = body.get('user_id')
+        self._credentials = (username, password)
+        self._ready.set()
+        return body
+
+    async def logout(self):
+        self.auth_token = None
+        self._credentials = None
+        if self._connected.is_set():
+            self._ready.set()
+
+    async def send(self, username: str, message: str) -> str:
+        return (await self.request('send', username=username, message=message))['message']
+
+    async def friends(self) -> list:
+        """Returns [{'username': ..., 'online': bool}, ...]."""
+        return (await self.request('myfriends')).get('friends', [])
+
+    async def add_friend(self, username: str) -> str:
+        return (await self.request('add_friend', username=username))['message']
+
+    async def accept_friend(self, username: str) -> str:
+        return (await self.request('accept_friend', username=username))['message']
+
+    async def broadcast(self, message: str) -> str:
+        return (await self.request('broadcast', message=message))['message']
+
+    # --- pushed events -----------------------------------------------------------
+
+    async def events(self) -> AsyncIterator[dict]:
+        """Yields server-pushed messages (usersend, sysmsg, userbroadcast, ...) until the client is closed."""
+        while True:
+            event = await self._events.get()
+            if event is None:
+                # Closed: leave the marker for any other consumer
+                self._events.put_nowait(None)
+                return
+            yield event
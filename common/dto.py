@@ -1,20 +1,6 @@
-from dataclasses import dataclass, field
-from typing import Any, Optional
-from sqlalchemy.ext.asyncio import AsyncSession
-import asyncio
+from dataclasses import dataclass
+from typing import Any
 
-# Forward declaration to avoid circular imports
-class User:
-    pass
-
-@dataclass
-class Request:
-    """Encapsulates all context for a single request."""
-    user: Optional[User]
-    payload: dict
-    db_session: AsyncSession
-    writer: asyncio.StreamWriter
-    writer_info: dict = field(default_factory=dict)
 
 @dataclass
 class Response:
@@ -23,3 +9,12 @@ class Response:
     message: str
     response_type: str = 'normalmsg'
     data: Any = None
+
+
+def __getattr__(name):
+    # Request carries server-only state (DB session, writer) and now lives in server.dto.
+    # It is resolved lazily so importing common.dto never pulls in the server stack.
+    if name == 'Request':
+        from server.dto import Request
+        return Request
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
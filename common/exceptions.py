@@ -17,3 +17,19 @@ class UserNotFoundError(ChatException):
 class GroupNotFoundError(ChatException):
     """Raised when a group is not found."""
     pass
+
+class RequestFailedError(ChatException):
+    """Raised by the client SDK when the server rejects a request."""
+    def __init__(self, message: str, response: dict = None):
+        super().__init__(message)
+        self.response = response
+
+class ServerBusyError(RequestFailedError):
+    """Raised when a request was throttled or shed; retry after `retry_after` seconds."""
+    def __init__(self, message: str, retry_after: float, response: dict = None):
+        super().__init__(message, response)
+        self.retry_after = retry_after
+
+class ConnectionLostError(ChatException):
+    """Raised for requests in flight when the connection to the server drops."""
+    pass
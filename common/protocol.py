@@ -1,9 +1,6 @@
 import struct
-import io
 import json
-import datetime
 import time
-from operator import index
 
 MAGIC_HEADER = b'\xab\xcd\xef\x88'
 # 定义进制的头 MAGIC +PAYLOADLEN+CHECKSUM+PAYLOAD
@@ -28,7 +25,7 @@ class protocol():
         return message_header+payload_bytes
 
     @staticmethod
-    def deserialize_stream(io_stream:io.BytesIO,buffer=b''):
+    def deserialize_stream(io_stream,buffer=b''):
 
         # 这里反序列化的核心逻辑。
         # 这里有大坑,当socket通过makeifle("rb")转换为bufferreader后，使用read(N)如果获取不到预期的时候会阻塞。使用read1会达到socket.recv一样的方法。
@@ -110,11 +107,53 @@ class protocol():
             'message':message
         })
     @staticmethod
-    def create_client_user_send_message(fromusername,message):
-        return protocol.serialize_message('usersend', payload={
+    def create_throttled(command, retry_after, req_id=None):
+        """
+            请求被限流时返回给客户端的信息，retry_after 为建议的重试等待秒数
+        """
+        payload = {
+            'command': command,
+            'retry_after': round(retry_after, 3),
+            'message': f"Too many '{command}' requests, retry in {retry_after:.2f}s.",
+            'ok': False
+        }
+        if req_id is not None:
+            payload['req_id'] = req_id
+        return protocol.serialize_message('throttled', payload=payload)
+
+    @staticmethod
+    def create_shed(retry_after, message, req_id=None):
+        """
+            服务器过载时拒绝新连接/登录的信息，客户端应至少等待 retry_after 秒后重试
+        """
+        payload = {
+            'retry_after': round(retry_after, 3),
+            'message': message,
+            'ok': False
+        }
+        if req_id is not None:
+            payload['req_id'] = req_id
+        return protocol.serialize_message('shed', payload=payload)
+
+    @staticmethod
+    def create_client_user_send_message(fromusername,message,seq=None):
+        """
+            seq 为接收者的投递序号，客户端收到后用 ack 累计确认
+        """
+        payload = {
             "fromusername":fromusername,
             'message': message
-        })
+        }
+        if seq is not None:
+            payload['seq'] = seq
+        return protocol.serialize_message('usersend', payload=payload)
+
+    @staticmethod
+    def create_ack(seq):
+        """
+            累计确认：seq 及之前的所有消息都已收到（按连接上已登录的用户处理，无需 auth_token）
+        """
+        return protocol.serialize_message('ack', payload={'seq': seq})
 
     @staticmethod
     def create_user_broadcast_message(fromusername, message):
@@ -137,12 +176,13 @@ class protocol():
         # 显示格式的为 username:msgcontent(datetime) 如：[系统通知]:欢迎新用户xxx(10:44）
         payload_content =  payload['payload']
         if msg_type =='sysmsg':
-            return_msg = f'[系统消息]:{payload_content['message']}'
+            return_msg = f'[系统消息]:{payload_content["message"]}'
         elif msg_type == 'usersend':
             return_msg = f'{payload_content["fromusername"]}悄悄对你说:{payload_content["message"]}'
         elif msg_type == 'userbroadcast':
             return_msg =  f'{payload_content["fromusername"]}:{payload_content["message"]}'
         if return_msg:
+            import datetime  # 只在显示时需要，避免拖慢客户端启动
             send_time =  datetime.datetime.fromtimestamp(payload['timestamp'])
             return_msg += f"({send_time.strftime('%H:%M')})"
         else:
@@ -0,0 +1,76 @@
+import os
+import ssl
+import subprocess
+from typing import Optional
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Client context that resumes the previous TLS session on reconnect (abbreviated handshake, no
+    certificate exchange or key agreement signatures). asyncio creates the SSLObject of each connection
+    through wrap_bio() without a session argument, so the session is injected here: the context keeps
+    the SSLObject of its last connection and offers that connection's session ticket to the next one.
+    Meant for a client that talks to a single server.
+    """
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        return super().__new__(cls, protocol)
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self._session = None
+        self._last_object = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if not server_side and session is None:
+            session = self.resumable_session()
+        ssl_object = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session=session)
+        if not server_side:
+            self._last_object = ssl_object
+        return ssl_object
+
+    def resumable_session(self) -> Optional[ssl.SSLSession]:
+        """The newest session with a ticket. TLS 1.3 tickets arrive after the handshake, so it is read lazily."""
+        if self._last_object is not None:
+            latest = self._last_object.session
+            if latest is not None and latest.has_ticket:
+                self._session = latest
+        return self._session
+
+
+def client_context(cafile: str = None, resume: bool = True) -> ssl.SSLContext:
+    """Verifying client context; cafile None trusts the system CAs. resume enables session resumption."""
+    context = ResumingSSLContext() if resume else ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def server_context(certfile: str, keyfile: str = None, num_tickets: int = 2) -> ssl.SSLContext:
+    """Server context issuing num_tickets TLS 1.3 session tickets per full handshake (0 disables resumption)."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = num_tickets
+    if num_tickets == 0:
+        context.options |= ssl.OP_NO_TICKET
+    return context
+
+
+def generate_self_signed_cert(directory: str, hostname: str = 'localhost', key: str = 'rsa:2048') -> tuple[str, str]:
+    """
+    Writes a self-signed certificate for hostname (and 127.0.0.1) with the openssl CLI, for local
+    development, tests and benchmarks. key is 'rsa:<bits>' or 'ec' (P-256). Returns (certfile, keyfile).
+    """
+    certfile, keyfile = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    if key == 'ec':
+        key_args = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1']
+    else:
+        key_args = ['-newkey', key]
+    subprocess.run(
+        ['openssl', 'req', '-x509', *key_args, '-nodes', '-keyout', keyfile, '-out', certfile, '-days', '30',
+         '-subj', f'/CN={hostname}', '-addext', f'subjectAltName=DNS:{hostname},IP:127.0.0.1'],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
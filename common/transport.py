@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import socket
+
+
+def install_event_loop(use_uvloop: bool = True) -> bool:
+    """
+    Installs uvloop as the event loop policy when requested and available.
+    Must be called before asyncio.run(). Returns True if uvloop is active.
+    """
+    if not use_uvloop:
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        logging.info("uvloop is not installed, using the default asyncio event loop.")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logging.info("uvloop event loop policy installed.")
+    return True
+
+
+def tune_socket(sock: socket.socket, nodelay: bool = True, sndbuf: int = None, rcvbuf: int = None):
+    """
+    Applies TCP_NODELAY and kernel buffer sizes to a socket. None leaves the OS/asyncio default.
+    Options that do not apply to the socket family (e.g. TCP_NODELAY on AF_UNIX) are skipped.
+    """
+    if sock is None:
+        return
+    try:
+        if nodelay is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError as e:
+        logging.warning(f"Failed to tune socket {sock}: {e}")
+
+
+async def open_connection(host: str, port: int, path: str = None, ssl=None, server_hostname: str = None):
+    """
+    asyncio.open_connection to host:port, or to the Unix domain socket at path when one is given.
+    Unix sockets only reach the same host, so TLS is not used on them.
+    """
+    if path:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port, ssl=ssl, server_hostname=server_hostname if ssl else None)
+
+
+def tune_writer(writer: asyncio.StreamWriter, nodelay: bool = True, sndbuf: int = None, rcvbuf: int = None,
+                write_high: int = None, write_low: int = None):
+    """
+    Tunes an established connection: socket options plus the transport write-buffer watermarks.
+    drain() only blocks once the transport buffer exceeds the high watermark.
+    """
+    tune_socket(writer.get_extra_info('socket'), nodelay, sndbuf, rcvbuf)
+    if write_high is not None:
+        writer.transport.set_write_buffer_limits(high=write_high, low=write_low)
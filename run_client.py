@@ -1,6 +1,8 @@
 import asyncio
 import logging
 from client.client import ChatClient
+from client import config
+from common.transport import install_event_loop
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 async def main():
@@ -8,6 +10,7 @@ async def main():
     await client.start()
 
 if __name__ == '__main__':
+    install_event_loop(config.USE_UVLOOP)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
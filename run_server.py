@@ -1,20 +1,22 @@
 import asyncio
 import logging
-from server.db.session import create_db_and_tables, close_engine
 from server.server import  ChatServer
+from server import config
+from common.transport import install_event_loop
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 async def main():
     port = 18888
-    await create_db_and_tables()
     server = ChatServer(port=port)
+    await server.backend.create()
     try:
         await server.start()
     finally:
-        await close_engine()
+        await server.backend.close()
 
 
 if __name__ == '__main__':
+    install_event_loop(config.USE_UVLOOP)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from collections import Counter
+
+
+class AdmissionController:
+    """
+    Decides whether the server accepts new work.
+    New connections are capped by max_connections, logins/registrations (PBKDF2) by max_inflight_logins,
+    and both are shed while the event loop lags or too many requests are in flight.
+    Rejections carry a retry-after hint in seconds.
+    """
+    def __init__(
+        self,
+        max_connections: int,
+        max_inflight_logins: int,
+        max_loop_lag: float,
+        max_queue_depth: int,
+        retry_after: float,
+        lag_interval: float = 0.1,
+    ):
+        self.max_connections = max_connections
+        self.max_inflight_logins = max_inflight_logins
+        self.max_loop_lag = max_loop_lag
+        self.max_queue_depth = max_queue_depth
+        self.retry_after = retry_after
+        self.lag_interval = lag_interval
+
+        self.connections = 0
+        self.inflight_logins = 0
+        # Requests currently being handled (the dispatch queue depth)
+        self.inflight_requests = 0
+        self.loop_lag = 0.0
+        # reason -> number of rejected connections/logins
+        self.shed = Counter()
+        self._lag_task = None
+
+    def start(self):
+        """Starts the event-loop lag sampler. Must be called from the running loop."""
+        if self._lag_task is None:
+            self._lag_task = asyncio.create_task(self._sample_lag())
+
+    def stop(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    async def _sample_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - scheduled - self.lag_interval)
+            # Smooth out single spikes, but react quickly to sustained lag
+            self.loop_lag = lag if lag > self.loop_lag else self.loop_lag * 0.7 + lag * 0.3
+
+    def overloaded(self) -> str | None:
+        """Returns the reason new work should be shed, or None."""
+        if self.loop_lag > self.max_loop_lag:
+            return 'loop_lag'
+        if self.inflight_requests > self.max_queue_depth:
+            return 'queue_depth'
+        return None
+
+    def _hint(self) -> float:
+        # Back clients off harder the further we are past the lag threshold
+        if self.max_loop_lag and self.loop_lag > self.max_loop_lag:
+            return self.retry_after * min(4.0, self.loop_lag / self.max_loop_lag)
+        return self.retry_after
+
+    def admit_connection(self) -> float:
+        """Returns 0 and counts the connection if admitted, otherwise a retry-after hint."""
+        reason = 'max_connections' if self.connections >= self.max_connections else self.overloaded()
+        if reason:
+            self.shed['connection:' + reason] += 1
+            logging.warning(f"Shedding new connection ({reason}), {self.connections} open.")
+            return self._hint()
+        self.connections += 1
+        return 0.0
+
+    def release_connection(self):
+        self.connections -= 1
+
+    def admit_login(self) -> float:
+        """Returns 0 and takes a login slot if admitted, otherwise a retry-after hint."""
+        reason = 'max_inflight_logins' if self.inflight_logins >= self.max_inflight_logins else self.overloaded()
+        if reason:
+            self.shed['login:' + reason] += 1
+            return self._hint()
+        self.inflight_logins += 1
+        return 0.0
+
+    def release_login(self):
+        self.inflight_logins -= 1
+
+    def stats(self) -> dict:
+        return {
+            'connections': self.connections,
+            'inflight_logins': self.inflight_logins,
+            'inflight_requests': self.inflight_requests,
+            'loop_lag_ms': round(self.loop_lag * 1000, 2),
+            'shed': dict(self.shed),
+        }
@@ -1,7 +1,7 @@
 import hashlib
 import secrets
 from sqlalchemy.future import select
-from server.models import User
+from server.models import User, UserSession
 
 def hash_password(password: str, salt: str = None) -> (str, str):
     """Hashes a password with a salt. If no salt is provided, a new one is generated."""
@@ -22,6 +22,13 @@ def hash_password(password: str, salt: str = None) -> (str, str):
     # Return the salt and the hex representation of the hash
     return salt, password_hash.hex()
 
+def hash_passwords(passwords: list[str]) -> list[str]:
+    """
+    Hashes a batch of passwords into the stored 'salt:hash' form.
+    pbkdf2_hmac releases the GIL, so bulk imports run batches of this in a thread pool in parallel.
+    """
+    return [':'.join(hash_password(password)) for password in passwords]
+
 def verify_password(stored_password_hash: str, salt: str, provided_password: str) -> bool:
     """Verifies a provided password against a stored hash and salt."""
     # Hash the provided password with the stored salt
@@ -38,5 +45,6 @@ async def get_user_by_token(session, token: str) -> User | None:
     """Retrieves a user from the database based on their authentication token."""
     if not token:
         return None
-    result = await session.execute(select(User).where(User.auth_token == token))
+    result = await session.execute(
+        select(User).join(UserSession, UserSession.user_id == User.id).where(UserSession.token == token))
     return result.scalars().first()
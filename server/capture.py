@@ -0,0 +1,151 @@
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import os
+import struct
+import time
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+# File header: magic and the capture start time (epoch seconds), shared by all rotated files of a capture
+FILE_MAGIC = b'P2SPCAP1'
+FILE_HEADER = struct.Struct('<8sd')
+# Record header: kind, connection id, offset from capture start (s), server handling time (s), body length
+RECORD_HEADER = struct.Struct('<BIdfI')
+
+OPEN, FRAME, CLOSE = 0, 1, 2
+
+REDACTED = '<redacted>'
+# Payload fields replaced by REDACTED when redaction is on
+REDACTED_FIELDS = {
+    'login': ('password',),
+    'reg': ('password',),
+    'import_users': ('data',),
+}
+
+
+class CaptureRecord(NamedTuple):
+    kind: int
+    conn_id: int
+    offset: float
+    duration: float
+    message: Optional[dict]
+
+
+def pseudonymize_token(message: dict, key: bytes) -> dict:
+    """
+    Returns message with its auth token replaced by a keyed hash (copying only when needed). The same
+    token always maps to the same pseudonym under one key, which is all tools/replay.py needs to remap it.
+    """
+    payload = message.get('payload')
+    token = payload.get('auth_token') if isinstance(payload, dict) else None
+    if not isinstance(token, str) or not token:
+        return message
+    pseudonym = 'tok-' + hmac.new(key, token.encode('utf8'), hashlib.sha256).hexdigest()[:32]
+    return {**message, 'payload': {**payload, 'auth_token': pseudonym}}
+
+
+def redact(message: dict) -> dict:
+    """Returns message with the password fields of its payload replaced (copying only when needed)."""
+    fields = REDACTED_FIELDS.get(message.get('type'))
+    payload = message.get('payload')
+    if not fields or not isinstance(payload, dict) or not any(f in payload for f in fields):
+        return message
+    payload = dict(payload)
+    for field in fields:
+        if field in payload:
+            payload[field] = REDACTED
+    return {**message, 'payload': payload}
+
+
+class TrafficCapture:
+    """
+    Appends decoded inbound frames to a compact binary log for later replay (tools/replay.py).
+    Each record carries the connection id, the offset from the start of the capture and the time the
+    server spent handling the frame; connection open/close are recorded too. Files rotate at max_bytes,
+    keeping the newest max_files. Writes are buffered: the tail of the log is lost if the process dies.
+    Auth tokens are live credentials and are never written: each is replaced by an HMAC under a key
+    that exists only in memory for the lifetime of the capture.
+    """
+    def __init__(self, directory: str, max_bytes: int, max_files: int, redact_passwords: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.redact_passwords = redact_passwords
+        self.started = time.time()
+        self._clock_start = time.perf_counter()
+        self._prefix = time.strftime('capture-%Y%m%d-%H%M%S', time.localtime(self.started))
+        self._index = 0
+        self._file = None
+        self._size = 0
+        self.records = 0
+        self._token_key = os.urandom(32)
+        os.makedirs(directory, exist_ok=True)
+        self._rotate()
+
+    def now(self) -> float:
+        """Offset of the current moment from the start of the capture, for record offsets."""
+        return time.perf_counter() - self._clock_start
+
+    def opened(self, conn_id: int, offset: float):
+        self._write(OPEN, conn_id, offset, 0.0, b'')
+
+    def closed(self, conn_id: int):
+        self._write(CLOSE, conn_id, self.now(), 0.0, b'')
+
+    def encode(self, message: dict) -> bytes:
+        """The record body of an inbound frame, taken as received: before handling can change the payload."""
+        message = pseudonymize_token(message, self._token_key)
+        if self.redact_passwords:
+            message = redact(message)
+        return json.dumps(message, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+
+    def frame(self, conn_id: int, offset: float, duration: float, body: bytes):
+        self._write(FRAME, conn_id, offset, duration, body)
+
+    def _write(self, kind: int, conn_id: int, offset: float, duration: float, body: bytes):
+        if self._file is None:
+            return
+        self._file.write(RECORD_HEADER.pack(kind, conn_id, offset, duration, len(body)))
+        self._file.write(body)
+        self._size += RECORD_HEADER.size + len(body)
+        self.records += 1
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self._index += 1
+        path = os.path.join(self.directory, f"{self._prefix}-{self._index:04d}.bin")
+        self._file = open(path, 'wb', buffering=64 * 1024)
+        self._file.write(FILE_HEADER.pack(FILE_MAGIC, self.started))
+        self._size = FILE_HEADER.size
+        old = sorted(glob.glob(os.path.join(self.directory, f"{self._prefix}-*.bin")))
+        for stale in old[:-self.max_files]:
+            os.remove(stale)
+        logging.info(f"Capturing traffic to {path}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(paths: Iterable[str]) -> Iterator[CaptureRecord]:
+    """Yields the records of capture files in the given order. Stops quietly at a truncated tail."""
+    for path in paths:
+        with open(path, 'rb') as f:
+            magic, _ = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+            if magic != FILE_MAGIC:
+                raise ValueError(f"{path} is not a traffic capture file.")
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                kind, conn_id, offset, duration, length = RECORD_HEADER.unpack(header)
+                body = f.read(length)
+                if len(body) < length:
+                    break
+                yield CaptureRecord(kind, conn_id, offset, duration, json.loads(body) if body else None)
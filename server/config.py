@@ -12,3 +12,154 @@ DATABASE_FILE = os.path.join(BASE_DIR, DB_NAME)
 # SQLAlchemy database URL for SQLite
 # The `sqlite+aiosqlite:///` prefix indicates the use of the aiosqlite driver for async operations
 SQLALCHEMY_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_FILE}"
+
+# --- Storage backend ---
+# 'sqlalchemy': the SQLite database above. 'memory': dicts in the server process, lost on restart; for
+# benchmarks and demo servers (no full-text search or TTL maintenance).
+REPOSITORY_BACKEND = 'sqlalchemy'
+# Usernames that become administrators when they register on the memory backend.
+MEMORY_ADMINS = ()
+
+# --- Offline message store (sqlalchemy backend) ---
+# 'database': the offline_messages table. 'spool': append-only segment files under SPOOL_DIR, one series
+# per shard of users, with an in-memory index; expired by the maintenance task like the table.
+OFFLINE_STORE = 'database'
+SPOOL_DIR = os.path.join(BASE_DIR, 'spool')
+SPOOL_SHARDS = 16
+# A segment is closed for appends at this size and deleted once all its messages are delivered; closed
+# segments that are mostly delivered get their remaining messages rewritten into a new segment.
+SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024
+# fsync after every write: durable across power loss, at the cost of a disk flush per offline message.
+SPOOL_FSYNC = False
+
+# --- Event loop & transport tuning ---
+# Use uvloop when it is installed (pip install uvloop); falls back to the stock asyncio loop.
+USE_UVLOOP = True
+# Disable Nagle's algorithm so small chat frames are sent immediately.
+TCP_NODELAY = True
+# Kernel socket buffer sizes in bytes (None keeps the OS default).
+SOCKET_SNDBUF = None
+SOCKET_RCVBUF = None
+# Transport write-buffer watermarks: drain() blocks above HIGH and resumes below LOW.
+WRITE_BUFFER_HIGH = 256 * 1024
+WRITE_BUFFER_LOW = 64 * 1024
+# Frames moved from each priority queue (CONTROL, INTERACTIVE, BULK) per scheduling round once a
+# connection's transport is backed up; see server/managers/connection.py.
+OUTBOUND_WEIGHTS = (16, 4, 1)
+# Listen backlog passed to asyncio.start_server.
+LISTEN_BACKLOG = 1024
+
+# --- Unix domain sockets ---
+# Extra listeners for bots and gateways on the same host, e.g. ('/run/p2sp/chat.sock',). They share the
+# handler, connection manager and admission limits with the TCP listener; TLS does not apply to them.
+UNIX_SOCKET_PATHS = ()
+# File mode of the socket files: who on this host may connect.
+UNIX_SOCKET_MODE = 0o660
+
+# --- TLS ---
+# PEM certificate chain and private key; None serves plaintext TCP.
+TLS_CERTFILE = None
+TLS_KEYFILE = None
+# TLS 1.3 session tickets issued per full handshake, so reconnecting clients can resume; 0 disables resumption.
+TLS_NUM_TICKETS = 2
+# Seconds a client may take to complete the handshake.
+TLS_HANDSHAKE_TIMEOUT = 10.0
+
+# --- Rate limiting ---
+# Per-command token-bucket limits are declared in ServerMessageHandler.command_map.
+RATE_LIMIT_ENABLED = True
+# Upper bound on tracked buckets (LRU); bounds limiter memory regardless of user count.
+RATE_LIMIT_MAX_BUCKETS = 100_000
+
+# --- Admission control / load shedding ---
+MAX_CONNECTIONS = 10_000
+# Concurrent login/reg requests (each runs PBKDF2 on the event loop).
+MAX_INFLIGHT_LOGINS = 32
+# Shed new connections and logins while event-loop lag (seconds) or in-flight requests exceed these.
+SHED_LOOP_LAG = 0.2
+SHED_QUEUE_DEPTH = 1_000
+# Base retry-after hint (seconds) sent to shed clients; grows with the measured lag.
+SHED_RETRY_AFTER = 2.0
+
+# --- Metrics ---
+# Plain-text (Prometheus format) scrape endpoint; None disables it. Bind to a local address only.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+
+# --- On-demand sampling profiler (admin 'profile <seconds>' command) ---
+PROFILE_OUTPUT_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+
+# --- Event-loop watchdog ---
+# A helper thread pings the loop every WATCHDOG_INTERVAL seconds and records the lag into a histogram.
+# A ping unanswered for WATCHDOG_THRESHOLD seconds logs the loop thread's stack (WATCHDOG_STACK_DEPTH
+# innermost frames) and running task, at most once per WATCHDOG_LOG_INTERVAL seconds. None disables it.
+WATCHDOG_THRESHOLD = 0.1
+WATCHDOG_INTERVAL = 0.05
+WATCHDOG_LOG_INTERVAL = 10.0
+WATCHDOG_STACK_DEPTH = 20
+
+# --- Request tracing ---
+# Requests slower than this many seconds are logged with a per-stage and DB breakdown; None disables it.
+SLOW_REQUEST_THRESHOLD = 0.5
+
+# --- Traffic capture (replayed with tools/replay.py) ---
+# Directory for binary capture files of all inbound frames; None disables capturing.
+CAPTURE_DIR = None
+# Rotate to a new file after this many bytes, keeping the newest CAPTURE_MAX_FILES files.
+CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+CAPTURE_MAX_FILES = 10
+# Replace passwords in login/reg (and import_users data) with a placeholder before writing.
+CAPTURE_REDACT_PASSWORDS = True
+
+# --- Replay de-duplication ---
+# Number of recent client msg_ids remembered to drop messages replayed after a reconnect.
+DEDUP_MAX_IDS = 100_000
+
+# --- Message history ---
+# Default and maximum page size of the 'history' command.
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+# Messages older than this many days are removed by the maintenance task; None keeps history forever.
+HISTORY_RETENTION_DAYS = 90
+
+# --- Full-text search ---
+# New messages are added to the FTS5 index by a background task every SEARCH_SYNC_INTERVAL seconds,
+# in batches of up to SEARCH_SYNC_BATCH rows per transaction.
+SEARCH_SYNC_INTERVAL = 1.0
+SEARCH_SYNC_BATCH = 2000
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE = 50
+
+# --- Delivery acknowledgements ---
+# Maximum sequenced messages awaiting a client ack per session; a client that falls this far behind is disconnected
+# and the unacked messages are stored as offline messages.
+UNACKED_WINDOW_MAX = 1000
+
+# --- Multi-device sessions ---
+# Sessions (logged-in connections) one user may hold at once; a login beyond this closes the oldest session
+# after a notice, and the new session takes over its unacked messages. 1 allows a single device.
+MAX_SESSIONS_PER_USER = 5
+
+# --- Bulk user import ---
+# Users are created in chunks of IMPORT_CHUNK_SIZE (one transaction and one progress report each);
+# password hashing runs on IMPORT_HASH_WORKERS threads.
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_HASH_WORKERS = os.cpu_count() or 1
+IMPORT_MAX_USERS = 200_000
+
+# --- Background maintenance ---
+# Every MAINTENANCE_INTERVAL seconds, rows past their TTL (days; None disables) are deleted in batches of
+# MAINTENANCE_BATCH rows, one short transaction each, sleeping MAINTENANCE_PAUSE seconds between batches
+# so the SQLite write lock is never held for long.
+MAINTENANCE_INTERVAL = 3600
+MAINTENANCE_BATCH = 500
+MAINTENANCE_PAUSE = 0.05
+OFFLINE_MESSAGE_TTL_DAYS = 30
+LOGIN_LOG_TTL_DAYS = 90
+# Roll expired login logs into per-day, per-user counts (user_login_daily) instead of just deleting them.
+LOGIN_LOG_AGGREGATE = True
+# Free pages returned to the OS per incremental vacuum step; 0 disables. Needs auto_vacuum=INCREMENTAL,
+# which is set when the database file is created.
+MAINTENANCE_VACUUM_PAGES = 1000
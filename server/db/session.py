@@ -1,18 +1,46 @@
+import time
 from contextlib import asynccontextmanager
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from ..config import SQLALCHEMY_DATABASE_URL
 from ..models import Base
+from ..metrics import registry
+from ..tracing import record_query, span
+from ..repository.search_repository import FTS_DDL
 
-# Create an asynchronous engine
-engine = create_async_engine(SQLALCHEMY_DATABASE_URL, echo=False)
+# Query timing: hooks run on the sync engine underneath the async facade
+_db_queries = registry.counter('db_queries_total')
+_db_query_seconds = registry.histogram('db_query_seconds')
 
-# Create a session factory for creating async sessions
-AsyncSessionFactory = sessionmaker(
-    bind=engine,
-    class_=AsyncSession,
-    expire_on_commit=False,
-)
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    _db_queries.value += 1
+    _db_query_seconds.record(elapsed)
+    record_query(elapsed)
+
+def configure_engine(url: str = SQLALCHEMY_DATABASE_URL):
+    """
+    (Re)creates the engine and session factory for the given database URL.
+    Called once at import with the configured URL; tests and benchmarks call it to use a scratch database.
+    """
+    global engine, AsyncSessionFactory
+    # Create an asynchronous engine
+    engine = create_async_engine(url, echo=False)
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+    # Create a session factory for creating async sessions
+    AsyncSessionFactory = sessionmaker(
+        bind=engine,
+        class_=AsyncSession,
+        expire_on_commit=False,
+    )
+
+configure_engine()
 
 @asynccontextmanager
 async def get_session() -> AsyncSession:
@@ -20,21 +48,65 @@ async def get_session() -> AsyncSession:
     async with AsyncSessionFactory() as session:
         try:
             yield session
-            await session.commit()
+            with span('commit'):
+                await session.commit()
         except Exception:
             await session.rollback()
             raise
 
+# Columns and indexes added to tables that already existed before; create_all only creates missing tables
+_MIGRATIONS = (
+    ('users', 'last_seq', "ALTER TABLE users ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0"),
+    ('offline_messages', 'seq', "ALTER TABLE offline_messages ADD COLUMN seq INTEGER"),
+)
+_MIGRATION_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_offline_messages_timestamp ON offline_messages (timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_user_login_log_login_time ON user_login_log (login_time)",
+)
+
+async def _migrate(conn):
+    """Idempotently brings a database created by an older version up to the current models."""
+    for table, column, statement in _MIGRATIONS:
+        columns = {row[1] for row in (await conn.exec_driver_sql(f"PRAGMA table_info({table})")).fetchall()}
+        if column not in columns:
+            await conn.exec_driver_sql(statement)
+    for statement in _MIGRATION_INDEXES:
+        await conn.exec_driver_sql(statement)
+
 async def create_db_and_tables():
     """
     Asynchronously creates all database tables defined in the models.
     This function should be called once when the application starts.
     """
     async with engine.begin() as conn:
+        # Lets the maintenance task return freed pages to the OS; only takes effect on a new database file
+        await conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
         # Drop all tables first (for development purposes)
         # In production, you would use migrations (e.g., with Alembic)
         # await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
+        await _migrate(conn)
+        # The full-text index is an FTS5 virtual table, outside of the ORM metadata
+        for statement in FTS_DDL:
+            await conn.exec_driver_sql(statement)
+
+async def incremental_vacuum(pages: int) -> int:
+    """Returns up to `pages` free pages to the OS. Returns the number of pages freed."""
+    async with engine.connect() as conn:
+        before = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        raw = await conn.get_raw_connection()
+        # Each step of this pragma frees one page and the DBAPI cursor steps only once; executescript runs it to completion
+        await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+    return before - after
+
+async def database_stats() -> dict:
+    """Page-level size information of the database file."""
+    async with engine.connect() as conn:
+        stats = {}
+        for pragma in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'):
+            stats[pragma] = (await conn.exec_driver_sql(f"PRAGMA {pragma}")).scalar()
+    return stats
 
 async def close_engine():
     """
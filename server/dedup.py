@@ -0,0 +1,30 @@
+from collections import OrderedDict
+from typing import Hashable
+
+
+class ReplayFilter:
+    """
+    Remembers the most recent client message ids (bounded LRU) so a message that a client
+    replays after reconnecting is processed only once. Ids are keyed by (user id, msg_id): clients
+    only pick ids unique among their own messages. An id is added only once its request has been
+    processed and committed, so a replay of a request that failed is processed again.
+    """
+    def __init__(self, max_ids: int = 100_000):
+        self._seen = OrderedDict()
+        self._max_ids = max_ids
+        self.duplicates = 0
+
+    def contains(self, key: Hashable) -> bool:
+        """Returns True (and counts a duplicate) if key was added before."""
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, key: Hashable):
+        """Records a processed message."""
+        self._seen[key] = None
+        self._seen.move_to_end(key)
+        if len(self._seen) > self._max_ids:
+            self._seen.popitem(last=False)
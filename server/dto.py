@@ -0,0 +1,22 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional
+
+if TYPE_CHECKING:  # 仅用于类型标注，避免在导入时加载 ORM
+    from server.models import User
+    from server.repository.backend import Repositories
+    from server.managers.connection import Connection
+
+
+@dataclass(slots=True)
+class Request:
+    """
+    Encapsulates all context for a single request; repos are the repositories of the request's unit of
+    work and connection carries the peer address and stream. after_commit holds coroutine functions the
+    handler awaits once the unit of work has committed, before it replies.
+    """
+    user: Optional[User]
+    payload: dict
+    repos: Repositories
+    connection: Connection
+    after_commit: List[Callable[[], Awaitable[None]]] = field(default_factory=list)
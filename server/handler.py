@@ -1,15 +1,27 @@
 import logging
-from typing import TYPE_CHECKING
+import time
+from typing import TYPE_CHECKING, Callable, NamedTuple, Optional
 
-from common.dto import Request, Response
+from common.dto import Response
+from server.dto import Request
 from common.protocol import protocol
-from server.db.session import get_session
-from server.repository.user_repository import UserRepository
+from server.repository.backend import RepositoryBackend
 from server.services.user_service import UserService
 from server.services.friend_service import FriendService
 from server.services.message_service import MessageService
+from server.services.search_service import SearchService
+from server.services.maintenance_service import MaintenanceService
 from server.services.admin_service import AdminService
 from server.managers.connection_manager import ConnectionManager
+from server.managers.connection import Connection, Priority
+from server.ratelimit import RateLimit, RateLimiter
+from server.admission import AdmissionController
+from server.dedup import ReplayFilter
+from server.metrics import registry
+from server.tracing import trace_request, span
+
+_frames_out = registry.counter('frames_out_total')
+_bytes_out = registry.counter('bytes_out_total')
 
 
 if TYPE_CHECKING:
@@ -18,105 +30,221 @@ if TYPE_CHECKING:
 class CommandNotFoundError(Exception):
     pass
 
+class DuplicateMessageError(Exception):
+    pass
+
+class ThrottledError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class Command(NamedTuple):
+    """
+    A command_map entry: the service method and its optional token-bucket limits.
+    gated commands take an in-flight login slot and are shed while the server is overloaded.
+    control commands are answered at CONTROL priority, ahead of any queued backlog.
+    """
+    method: Callable
+    rate_limit: Optional[RateLimit] = None
+    gated: bool = False
+    control: bool = False
+
 class ServerMessageHandler:
     def __init__(
         self, 
         server: "ChatServer", 
+        backend: RepositoryBackend,
         user_service: UserService, 
         friend_service: FriendService,
         message_service: MessageService,
+        search_service: Optional[SearchService],
+        maintenance_service: Optional[MaintenanceService],
         admin_service: AdminService,
-        connection_manager: ConnectionManager
+        connection_manager: ConnectionManager,
+        rate_limiter: RateLimiter,
+        admission: AdmissionController,
+        replay_filter: ReplayFilter
     ):
         self.server = server
+        self.backend = backend
         self._user_service = user_service
         self._friend_service = friend_service
         self._message_service = message_service
+        self._search_service = search_service
+        self._maintenance_service = maintenance_service
         self._admin_service = admin_service
         self.connection_manager = connection_manager
-        
-        # Command map routes all message types to the appropriate service methods
+        self.rate_limiter = rate_limiter
+        self.admission = admission
+        self.replay_filter = replay_filter
+
+        # Command map routes all message types to the appropriate service methods.
+        # Rate limits are (tokens per second, burst) token buckets per user and/or per connection.
         self.command_map = {
             # User Service
-            'login': self._user_service.login,
-            'reg': self._user_service.register,
+            'login': Command(self._user_service.login, RateLimit(per_connection=(0.5, 5)), gated=True, control=True),
+            'reg': Command(self._user_service.register, RateLimit(per_connection=(0.2, 3)), gated=True, control=True),
+            'resume': Command(self._user_service.resume, RateLimit(per_connection=(0.5, 5)), control=True),
             # Friend Service
-            'add_friend': self._friend_service.add_friend,
-            'accept_friend': self._friend_service.accept_friend,
-            'myfriends': self._friend_service.list_friends,
+            'add_friend': Command(self._friend_service.add_friend, RateLimit(per_user=(0.5, 10), per_connection=(0.5, 10))),
+            'accept_friend': Command(self._friend_service.accept_friend, RateLimit(per_user=(1, 10))),
+            'myfriends': Command(self._friend_service.list_friends, RateLimit(per_user=(2, 10))),
             # Message Service
-            'send': self._message_service.send_private_message,
+            'send': Command(self._message_service.send_private_message, RateLimit(per_user=(10, 30), per_connection=(10, 30))),
+            'history': Command(self._message_service.history, RateLimit(per_user=(5, 20))),
             # Admin Service
-            'broadcast': self._admin_service.broadcast_message,
-            'ban_user': self._admin_service.ban_user,
-            'permit_user': self._admin_service.permit_user,
+            'broadcast': Command(self._admin_service.broadcast_message),
+            'ban_user': Command(self._admin_service.ban_user),
+            'permit_user': Command(self._admin_service.permit_user),
+            'ban_users': Command(self._admin_service.ban_users),
+            'permit_users': Command(self._admin_service.permit_users),
+            'import_users': Command(self._admin_service.import_users),
+            'ratelimit_stats': Command(self._admin_service.rate_limit_stats),
+            'stats': Command(self._admin_service.stats),
+            'profile': Command(self._admin_service.profile),
         }
+        # Full-text search and TTL maintenance are SQL features, absent on the in-memory backend
+        if self._search_service:
+            self.command_map['search'] = Command(self._search_service.search, RateLimit(per_user=(2, 10)))
+        if self._maintenance_service:
+            self.command_map['maintenance'] = Command(self._maintenance_service.maintenance)
+        # Per-command latency histograms, resolved once so the hot path is a dict lookup
+        self._latency = {name: registry.histogram('handler_latency_seconds', command=name) for name in self.command_map}
+        self._latency_unknown = registry.histogram('handler_latency_seconds', command='unknown')
 
-    async def handle_message(self, writer, message: dict):
+    async def handle_message(self, conn: Connection, message: dict):
         """
         Acts as a central dispatcher for all incoming messages.
-        Orchestrates the request lifecycle: session -> request -> service -> response -> network message.
+        Orchestrates the request lifecycle: rate limit -> admission -> de-duplication -> transaction -> request -> service -> response -> network message.
+        The connection's id and logged-in user are the rate limiting keys.
         """
         msg_type = message.get('type')
         payload = message.get('payload', {})
-        
-        logged_in_user_id = None
 
-        async with get_session() as session:
+        # Acks are frequent, need no reply and only touch the connection's own window: no transaction
+        if msg_type == 'ack':
+            seq = payload.get('seq')
+            if isinstance(seq, int):
+                conn.ack(seq)
+            return
+
+        # 0. Throttle before touching the repositories. Per-user limits are keyed by user id; a connection
+        # that is not logged in draws on a per-user sized bucket of its own here, so its token lookups are
+        # throttled too, and is charged to the user once _dispatch has resolved the token.
+        command = self.command_map.get(msg_type)
+        if command and command.rate_limit:
+            retry_after = self.rate_limiter.check(
+                msg_type, command.rate_limit, user_key=conn.user_id, conn_key=conn.conn_id)
+            if retry_after:
+                await self._send(conn, protocol.create_throttled(msg_type, retry_after, payload.get('req_id')), Priority.CONTROL)
+                return
+
+        if command and command.gated:
+            retry_after = self.admission.admit_login()
+            if retry_after:
+                await self._send(conn, protocol.create_shed(
+                    retry_after, "Server is busy, please retry later.", payload.get('req_id')), Priority.CONTROL)
+                return
+
+        self.admission.inflight_requests += 1
+        start = time.perf_counter()
+        try:
+            with trace_request(msg_type):
+                await self._dispatch(conn, msg_type, payload, command)
+        finally:
+            self._latency.get(msg_type, self._latency_unknown).record(time.perf_counter() - start)
+            self.admission.inflight_requests -= 1
+            if command and command.gated:
+                self.admission.release_login()
+
+    async def _dispatch(self, conn: Connection, msg_type: str, payload: dict, command: Optional[Command]):
+        throttled = 0.0
+        processed = None  # replay filter key, recorded once the transaction has committed
+        request = None
+        async with self.backend.transaction() as repos:
             try:
                 # 1. Find the service method from the command map
-                service_method = self.command_map.get(msg_type)
-                if not service_method:
+                if not command:
                     raise CommandNotFoundError(f"Unknown command: {msg_type}")
+                service_method = command.method
 
                 # 2. Authenticate user for non-auth commands
                 user = None
                 auth_token = payload.get('auth_token')
-                user_repo = UserRepository(session)
-                user = await user_repo.get_by_token(auth_token)
+                with span('auth'):
+                    user = await repos.users.get_by_token(auth_token)
 
                 if msg_type not in ['login', 'reg']:
                     if not user:
                         raise PermissionError("Authentication required.")
                     if user.status == 0:
                         raise PermissionError("User is banned.")
+                    if conn.user_id is None and command.rate_limit:
+                        retry_after = self.rate_limiter.check(msg_type, command.rate_limit, user_key=user.id)
+                        if retry_after:
+                            raise ThrottledError(retry_after)
+
+                # Messages replayed by a client after a reconnect carry the msg_id of the original
+                msg_id = payload.get('msg_id')
+                replay_key = (user.id, msg_id) if user and msg_id is not None else None
+                if replay_key and self.replay_filter.contains(replay_key):
+                    raise DuplicateMessageError()
 
                 # 3. Encapsulate all request data into a single object
                 request = Request(
                     user=user,
                     payload=payload,
-                    writer_info={'peername': writer.get_extra_info('peername')},
-                    db_session=session,
-                    writer=writer
+                    repos=repos,
+                    connection=conn
                 )
 
                 # 4. Call the service method
-                response: Response = await service_method(request)
+                with span('service'):
+                    response: Response = await service_method(request)
 
                 # 5. Process the response object
                 if response.is_success:
                     # Use the response_type from the Response DTO to build the payload
-                    network_message = protocol.create_payload(
-                        response.response_type, 
-                        response.data or {'message': response.message}
-                    )
-                    
-                    if msg_type == 'login':
-                        logged_in_user_id = response.data['user_id']
+                    response_type = response.response_type
+                    response_payload = dict(response.data or {'message': response.message})
                 else:
                     # Generic failure message
-                    network_message = protocol.create_normal_message(response.message)
+                    response_type, response_payload = 'normalmsg', {'message': response.message}
+                response_payload['ok'] = response.is_success
+                if response.is_success:
+                    processed = replay_key
 
+            except ThrottledError as e:
+                throttled = e.retry_after
+            except DuplicateMessageError:
+                response_type, response_payload = 'normalmsg', {
+                    'message': "Duplicate message ignored.", 'ok': True, 'duplicate': True}
             except CommandNotFoundError as e:
-                network_message = protocol.create_normal_message(str(e))
+                response_type, response_payload = 'normalmsg', {'message': str(e), 'ok': False}
             except PermissionError as e:
-                network_message = protocol.create_normal_message(str(e))
+                response_type, response_payload = 'normalmsg', {'message': str(e), 'ok': False}
             except Exception as e:
                 logging.exception(f"An unexpected error occurred while handling '{msg_type}'")
-                network_message = protocol.create_normal_message(f"Server error: An internal error occurred.")
+                response_type, response_payload = 'normalmsg', {'message': "Server error: An internal error occurred.", 'ok': False}
+
+        if processed:
+            self.replay_filter.add(processed)
+        if request is not None:
+            for action in request.after_commit:
+                await action()
+        if throttled:
+            await self._send(conn, protocol.create_throttled(msg_type, throttled, payload.get('req_id')), Priority.CONTROL)
+            return
+
+        # 6. Send the response to the client, echoing the request id so pipelined clients can match it
+        if 'req_id' in payload:
+            response_payload['req_id'] = payload['req_id']
+        with span('write'):
+            priority = Priority.CONTROL if command and command.control else Priority.INTERACTIVE
+            await self._send(conn, protocol.create_payload(response_type, response_payload), priority)
 
-        # 6. Send the response to the client
-        writer.write(network_message)
-        await writer.drain()
-        
-        return logged_in_user_id
\ No newline at end of file
+    @staticmethod
+    async def _send(conn: Connection, network_message: bytes, priority: Priority = Priority.INTERACTIVE):
+        _frames_out.value += 1
+        _bytes_out.value += len(network_message)
+        await conn.send(network_message, priority)
\ No newline at end of file
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Deque, List, Optional, Tuple
+from server import config
+from server.metrics import registry
+
+_bytes_in = registry.counter('bytes_in_total')
+
+
+class Priority(IntEnum):
+    """Outbound priority classes, highest first. Services pick one per frame they send."""
+    CONTROL = 0      # login/resume replies, kick notices, throttling and shedding replies
+    INTERACTIVE = 1  # live messages and other command replies
+    BULK = 2         # offline backlog replay, broadcasts
+
+
+class Connection:
+    """
+    All server-side state of one client connection, kept in __slots__ so an idle connection costs a
+    single small object on top of the transport: the stream pair, the decoder buffer, the logged-in
+    user and per-connection counters.
+
+    The unacked window (for clients that ack deliveries) is created on the first sequenced message and
+    dropped again once everything is acknowledged, so idle connections do not carry an empty deque.
+
+    Outbound frames go straight to the transport while it is below its high watermark. Beyond that they
+    wait in one queue per Priority, and a sender task moves them to the transport as it drains, in
+    weighted rounds (OUTBOUND_WEIGHTS) that always start with CONTROL, so a kick notice or login reply
+    overtakes a queued backlog. Sequenced messages never overtake queued BULK frames, which keeps them
+    in seq order for the client.
+    """
+    __slots__ = ('conn_id', 'reader', 'writer', 'peername', 'user_id', 'auth_token', 'buffer', 'connected_at',
+                 'frames_in', 'bytes_in', 'frames_out', 'bytes_out', 'track_acks', 'unacked',
+                 'queues', 'queued_bytes', 'sender', 'drained')
+
+    def __init__(self, conn_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.conn_id = conn_id
+        self.reader = reader
+        self.writer = writer
+        self.peername = writer.get_extra_info('peername')
+        self.user_id: Optional[int] = None
+        # The session token the connection logged in or resumed with
+        self.auth_token: Optional[str] = None
+        # Decoder state: bytes received but not yet parsed into a frame
+        self.buffer = b''
+        self.connected_at = time.time()
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.track_acks = False
+        # [(seq, frame), ...] in ascending seq order; None while empty
+        self.unacked: Optional[Deque[Tuple[int, bytes]]] = None
+        # One deque of frames per Priority, created when the transport first backs up
+        self.queues: Optional[Tuple[Deque[bytes], ...]] = None
+        self.queued_bytes = 0
+        self.sender: Optional[asyncio.Task] = None
+        # Resolved once queued_bytes falls below WRITE_BUFFER_LOW; senders wait on it for backpressure
+        self.drained: Optional[asyncio.Future] = None
+
+    @property
+    def ip(self) -> str:
+        # Unix domain socket peers have no address (peername is '')
+        if isinstance(self.peername, tuple):
+            return self.peername[0]
+        return 'unix' if self.peername is not None else 'unknown'
+
+    async def read(self, n: int = -1) -> bytes:
+        """StreamReader.read that also counts inbound bytes; the decoder reads through this."""
+        data = await self.reader.read(n)
+        self.bytes_in += len(data)
+        _bytes_in.value += len(data)
+        return data
+
+    def write(self, frame: bytes):
+        self.writer.write(frame)
+        self.frames_out += 1
+        self.bytes_out += len(frame)
+
+    async def send(self, frame: bytes, priority: Priority = Priority.INTERACTIVE, seq: Optional[int] = None):
+        """
+        Sends a frame at the given priority. Waits while too much is queued for this connection, like
+        StreamWriter.drain(). seq marks a sequenced message, which must stay behind queued BULK frames.
+        """
+        if self.enqueue(frame, priority, seq):
+            await self.drain()
+
+    def enqueue(self, frame: bytes, priority: Priority = Priority.INTERACTIVE, seq: Optional[int] = None) -> bool:
+        """send() without the waiting. Returns True if the caller has to await drain() before sending more."""
+        if self.sender is None and self.writer.transport.get_write_buffer_size() < config.WRITE_BUFFER_HIGH:
+            self.write(frame)
+            return True
+        if self.queues is None:
+            self.queues = tuple(deque() for _ in Priority)
+        if seq is not None and self.queues[Priority.BULK]:
+            priority = Priority.BULK
+        self.queues[priority].append(frame)
+        self.queued_bytes += len(frame)
+        if self.sender is None:
+            self.sender = asyncio.create_task(self._send_queued())
+        return self.queued_bytes > config.WRITE_BUFFER_HIGH
+
+    async def drain(self):
+        """Waits until the transport has drained or, while frames are queued, until the queues are below WRITE_BUFFER_HIGH."""
+        if self.sender is None:
+            await self.writer.drain()
+        elif self.queued_bytes > config.WRITE_BUFFER_HIGH:
+            if self.drained is None:
+                self.drained = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self.drained)
+
+    async def _send_queued(self):
+        """Moves queued frames to the transport in weighted rounds, waiting for it to drain between rounds."""
+        queues = self.queues
+        completed = False
+        try:
+            while self.queued_bytes:
+                # Frames already in the transport are out of reach; wait until it has room before picking
+                await self.writer.drain()
+                for priority in Priority:
+                    queue = queues[priority]
+                    for _ in range(config.OUTBOUND_WEIGHTS[priority]):
+                        if not queue:
+                            break
+                        frame = queue.popleft()
+                        self.queued_bytes -= len(frame)
+                        self.write(frame)
+                self._release(config.WRITE_BUFFER_LOW)
+            completed = True
+        except ConnectionError as e:
+            logging.warning(f"Connection {self.conn_id} lost with {self.queued_bytes} bytes queued: {e}")
+        except Exception:
+            logging.exception(f"Sender of connection {self.conn_id} failed with {self.queued_bytes} bytes queued")
+        finally:
+            self.sender = None
+            if not completed:
+                # Nothing will send the rest: drop it and wake every send() waiting for the queue to drain
+                self.discard()
+            if not self.queued_bytes:
+                self.queues = None
+            self._release(config.WRITE_BUFFER_LOW)
+
+    def _release(self, threshold: int):
+        if self.drained is not None and self.queued_bytes <= threshold:
+            if not self.drained.done():
+                self.drained.set_result(None)
+            self.drained = None
+
+    def discard(self):
+        """Drops queued frames and stops the sender; called when the connection closes."""
+        if self.queues is not None:
+            for queue in self.queues:
+                queue.clear()
+        self.queued_bytes = 0
+        if self.sender is not None and self.sender is not asyncio.current_task():
+            self.sender.cancel()
+        self._release(0)
+
+    def push_unacked(self, seq: int, frame: bytes) -> int:
+        """Keeps a sequenced frame until it is acknowledged; returns the window size."""
+        if self.unacked is None:
+            self.unacked = deque()
+        self.unacked.append((seq, frame))
+        return len(self.unacked)
+
+    def ack(self, seq: int):
+        """Cumulative ack: the client has received every sequenced message up to and including seq."""
+        window = self.unacked
+        while window and window[0][0] <= seq:
+            window.popleft()
+        if not window:
+            self.unacked = None
+
+    def take_unacked(self) -> List[Tuple[int, bytes]]:
+        """Removes and returns the unacked (seq, frame) pairs, oldest first."""
+        window, self.unacked = self.unacked, None
+        return list(window or ())
@@ -1,54 +1,206 @@
 import asyncio
 import logging
-from typing import Dict
+import time
+from typing import Dict, Iterator, List, Optional
+from common.protocol import protocol
+from server import config
+from server.managers.connection import Connection, Priority
+from server.metrics import registry
+
+_frames_out = registry.counter('frames_out_total')
+_bytes_out = registry.counter('bytes_out_total')
+_broadcast_seconds = registry.histogram('broadcast_fanout_seconds')
+_window_overflows = registry.counter('unacked_window_overflows_total')
+
+SESSION_LIMIT_NOTICE = protocol.create_sys_notify(
+    "You signed in on another device and have too many sessions. This one is being disconnected.")
 
 class ConnectionManager:
     """
     Manages all active client connections.
     This class is the single source of truth for who is online.
+
+    A user may be logged in from several devices at once (desktop, mobile, bot): each login adds a session
+    and a message for the user goes to all of them. Past max_sessions the oldest sessions are closed.
+
+    For clients that acknowledge deliveries, sequenced messages stay in the session's unacked window
+    until a cumulative ack covers them; whatever is left when a session goes offline is stored
+    as offline messages, giving at-least-once delivery.
     """
-    def __init__(self):
-        # Maps user_id to their StreamWriter object
-        self.online_users: Dict[int, asyncio.StreamWriter] = {}
+    def __init__(self, window_size: int = config.UNACKED_WINDOW_MAX, max_sessions: int = config.MAX_SESSIONS_PER_USER):
+        # Maps user_id to their sessions, oldest first
+        self.online_users: Dict[int, List[Connection]] = {}
+        self.window_size = window_size
+        self.max_sessions = max_sessions
+        registry.gauge_fn('online_users', lambda: len(self.online_users))
+        registry.gauge_fn('online_sessions', lambda: sum(len(s) for s in self.online_users.values()))
+        registry.gauge_fn('outbound_buffer_bytes', self.outbound_buffer_bytes)
+        registry.gauge_fn('unacked_messages', lambda: sum(len(c.unacked or ()) for c in self.connections()))
+        registry.gauge_fn('outbound_queued_bytes', lambda: sum(c.queued_bytes for c in self.connections()))
 
-    def add_user(self, user_id: int, writer: asyncio.StreamWriter):
-        """Adds a user's connection to the manager upon successful login."""
-        self.online_users[user_id] = writer
-        logging.info(f"User {user_id} connected. Total online: {len(self.online_users)}")
+    def connections(self) -> Iterator[Connection]:
+        """All sessions of all online users."""
+        for sessions in self.online_users.values():
+            yield from sessions
+
+    def outbound_buffer_bytes(self) -> int:
+        """Bytes queued in the transports of all online users and not yet sent."""
+        return sum(c.writer.transport.get_write_buffer_size()
+                   for c in self.connections() if not c.writer.is_closing())
+
+    def add_user(self, user_id: int, conn: Connection, track_acks: bool = False) -> List[Connection]:
+        """
+        Adds a session for the user upon successful login; the user's other sessions stay online.
+        track_acks enables the unacked window; clients that never send acks must not enable it.
+        A session with the same auth token is the same device reconnecting: its old connection is closed.
+        If the user now has more than max_sessions sessions, the oldest ones are sent a notice and closed.
+        Returns the closed sessions: their unacked messages are left for the caller to take over.
+        """
+        if conn.user_id is not None and conn.user_id != user_id:
+            # The connection logs in as someone else: it no longer represents the previous user
+            self.remove_user(conn.user_id, conn)
+        conn.user_id = user_id
+        conn.track_acks = track_acks
+        sessions = self.online_users.setdefault(user_id, [])
+        replaced = [old for old in sessions
+                    if old is not conn and conn.auth_token and old.auth_token == conn.auth_token]
+        for old in replaced:
+            sessions.remove(old)
+            old.discard()
+            old.writer.close()
+        if conn not in sessions:
+            sessions.append(conn)
+        evicted = sessions[:max(0, len(sessions) - self.max_sessions)]
+        if evicted:
+            del sessions[:len(evicted)]
+            for old in evicted:
+                self._close(old, SESSION_LIMIT_NOTICE)
+            logging.info(f"User {user_id} is over {self.max_sessions} sessions: closed {len(evicted)} oldest.")
+        evicted = replaced + evicted
+        logging.info(f"User {user_id} connected ({len(sessions)} sessions). Total online: {len(self.online_users)}")
+        return evicted
 
-    def remove_user(self, user_id: int):
-        """Removes a user's connection when they disconnect."""
-        if user_id in self.online_users:
-            del self.online_users[user_id]
-            logging.info(f"User {user_id} disconnected. Total online: {len(self.online_users)}")
+    def remove_user(self, user_id: int, conn: Optional[Connection] = None):
+        """
+        Removes a user's sessions when they disconnect.
+        If conn is given, only that session is removed: the user's other sessions are kept.
+        """
+        sessions = self.online_users.get(user_id)
+        if not sessions or (conn is not None and conn not in sessions):
+            return
+        if conn is not None and len(sessions) > 1:
+            sessions.remove(conn)
+            logging.info(f"User {user_id} closed a session ({len(sessions)} left).")
+            return
+        del self.online_users[user_id]
+        logging.info(f"User {user_id} disconnected. Total online: {len(self.online_users)}")
+
+    def _close(self, conn: Connection, message: bytes):
+        """
+        Sends a final notice and closes the session without waiting on it: close() still flushes the notice.
+        The notice bypasses the priority queues, whose frames are dropped.
+        """
+        conn.discard()
+        conn.write(message)
+        conn.writer.close()
+        _frames_out.value += 1
+        _bytes_out.value += len(message)
+
+    def kick_users(self, user_ids, message: bytes) -> int:
+        """
+        Sends a final notice to every session of the listed online users and closes them.
+        Returns the number of users kicked.
+        """
+        kicked = 0
+        for user_id in user_ids:
+            sessions = self.online_users.pop(user_id, None)
+            if sessions is None:
+                continue
+            for conn in sessions:
+                self._close(conn, message)
+            kicked += 1
+        if kicked:
+            logging.info(f"Kicked {kicked} users. Total online: {len(self.online_users)}")
+        return kicked
 
     def is_online(self, user_id: int) -> bool:
-        """Checks if a user is currently online."""
+        """Checks if a user is currently online on any device."""
         return user_id in self.online_users
 
-    async def send_to_user(self, user_id: int, message: bytes):
+    async def send_to_user(self, user_id: int, message: bytes, seq: Optional[int] = None,
+                           priority: Priority = Priority.INTERACTIVE) -> bool:
         """
-        Sends a message to a specific user.
-        Handles connection errors gracefully by removing the dead connection.
+        Sends an already serialized message to every session of a user at the given priority.
+        Returns False if the user is not online, so the caller stores it as an offline message.
+        Messages with a seq are kept in each acking session's unacked window until acknowledged.
+        Handles connection errors gracefully by removing the dead session.
         """
-        writer = self.online_users.get(user_id)
-        if writer:
-            try:
-                writer.write(message)
-                await writer.drain()
-            except (ConnectionResetError, BrokenPipeError) as e:
-                logging.warning(f"Connection error for user {user_id}: {e}. Removing connection.")
-                self.remove_user(user_id)
-        else:
+        sessions = self.online_users.get(user_id)
+        if not sessions:
             # This is not an error, the user is just offline.
             # The service layer will handle saving offline messages.
-            pass
+            return False
+        if len(sessions) == 1:
+            await self.send_to_connection(sessions[0], message, seq, priority)
+        else:
+            # One after the other, in the same order for every message: a send only waits while a session
+            # is backed up, and a concurrent message cannot overtake this one on the sessions after it
+            for conn in tuple(sessions):
+                await self.send_to_connection(conn, message, seq, priority)
+        return True
+
+    def enqueue_to_user(self, user_id: int, message: bytes, seq: Optional[int] = None,
+                        priority: Priority = Priority.INTERACTIVE) -> Optional[List[Connection]]:
+        """
+        send_to_user() without waiting for backpressure, for callers inside a transaction: the message is
+        handed to every session at once. Returns the sessions to drain() once the transaction has
+        committed, or None if the user is not online.
+        """
+        sessions = self.online_users.get(user_id)
+        if not sessions:
+            return None
+        return [conn for conn in tuple(sessions) if self._enqueue(conn, message, seq, priority)]
+
+    async def drain(self, sessions: List[Connection]):
+        """Waits for the sessions returned by enqueue_to_user() to take more frames."""
+        for conn in sessions:
+            await self._drain(conn)
+
+    async def send_to_connection(self, conn: Connection, message: bytes, seq: Optional[int] = None,
+                                 priority: Priority = Priority.INTERACTIVE):
+        """
+        Sends a message to a single session of a logged-in user, e.g. the backlog replayed to a new session.
+        """
+        if self._enqueue(conn, message, seq, priority):
+            await self._drain(conn)
+
+    def _enqueue(self, conn: Connection, message: bytes, seq: Optional[int], priority: Priority) -> bool:
+        if seq is not None and conn.track_acks:
+            if conn.push_unacked(seq, message) > self.window_size:
+                # The client stopped acking: drop the session; the window is persisted on disconnect
+                _window_overflows.value += 1
+                logging.warning(f"Unacked window of user {conn.user_id} on connection {conn.conn_id} is full. "
+                                f"Closing connection.")
+                conn.writer.close()
+                return False
+        _frames_out.value += 1
+        _bytes_out.value += len(message)
+        return conn.enqueue(message, priority, seq)
+
+    async def _drain(self, conn: Connection):
+        try:
+            await conn.drain()
+        except (ConnectionResetError, BrokenPipeError) as e:
+            logging.warning(f"Connection error for user {conn.user_id}: {e}. Removing connection.")
+            self.remove_user(conn.user_id, conn)
 
-    async def broadcast(self, message: bytes):
-        """Broadcasts a message to all currently connected users."""
+    async def broadcast(self, message: bytes, priority: Priority = Priority.BULK):
+        """Broadcasts a message to all currently connected users, behind their interactive traffic by default."""
         if not self.online_users:
             return
         
+        start = time.perf_counter()
         # Create a list of tasks to send messages concurrently
-        tasks = [self.send_to_user(user_id, message) for user_id in self.online_users.keys()]
+        tasks = [self.send_to_user(user_id, message, priority=priority) for user_id in self.online_users.keys()]
         await asyncio.gather(*tasks, return_exceptions=True) # Use return_exceptions to prevent one failure from stopping all
+        _broadcast_seconds.record(time.perf_counter() - start)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, Tuple
+
+# Histogram resolution: values are recorded in integer microseconds into log-linear buckets,
+# 2**SUB_BITS sub-buckets per power of two (about 6% relative error), HDR-histogram style.
+SUB_BITS = 4
+SUB_COUNT = 1 << SUB_BITS
+_LINEAR_LIMIT = SUB_COUNT * 2
+_MAX_BUCKETS = SUB_COUNT * 40  # covers up to ~2**39 us (6 days)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram:
+    """Log-linear latency histogram. record() takes seconds and costs a few integer operations."""
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * _MAX_BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        us = int(seconds * 1_000_000)
+        if us < _LINEAR_LIMIT:
+            self.counts[us] += 1
+        else:
+            shift = us.bit_length() - SUB_BITS - 1
+            try:
+                self.counts[(shift << SUB_BITS) + (us >> shift)] += 1
+            except IndexError:
+                self.counts[-1] += 1
+
+    @staticmethod
+    def _bucket_upper(index: int) -> float:
+        """Upper bound of a bucket, in seconds."""
+        if index < _LINEAR_LIMIT:
+            return (index + 1) / 1_000_000
+        shift = index // SUB_COUNT - 1
+        return (((index % SUB_COUNT) + SUB_COUNT + 1) << shift) / 1_000_000
+
+    def percentile(self, p: float) -> float:
+        """Returns the value (seconds) at percentile p (0-100), as the upper bound of its bucket."""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self._bucket_upper(index)
+        return self.max
+
+    @property
+    def max(self) -> float:
+        for index in range(_MAX_BUCKETS - 1, -1, -1):
+            if self.counts[index]:
+                return self._bucket_upper(index)
+        return 0.0
+
+    def reset(self):
+        self.counts = [0] * _MAX_BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+
+# A sample is (metric name, labels, value); collectors yield them at scrape time.
+Sample = Tuple[str, Dict[str, str], float]
+
+QUANTILES = (50, 90, 99, 99.9)
+
+
+class MetricsRegistry:
+    """
+    In-process registry of counters, gauges and histograms.
+    Metric objects are created once (get-or-create by name + labels); callers keep a reference
+    and record on it directly, so the hot path is a plain attribute update.
+    Values that are cheaper to read on demand (online users, buffer sizes) are registered as
+    gauge callbacks or collectors and evaluated only when the registry is rendered.
+    """
+    def __init__(self):
+        self._metrics: Dict[tuple, object] = {}
+        self._gauge_fns: Dict[tuple, Callable[[], float]] = {}
+        self._collectors: Dict[str, Callable[[], Iterable[Sample]]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def _get(self, cls, name: str, labels: dict):
+        key = self._key(name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = cls()
+        return metric
+
+    def counter(self, name: str, **labels) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels) -> Gauge:
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self._get(Histogram, name, labels)
+
+    def gauge_fn(self, name: str, fn: Callable[[], float], **labels):
+        """Registers a gauge whose value is computed by fn() at render time."""
+        self._gauge_fns[self._key(name, labels)] = fn
+
+    def add_collector(self, name: str, fn: Callable[[], Iterable[Sample]]):
+        """
+        Registers a callable yielding (name, labels, value) samples at render time. A collector registered
+        under the same name is replaced, so a second server in the process does not duplicate its series.
+        """
+        self._collectors[name] = fn
+
+    def remove_collector(self, name: str, fn: Callable[[], Iterable[Sample]]):
+        """Unregisters the collector, unless another one has replaced it under that name since."""
+        if self._collectors.get(name) is fn:
+            del self._collectors[name]
+
+    def samples(self) -> Iterable[Sample]:
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            labels = dict(labels)
+            if isinstance(metric, Histogram):
+                yield f"{name}_count", labels, metric.count
+                yield f"{name}_sum", labels, metric.total
+                yield f"{name}_max", labels, metric.max
+                for q in QUANTILES:
+                    yield name, {**labels, 'quantile': f"{q / 100:g}"}, metric.percentile(q)
+            else:
+                yield name, labels, metric.value
+        for (name, labels), fn in sorted(self._gauge_fns.items(), key=lambda item: item[0]):
+            try:
+                yield name, dict(labels), fn()
+            except Exception as e:
+                logging.warning(f"Gauge callback {name} failed: {e}")
+        for name, collector in list(self._collectors.items()):
+            try:
+                yield from collector()
+            except Exception as e:
+                logging.warning(f"Metrics collector {name} failed: {e}")
+
+    def render_text(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, labels, value in self.samples():
+            if labels:
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value:g}")
+            else:
+                lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry shared by the server, the DB hooks and the admin 'stats' command
+registry = MetricsRegistry()
+
+
+async def start_metrics_server(metrics: MetricsRegistry, host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Serves the registry as plain text on host:port for scrapers (e.g. Prometheus, curl).
+    Any request gets the current metrics; the endpoint is meant to be bound to a local address.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Read (and ignore) the request head; don't wait forever on idle connections
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            body = metrics.render_text().encode('utf8')
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Metrics endpoint on {server.sockets[0].getsockname()}")
+    return server
@@ -6,6 +6,7 @@ from sqlalchemy import (
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
     UniqueConstraint,
 )
 from sqlalchemy.ext.declarative import declarative_base
@@ -22,9 +23,20 @@ class User(Base):
     password_hash = Column(String, nullable=False)
     status = Column(Integer, nullable=False, default=1)  # 1: normal, 0: disabled
     is_admin = Column(Boolean, nullable=False, default=False)
-    auth_token = Column(String, nullable=True, index=True)
+    # Last delivery sequence number allocated to messages for this user (see UserRepository.next_seq)
+    last_seq = Column(Integer, nullable=False, default=0, server_default='0')
     create_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
 
+class UserSession(Base):
+    """One auth token per login, so every device of a user keeps working (see UserRepository.create_session)."""
+    __tablename__ = 'user_sessions'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    token = Column(String, nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    create_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    user = relationship("User")
+
 class Group(Base):
     __tablename__ = 'groups'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -65,17 +77,46 @@ class OfflineMessage(Base):
     __tablename__ = 'offline_messages'
     id = Column(Integer, primary_key=True, autoincrement=True)
     recipient_user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # Recipient's delivery sequence number of this message; NULL for rows written before sequencing
+    seq = Column(Integer, nullable=True)
     message_payload = Column(String, nullable=False)
-    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
 
     recipient = relationship("User")
 
+class ChatMessage(Base):
+    """
+    Private message history. A conversation is identified by its two user ids in ascending order;
+    ids are AUTOINCREMENT so they are never reused and double as the keyset pagination cursor.
+    """
+    __tablename__ = 'chat_messages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_low_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_high_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    sender_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    message = Column(String, nullable=False)
+    create_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # One page of a conversation is a single range scan: (low, high) equality + id < cursor, descending
+        Index('ix_chat_messages_conversation', 'user_low_id', 'user_high_id', 'id'),
+        Index('ix_chat_messages_create_time', 'create_time'),
+        {'sqlite_autoincrement': True},
+    )
+
 class UserLoginLog(Base):
     __tablename__ = 'user_login_log'
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     username = Column(String, nullable=False)
-    login_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    login_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
     login_ip = Column(String, nullable=True)
 
     user = relationship("User")
+
+class UserLoginDaily(Base):
+    """Per-day login counts that expired user_login_log rows are rolled up into by the maintenance task."""
+    __tablename__ = 'user_login_daily'
+    day = Column(String, primary_key=True)  # 'YYYY-MM-DD' (UTC)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    logins = Column(Integer, nullable=False, default=0)
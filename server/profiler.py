@@ -0,0 +1,99 @@
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profiling session is requested while another one is running."""
+    pass
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler for a live server.
+    A daemon thread samples the target thread's Python stack every `interval` seconds via
+    sys._current_frames() and writes the result in collapsed-stack format
+    ("frame;frame;frame count" per line), ready for flamegraph.pl or speedscope.
+    The event loop is never paused; only one session may run at a time.
+    """
+    def __init__(self, output_dir: str, interval: float = 0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._sessions = itertools.count(1)
+        self.current_path: Optional[str] = None
+
+    @property
+    def active(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, thread_id: int = None, on_done: Callable[[str, int], None] = None) -> str:
+        """
+        Starts sampling thread_id (default: the calling thread) for `seconds`.
+        Returns the output path; on_done(path, samples) is called from the profiler thread when finished.
+        """
+        with self._lock:
+            if self.active:
+                raise ProfilerBusyError(f"A profiling session is already running ({self.current_path}).")
+            os.makedirs(self.output_dir, exist_ok=True)
+            # Milliseconds, pid and a session counter: back-to-back sessions, or two servers sharing the
+            # directory, never overwrite each other's output
+            now = time.time()
+            name = f"profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}" \
+                   f"-{os.getpid()}-{next(self._sessions)}.collapsed"
+            path = os.path.join(self.output_dir, name)
+            target = thread_id if thread_id is not None else threading.get_ident()
+            self.current_path = path
+            self._thread = threading.Thread(
+                target=self._run, args=(target, seconds, path, on_done),
+                name='sampling-profiler', daemon=True,
+            )
+            self._thread.start()
+            return path
+
+    def _run(self, thread_id: int, seconds: float, path: str, on_done):
+        stacks = Counter()
+        code_names = {}
+        deadline = time.monotonic() + seconds
+        samples = 0
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stacks[self._collapse(frame, code_names)] += 1
+            samples += 1
+            del frame
+            time.sleep(self.interval)
+
+        try:
+            with open(path, 'w', encoding='utf8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            logging.info(f"Profile written to {path} ({samples} samples).")
+        except OSError as e:
+            logging.error(f"Failed to write profile {path}: {e}")
+        if on_done:
+            try:
+                on_done(path, samples)
+            except Exception:
+                logging.exception("Profiler completion callback failed")
+
+    @staticmethod
+    def _collapse(frame, code_names: dict) -> str:
+        """Builds 'outer;...;inner' for a frame chain, caching the label of each code object."""
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            label = code_names.get(code)
+            if label is None:
+                label = code_names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            parts.append(label)
+            frame = frame.f_back
+        parts.reverse()
+        return ';'.join(parts)
@@ -0,0 +1,88 @@
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """
+    Token-bucket limits for one command.
+    rate is tokens refilled per second, burst is the bucket size. A scope set to None is not limited.
+    """
+    per_user: Optional[tuple] = None        # (rate, burst), keyed by user; by connection until it is logged in
+    per_connection: Optional[tuple] = None  # (rate, burst), keyed by connection
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> float:
+        """Adds the tokens earned since the last call. Returns 0 if one is available, otherwise the seconds until it is."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / rate
+
+
+class RateLimiter:
+    """
+    Keeps token buckets per (scope, key, command) in a bounded LRU map.
+    Every check is O(1); when max_buckets is reached the least recently used bucket is dropped,
+    which at worst hands that key a fresh (full) bucket. Buckets of closed connections are not
+    removed eagerly, they simply age out of the LRU.
+    """
+    def __init__(self, max_buckets: int = 100_000, clock=time.monotonic):
+        self.enabled = True
+        self._buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self._max_buckets = max_buckets
+        self._clock = clock
+        # (scope, command) -> number of throttled requests
+        self.throttled = Counter()
+
+    def check(self, command: str, limit: RateLimit, user_key: Hashable = None, conn_key: Hashable = None) -> float:
+        """
+        Returns 0 if the request may proceed, otherwise a retry-after hint in seconds.
+        A token is taken from every bucket that applies, or from none when one of them is empty. Without a
+        user_key the per-user limit applies to the connection, so requests are throttled before their
+        auth token is looked up.
+        """
+        if not self.enabled or limit is None:
+            return 0.0
+        now = self._clock()
+        buckets = []
+        if limit.per_connection and conn_key is not None:
+            buckets.append(('conn', self._bucket(('conn', conn_key, command), limit.per_connection, now), limit.per_connection))
+        if limit.per_user and user_key is not None:
+            buckets.append(('user', self._bucket(('user', user_key, command), limit.per_user, now), limit.per_user))
+        elif limit.per_user and conn_key is not None:
+            buckets.append(('anon', self._bucket(('anon', conn_key, command), limit.per_user, now), limit.per_user))
+        for scope, bucket, (rate, burst) in buckets:
+            wait = bucket.refill(rate, burst, now)
+            if wait:
+                self.throttled[scope, command] += 1
+                return wait
+        for _, bucket, _ in buckets:
+            bucket.tokens -= 1
+        return 0.0
+
+    def _bucket(self, key: tuple, spec: tuple, now: float) -> TokenBucket:
+        burst = spec[1]
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(burst, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self._max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def stats(self) -> dict:
+        return {
+            'buckets': len(self._buckets),
+            'throttled': {f"{scope}:{command}": count for (scope, command), count in self.throttled.items()},
+        }
@@ -0,0 +1,104 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from sqlalchemy.ext.asyncio import AsyncSession
+from server.repository.user_repository import UserRepository
+from server.repository.friend_repository import FriendRepository
+from server.repository.offline_message_repository import OfflineMessageRepository
+from server.repository.history_repository import HistoryRepository
+from server.repository.spool import OfflineSpool, SpoolOfflineMessageRepository
+
+
+class Repositories:
+    """
+    The repositories of one unit of work, as handed to services in Request.repos.
+    Every backend provides users, friends, offline and history with the same methods and return shapes;
+    entities are returned for reading: every change goes through a repository method, so backends can
+    serialize writers (see MemoryBackend).
+    """
+    users: UserRepository
+    friends: FriendRepository
+    offline: OfflineMessageRepository
+    history: HistoryRepository
+
+
+class RepositoryBackend:
+    """
+    Storage backend interface injected into the services by ChatServer.
+    transaction() opens a unit of work: committed when the block exits normally, rolled back (where the
+    backend supports it) when it raises.
+    """
+    name = ''
+    # Whether SQL-only features (full-text search, TTL maintenance) can run on this backend
+    sql = False
+
+    def transaction(self) -> AsyncIterator[Repositories]:
+        raise NotImplementedError
+
+    async def create(self):
+        """Prepares the storage (tables, indexes) before the server starts."""
+
+    async def close(self):
+        """Releases the storage when the server shuts down."""
+
+
+class SqlRepositories(Repositories):
+    """Repositories sharing one AsyncSession; session is exposed for SQL-only repositories."""
+    def __init__(self, session: AsyncSession, spool: OfflineSpool = None):
+        self.session = session
+        self.users = UserRepository(session)
+        self.friends = FriendRepository(session)
+        self.offline = SpoolOfflineMessageRepository(spool, session) if spool else OfflineMessageRepository(session)
+        self.history = HistoryRepository(session)
+
+
+class SqlAlchemyBackend(RepositoryBackend):
+    """
+    The SQLAlchemy/SQLite backend, using the engine configured in server.db.session. With a spool,
+    offline messages live in the spool's segment files instead of the offline_messages table; they are
+    written inside the database transaction, right before it commits.
+    """
+    name = 'sqlalchemy'
+    sql = True
+
+    def __init__(self, spool: OfflineSpool = None):
+        self.spool = spool
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[SqlRepositories]:
+        # Looked up at call time: tests and benchmarks re-point the engine with configure_engine()
+        from server.db.session import get_session
+        repos = None
+        try:
+            async with get_session() as session:
+                repos = SqlRepositories(session, self.spool)
+                yield repos
+                if self.spool is not None:
+                    repos.offline.commit()
+        except BaseException:
+            if self.spool is not None and repos is not None:
+                repos.offline.rollback()
+            raise
+
+    async def create(self):
+        from server.db.session import create_db_and_tables
+        await create_db_and_tables()
+
+    async def close(self):
+        from server.db.session import close_engine
+        await close_engine()
+        if self.spool is not None:
+            self.spool.close()
+
+
+def create_backend(name: str) -> RepositoryBackend:
+    """Builds the backend selected by config.REPOSITORY_BACKEND, with the configured OFFLINE_STORE."""
+    from server import config
+    if name == 'sqlalchemy':
+        spool = None
+        if config.OFFLINE_STORE == 'spool':
+            spool = OfflineSpool(config.SPOOL_DIR, config.SPOOL_SHARDS, config.SPOOL_SEGMENT_BYTES, config.SPOOL_FSYNC)
+        return SqlAlchemyBackend(spool)
+    if name == 'memory':
+        from server.repository.memory import MemoryBackend
+        return MemoryBackend(config.MEMORY_ADMINS)
+    raise ValueError(f"Unknown repository backend '{name}', use 'sqlalchemy' or 'memory'.")
@@ -32,6 +32,10 @@ class FriendRepository:
         )
         self._session.add(new_request)
 
+    async def accept_request(self, relation: UserFriend):
+        """将好友请求标记为已接受。"""
+        relation.status = 1
+
     async def list_friends(self, user_id: int) -> list[User]:
         """列出指定用户的所有已确认的好友。"""
         # 查询所有 user_id_a 或 user_id_b 是该用户，且状态为1（已接受）的关系
@@ -0,0 +1,41 @@
+import datetime
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import delete
+from server.models import ChatMessage
+
+
+def conversation_key(user_a: int, user_b: int) -> tuple[int, int]:
+    """Both participants see the same conversation, so it is keyed by the ordered pair of ids."""
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+
+class HistoryRepository:
+    """Handles data access for the ChatMessage (message history) model."""
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def save(self, sender_id: int, recipient_id: int, message: str):
+        """Appends a message to the conversation between sender and recipient."""
+        low, high = conversation_key(sender_id, recipient_id)
+        self._session.add(ChatMessage(user_low_id=low, user_high_id=high, sender_id=sender_id, message=message))
+
+    async def get_page(self, user_a: int, user_b: int, before_id: Optional[int], limit: int) -> list[ChatMessage]:
+        """
+        Returns up to `limit` messages of the conversation with id < before_id, newest first.
+        Keyset pagination: the cost of a page does not depend on how deep into the history it is.
+        """
+        low, high = conversation_key(user_a, user_b)
+        query = select(ChatMessage).where(ChatMessage.user_low_id == low, ChatMessage.user_high_id == high)
+        if before_id is not None:
+            query = query.where(ChatMessage.id < before_id)
+        result = await self._session.execute(query.order_by(ChatMessage.id.desc()).limit(limit))
+        return result.scalars().all()
+
+    async def delete_older_than(self, cutoff: datetime.datetime, batch: int) -> int:
+        """Deletes at most `batch` messages created before cutoff, oldest first. Returns the number deleted."""
+        oldest = (select(ChatMessage.id).where(ChatMessage.create_time < cutoff)
+                  .order_by(ChatMessage.create_time).limit(batch))
+        result = await self._session.execute(delete(ChatMessage).where(ChatMessage.id.in_(oldest)))
+        return result.rowcount
@@ -0,0 +1,38 @@
+import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import DateTime, bindparam, text
+
+# Bound through the DateTime type so the cutoff is formatted exactly like the stored column values
+_cutoff = bindparam('cutoff', type_=DateTime)
+
+
+class MaintenanceRepository:
+    """Batched deletes of rows past their TTL. Each call touches at most `batch` rows, oldest first."""
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def expire_offline_messages(self, cutoff: datetime.datetime, batch: int) -> int:
+        result = await self._session.execute(text(
+            "DELETE FROM offline_messages WHERE id IN ("
+            "SELECT id FROM offline_messages WHERE timestamp < :cutoff ORDER BY timestamp LIMIT :batch)"
+        ).bindparams(_cutoff), {'cutoff': cutoff, 'batch': batch})
+        return result.rowcount
+
+    async def expire_login_logs(self, cutoff: datetime.datetime, batch: int, aggregate: bool) -> int:
+        """Deletes expired login log rows, first adding them to the per-day counts if aggregate is set."""
+        ids = (await self._session.execute(text(
+            "SELECT id FROM user_login_log WHERE login_time < :cutoff ORDER BY login_time LIMIT :batch"
+        ).bindparams(_cutoff), {'cutoff': cutoff, 'batch': batch})).scalars().all()
+        if not ids:
+            return 0
+        params = {f"id{i}": value for i, value in enumerate(ids)}
+        id_list = ', '.join(f":{name}" for name in params)
+        if aggregate:
+            await self._session.execute(text(
+                "INSERT INTO user_login_daily (day, user_id, logins) "
+                f"SELECT date(login_time), user_id, count(*) FROM user_login_log WHERE id IN ({id_list}) "
+                "GROUP BY date(login_time), user_id "
+                "ON CONFLICT (day, user_id) DO UPDATE SET logins = logins + excluded.logins"
+            ), params)
+        result = await self._session.execute(text(f"DELETE FROM user_login_log WHERE id IN ({id_list})"), params)
+        return result.rowcount
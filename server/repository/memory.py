@@ -0,0 +1,260 @@
+import asyncio
+import datetime
+import itertools
+from bisect import bisect_left
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from operator import attrgetter
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from server.repository.backend import Repositories, RepositoryBackend
+from server.repository.history_repository import conversation_key
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+# Records carry the same attribute names as the ORM models, so services work with either backend
+@dataclass(slots=True, eq=False)
+class UserRecord:
+    id: int
+    username: str
+    password_hash: str
+    status: int = 1
+    is_admin: bool = False
+    last_seq: int = 0
+    create_time: datetime.datetime = field(default_factory=_now)
+
+
+@dataclass(slots=True, eq=False)
+class FriendRecord:
+    id: int
+    user_id_a: int
+    user_id_b: int
+    requester_id: int
+    status: int = 0
+    create_time: datetime.datetime = field(default_factory=_now)
+
+
+@dataclass(slots=True, eq=False)
+class OfflineRecord:
+    id: int
+    recipient_user_id: int
+    seq: Optional[int]
+    message_payload: str
+    timestamp: datetime.datetime = field(default_factory=_now)
+
+
+@dataclass(slots=True, eq=False)
+class HistoryRecord:
+    id: int
+    user_low_id: int
+    user_high_id: int
+    sender_id: int
+    message: str
+    create_time: datetime.datetime = field(default_factory=_now)
+
+
+class MemoryBackend(RepositoryBackend):
+    """
+    Dict-and-index storage that lives and dies with the process: for benchmarks of the network and
+    dispatch layers and for ephemeral demo servers. Every lookup the services make is a dict access
+    (users by id/name/token, relations by user pair, offline messages by recipient, history by
+    conversation), so data access costs microseconds.
+
+    Like SQLite, writers are serialized: a unit of work takes the backend's write lock on its first
+    write and holds it until it ends. Login and resume write before reading the offline messages, so a
+    concurrent send allocates its seq only after the backlog has been handed over, as with SQLite.
+    There is no rollback: changes made before an exception stay.
+    """
+    name = 'memory'
+    # Keeps the most recent logins only; the SQL backend's user_login_log has its own TTL
+    LOGIN_LOG_SIZE = 10_000
+
+    def __init__(self, admins=()):
+        # Usernames that are administrators as soon as they register (there is no database to edit)
+        self.admins = set(admins)
+        self.write_lock = asyncio.Lock()
+        self.ids = {kind: itertools.count(1) for kind in ('user', 'friend', 'offline', 'history')}
+        self.users: Dict[int, UserRecord] = {}
+        self.users_by_name: Dict[str, UserRecord] = {}
+        # Session tokens: token -> user, and each user's tokens oldest first
+        self.users_by_token: Dict[str, UserRecord] = {}
+        self.tokens_by_user: Dict[int, deque] = {}
+        self.relations: Dict[Tuple[int, int], FriendRecord] = {}
+        self.relations_by_user: Dict[int, Set[Tuple[int, int]]] = {}
+        self.offline: Dict[int, List[OfflineRecord]] = {}
+        self.offline_by_id: Dict[int, OfflineRecord] = {}
+        self.history: Dict[Tuple[int, int], List[HistoryRecord]] = {}
+        self.login_log: deque = deque(maxlen=self.LOGIN_LOG_SIZE)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator['MemoryRepositories']:
+        repos = MemoryRepositories(self)
+        try:
+            yield repos
+        finally:
+            if repos.locked:
+                self.write_lock.release()
+
+
+class MemoryRepositories(Repositories):
+    """One unit of work on a MemoryBackend."""
+    def __init__(self, backend: MemoryBackend):
+        self.backend = backend
+        self.locked = False
+        self.users = MemoryUserRepository(self)
+        self.friends = MemoryFriendRepository(self)
+        self.offline = MemoryOfflineMessageRepository(self)
+        self.history = MemoryHistoryRepository(self)
+
+    async def write(self) -> MemoryBackend:
+        """Takes the write lock for the rest of the unit of work; repository methods call it before any change."""
+        if not self.locked:
+            await self.backend.write_lock.acquire()
+            self.locked = True
+        return self.backend
+
+
+class _MemoryRepository:
+    def __init__(self, unit: MemoryRepositories):
+        self._unit = unit
+        self._db = unit.backend
+
+
+class MemoryUserRepository(_MemoryRepository):
+    async def get_by_username(self, username: str) -> UserRecord | None:
+        return self._db.users_by_name.get(username)
+
+    async def get_by_token(self, token: str) -> UserRecord | None:
+        if not token:
+            return None
+        return self._db.users_by_token.get(token)
+
+    async def create(self, username: str, password_hash: str) -> UserRecord:
+        db = await self._unit.write()
+        user = UserRecord(next(db.ids['user']), username, password_hash, is_admin=username in db.admins)
+        db.users[user.id] = db.users_by_name[username] = user
+        return user
+
+    async def create_session(self, user: UserRecord, token: str, keep: int):
+        db = await self._unit.write()
+        tokens = db.tokens_by_user.setdefault(user.id, deque())
+        while len(tokens) >= keep:
+            db.users_by_token.pop(tokens.popleft(), None)
+        tokens.append(token)
+        db.users_by_token[token] = user
+
+    async def delete_session(self, token: str):
+        db = await self._unit.write()
+        user = db.users_by_token.pop(token, None)
+        if user is not None:
+            db.tokens_by_user[user.id].remove(token)
+
+    async def set_status(self, user: UserRecord, status: int):
+        await self._unit.write()
+        user.status = status
+
+    async def add_login_log(self, user: UserRecord, ip: str):
+        db = await self._unit.write()
+        db.login_log.append((user.id, user.username, _now(), ip))
+
+    async def next_seq(self, user_id: int) -> int:
+        await self._unit.write()
+        user = self._db.users[user_id]
+        user.last_seq += 1
+        return user.last_seq
+
+    async def existing_usernames(self, usernames: list[str]) -> set[str]:
+        return {name for name in usernames if name in self._db.users_by_name}
+
+    async def add_many(self, users: list[tuple[str, str]]) -> int:
+        created = 0
+        for username, password_hash in users:
+            if username not in self._db.users_by_name:
+                await self.create(username, password_hash)
+                created += 1
+        return created
+
+    async def set_status_many(self, usernames: list[str], status: int) -> list[tuple[int, str]]:
+        await self._unit.write()
+        updated = []
+        for name in usernames:
+            user = self._db.users_by_name.get(name)
+            if user is not None and not user.is_admin:
+                user.status = status
+                updated.append((user.id, user.username))
+        return updated
+
+
+class MemoryFriendRepository(_MemoryRepository):
+    async def get_friend_relationship(self, user_id_1: int, user_id_2: int) -> FriendRecord | None:
+        return self._db.relations.get(conversation_key(user_id_1, user_id_2))
+
+    async def add_friend_request(self, requester_id: int, target_id: int):
+        db = await self._unit.write()
+        key = conversation_key(requester_id, target_id)
+        db.relations[key] = FriendRecord(next(db.ids['friend']), requester_id, target_id, requester_id)
+        for user_id in key:
+            db.relations_by_user.setdefault(user_id, set()).add(key)
+
+    async def accept_request(self, relation: FriendRecord):
+        await self._unit.write()
+        relation.status = 1
+
+    async def list_friends(self, user_id: int) -> list[UserRecord]:
+        db = self._db
+        friends = []
+        for key in db.relations_by_user.get(user_id, ()):
+            if db.relations[key].status == 1:
+                friends.append(db.users[key[1] if key[0] == user_id else key[0]])
+        return friends
+
+
+class MemoryOfflineMessageRepository(_MemoryRepository):
+    async def get_for_user(self, user_id: int) -> list[OfflineRecord]:
+        return sorted(self._db.offline.get(user_id, ()), key=lambda m: (m.seq is not None, m.seq or 0, m.id))
+
+    async def save(self, recipient_id: int, payload: str, seq: int | None = None):
+        db = await self._unit.write()
+        message = OfflineRecord(next(db.ids['offline']), recipient_id, seq, payload)
+        db.offline.setdefault(recipient_id, []).append(message)
+        db.offline_by_id[message.id] = message
+
+    async def save_many(self, recipient_id: int, messages: list[tuple[int, str]]):
+        for seq, payload in messages:
+            await self.save(recipient_id, payload, seq)
+
+    async def delete(self, message: OfflineRecord):
+        await self.delete_many([message.id])
+
+    async def delete_many(self, message_ids: list[int]):
+        if not message_ids:
+            return
+        db = await self._unit.write()
+        recipients = set()
+        for message_id in message_ids:
+            message = db.offline_by_id.pop(message_id, None)
+            if message is not None:
+                recipients.add(message.recipient_user_id)
+        for user_id in recipients:
+            remaining = [m for m in db.offline[user_id] if m.id in db.offline_by_id]
+            if remaining:
+                db.offline[user_id] = remaining
+            else:
+                del db.offline[user_id]
+
+
+class MemoryHistoryRepository(_MemoryRepository):
+    async def save(self, sender_id: int, recipient_id: int, message: str):
+        db = await self._unit.write()
+        low, high = conversation_key(sender_id, recipient_id)
+        # ids only grow, so every conversation list stays sorted by id
+        db.history.setdefault((low, high), []).append(
+            HistoryRecord(next(db.ids['history']), low, high, sender_id, message))
+
+    async def get_page(self, user_a: int, user_b: int, before_id: Optional[int], limit: int) -> list[HistoryRecord]:
+        messages = self._db.history.get(conversation_key(user_a, user_b), [])
+        end = len(messages) if before_id is None else bisect_left(messages, before_id, key=attrgetter('id'))
+        return messages[max(0, end - limit):end][::-1]
@@ -9,20 +9,35 @@ class OfflineMessageRepository:
         self._session = session
 
     async def get_for_user(self, user_id: int) -> list[OfflineMessage]:
-        """Retrieves all offline messages for a given user."""
+        """Retrieves all offline messages for a given user, in delivery sequence order."""
         result = await self._session.execute(
-            select(OfflineMessage).where(OfflineMessage.recipient_user_id == user_id).order_by(OfflineMessage.timestamp)
+            select(OfflineMessage).where(OfflineMessage.recipient_user_id == user_id)
+            .order_by(OfflineMessage.seq, OfflineMessage.id)
         )
         return result.scalars().all()
 
-    async def save(self, recipient_id: int, payload: str):
-        """Saves a new offline message."""
+    async def save(self, recipient_id: int, payload: str, seq: int | None = None):
+        """Saves a new offline message with the recipient's delivery sequence number."""
         new_message = OfflineMessage(
             recipient_user_id=recipient_id,
+            seq=seq,
             message_payload=payload
         )
         self._session.add(new_message)
 
+    async def save_many(self, recipient_id: int, messages: list[tuple[int, str]]):
+        """Saves several (seq, payload) offline messages, e.g. the unacked window of a disconnected user."""
+        self._session.add_all(
+            OfflineMessage(recipient_user_id=recipient_id, seq=seq, message_payload=payload)
+            for seq, payload in messages
+        )
+
     async def delete(self, message: OfflineMessage):
         """Deletes an offline message."""
         await self._session.delete(message)
+
+    async def delete_many(self, message_ids: list[int]):
+        """Deletes several offline messages with a single statement."""
+        if not message_ids:
+            return
+        await self._session.execute(delete(OfflineMessage).where(OfflineMessage.id.in_(message_ids)))
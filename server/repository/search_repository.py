@@ -0,0 +1,80 @@
+import re
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
+
+# FTS5 index over chat_messages. `members` holds one token per participant ("u12 u34") so restricting a
+# search to the caller's conversations is part of the index lookup instead of a filter over every hit.
+# Inserts are synced in batches by sync_batch(); deletes (retention purge) propagate through the trigger.
+FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5("
+    "message, members, tokenize = 'unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN "
+    "DELETE FROM chat_messages_fts WHERE rowid = old.id; END",
+)
+
+# Highest message id already indexed; message ids are monotonic, so everything above it is pending
+INDEXED_UPTO_SQL = "SELECT rowid FROM chat_messages_fts ORDER BY rowid DESC LIMIT 1"
+
+PENDING_SQL = (
+    "SELECT id, message, user_low_id, user_high_id FROM chat_messages "
+    "WHERE id > :after ORDER BY id LIMIT :limit"
+)
+
+INSERT_SQL = "INSERT INTO chat_messages_fts (rowid, message, members) VALUES (:id, :message, :members)"
+
+SEARCH_SQL = (
+    "SELECT m.id, m.message, m.create_time, s.username AS sender, p.username AS peer "
+    "FROM chat_messages_fts "
+    "JOIN chat_messages m ON m.id = chat_messages_fts.rowid "
+    "JOIN users s ON s.id = m.sender_id "
+    "JOIN users p ON p.id = CASE WHEN m.user_low_id = :user_id THEN m.user_high_id ELSE m.user_low_id END "
+    "WHERE chat_messages_fts MATCH :query "
+    "ORDER BY chat_messages_fts.rank LIMIT :limit OFFSET :offset"
+)
+
+# unicode61 keeps a run of CJK characters as one token; index them one character per token and
+# search them as phrases so that '你好' matches inside '你好世界'.
+_CJK = re.compile(r'([぀-ヿ㐀-䶿一-鿿豈-﫿가-힯])')
+
+
+def segment(message: str) -> str:
+    return _CJK.sub(r' \1 ', message)
+
+
+def build_query(terms: str, user_id: int) -> str | None:
+    """Turns user input into an FTS5 query: every whitespace-separated term must match, as a phrase."""
+    phrases = []
+    for term in terms.split():
+        term = segment(term).strip()
+        if term:
+            phrases.append('"' + term.replace('"', '""') + '"')
+    if not phrases:
+        return None
+    return f"message : ({' '.join(phrases)}) AND members : u{user_id}"
+
+
+def index_row(message_id: int, message: str, user_low_id: int, user_high_id: int) -> dict:
+    return {'id': message_id, 'message': segment(message), 'members': f"u{user_low_id} u{user_high_id}"}
+
+
+class SearchRepository:
+    """Handles the full-text index over message history."""
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def sync_batch(self, limit: int) -> int:
+        """Indexes up to `limit` not yet indexed messages with one multi-row insert. Returns how many."""
+        indexed_upto = (await self._session.execute(text(INDEXED_UPTO_SQL))).scalar() or 0
+        rows = (await self._session.execute(text(PENDING_SQL), {'after': indexed_upto, 'limit': limit})).all()
+        if rows:
+            await self._session.execute(text(INSERT_SQL), [index_row(*row) for row in rows])
+        return len(rows)
+
+    async def search(self, user_id: int, terms: str, limit: int, offset: int) -> list:
+        """Best-ranked (bm25) messages matching all terms, within conversations the user belongs to."""
+        query = build_query(terms, user_id)
+        if query is None:
+            return []
+        result = await self._session.execute(
+            text(SEARCH_SQL), {'user_id': user_id, 'query': query, 'limit': limit, 'offset': offset})
+        return result.all()
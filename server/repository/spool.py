@@ -0,0 +1,388 @@
+import datetime
+import errno
+import heapq
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Segment files start with MAGIC, then hold records: HEADER followed by `length` payload bytes.
+# kind MESSAGE carries a frame; kind DELETE is a tombstone for message id `message_id` (seq -1, no payload).
+MAGIC = b'P2SPOOL1'
+HEADER = struct.Struct('<BIQqdI')  # kind, user id, message id, seq (-1: none), unix time, payload length
+MESSAGE, DELETE = 1, 2
+
+
+class SpooledMessage:
+    """An offline message held in the spool; same attributes as the OfflineMessage model."""
+    __slots__ = ('id', 'recipient_user_id', 'seq', 'created', 'frame')
+
+    def __init__(self, message_id: int, recipient_user_id: int, seq: Optional[int], created: float, frame: bytes):
+        self.id = message_id
+        self.recipient_user_id = recipient_user_id
+        self.seq = seq
+        self.created = created
+        self.frame = frame
+
+    @property
+    def message_payload(self) -> str:
+        return self.frame.hex()
+
+    @property
+    def timestamp(self) -> datetime.datetime:
+        return datetime.datetime.utcfromtimestamp(self.created)
+
+
+class _Segment:
+    __slots__ = ('number', 'path', 'size', 'live', 'live_bytes', 'fd', 'map')
+
+    def __init__(self, number: int, path: str):
+        self.number = number
+        self.path = path
+        self.size = 0
+        self.live = 0       # messages in this segment not deleted yet
+        self.live_bytes = 0 # their size, headers included
+        self.fd = None      # append descriptor, only for the active segment
+        self.map = None     # read-only mapping, remapped when the segment has grown past it
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self.map is None or len(self.map) < offset + length:
+            if self.map is not None:
+                self.map.close()
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class OfflineSpool:
+    """
+    Offline message store made of append-only segment files, one series per shard of users
+    (user_id % shards). Enqueueing appends one record per message, delivery appends a tombstone; an
+    in-memory index maps each user to the (segment, offset) of their pending messages, and replay reads
+    the frames through mmap. A segment whose messages have all been delivered is deleted once every older
+    segment of its shard is gone (tombstones only ever refer to the same or older segments); when the
+    closed segments of a shard are mostly delivered, their remaining messages are copied into a new
+    segment first, so a few old undelivered messages do not keep the rest of the files alive. The index
+    is rebuilt by scanning the segments on open; a torn record at the end of a segment is cut off.
+    """
+    def __init__(self, directory: str, shards: int = 16, segment_bytes: int = 4 * 1024 * 1024, fsync: bool = False):
+        self.directory = directory
+        self.shards = shards
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._segments: List[List[_Segment]] = [[] for _ in range(shards)]
+        # user id -> {message id: (seq, segment, offset, length, created)}, in enqueue order
+        self._index: Dict[int, Dict[int, tuple]] = {}
+        self._owner: Dict[int, int] = {}  # message id -> user id
+        self._next_id = 1
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    # --- recovery ---
+
+    def _recover(self):
+        found = [[] for _ in range(self.shards)]
+        for name in os.listdir(self.directory):
+            shard, _, rest = name.partition('-')
+            if rest.endswith('.seg') and shard.isdigit() and int(shard) < self.shards:
+                found[int(shard)].append(int(rest[:-4]))
+        messages = 0
+        for shard, numbers in enumerate(found):
+            for number in sorted(numbers):
+                segment = _Segment(number, self._path(shard, number))
+                self._segments[shard].append(segment)
+                messages += self._scan(segment)
+            self._compact(shard)
+        if messages:
+            logging.info(f"Offline spool {self.directory}: {len(self._owner)} pending messages "
+                         f"for {len(self._index)} users ({messages} records scanned).")
+
+    def _scan(self, segment: _Segment) -> int:
+        with open(segment.path, 'rb') as f:
+            data = f.read()
+        end = len(MAGIC) if data.startswith(MAGIC) else 0
+        offset, count = end, 0
+        while offset + HEADER.size <= len(data):
+            kind, user_id, message_id, seq, created, length = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            if kind not in (MESSAGE, DELETE) or start + length > len(data):
+                break
+            if kind == MESSAGE:
+                # A copy made by _rewrite() supersedes the original if the crash came before its deletion
+                self._forget(message_id)
+                self._index.setdefault(user_id, {})[message_id] = (
+                    None if seq < 0 else seq, segment, start, length, created)
+                self._owner[message_id] = user_id
+                segment.live += 1
+                segment.live_bytes += HEADER.size + length
+            else:
+                self._forget(message_id)
+            self._next_id = max(self._next_id, message_id + 1)
+            offset = end = start + length
+            count += 1
+        if end != len(data):
+            logging.warning(f"Offline spool segment {segment.path}: cutting off {len(data) - end} torn bytes.")
+            with open(segment.path, 'r+b') as f:
+                if end == 0:
+                    f.write(MAGIC)
+                    end = len(MAGIC)
+                f.truncate(end)
+        segment.size = end
+        return count
+
+    # --- writes ---
+
+    def write(self, messages: List[tuple], deleted: List[int]):
+        """
+        Appends messages [(user id, seq, frame), ...] and tombstones for the deleted message ids, with one
+        write per shard touched. Returns the ids given to the messages. The index only changes once every
+        append succeeded: if one fails, the shards already written are truncated back and nothing happened.
+        """
+        now = time.time()
+        records: Dict[int, List[tuple]] = {}
+        ids = []
+        for user_id, seq, frame in messages:
+            message_id = self._next_id
+            self._next_id += 1
+            ids.append(message_id)
+            records.setdefault(user_id % self.shards, []).append((MESSAGE, user_id, message_id, seq, frame))
+        for message_id in deleted:
+            user_id = self._owner.get(message_id)
+            if user_id is not None:
+                records.setdefault(user_id % self.shards, []).append((DELETE, user_id, message_id, None, b''))
+
+        appended = []  # (shard, segment, size before the append, records)
+        try:
+            for shard, items in records.items():
+                segment = self._active(shard)
+                appended.append((shard, segment, segment.size, items))
+                data = b''.join(
+                    HEADER.pack(kind, user_id, message_id, -1 if seq is None else seq, now, len(frame)) + frame
+                    for kind, user_id, message_id, seq, frame in items)
+                if os.write(segment.fd, data) != len(data):
+                    raise OSError(errno.ENOSPC, f"Short write to {segment.path}")
+                if self.fsync:
+                    os.fsync(segment.fd)
+        except BaseException:
+            for _, segment, size, _ in appended:
+                try:
+                    os.ftruncate(segment.fd, size)
+                except OSError:
+                    logging.exception(f"Offline spool segment {segment.path}: undoing a failed write")
+            raise
+
+        for shard, segment, offset, items in appended:
+            for kind, user_id, message_id, seq, frame in items:
+                offset += HEADER.size
+                if kind == MESSAGE:
+                    self._index.setdefault(user_id, {})[message_id] = (seq, segment, offset, len(frame), now)
+                    self._owner[message_id] = user_id
+                    segment.live += 1
+                    segment.live_bytes += HEADER.size + len(frame)
+                else:
+                    self._forget(message_id)
+                offset += len(frame)
+            segment.size = offset
+            self._compact(shard)
+        return ids
+
+    def expire(self, cutoff: float, limit: int) -> int:
+        """Deletes up to `limit` pending messages enqueued before the unix time `cutoff`, oldest first."""
+        expired = heapq.nsmallest(limit, (
+            (created, message_id)
+            for pending in self._index.values()
+            for message_id, (_, _, _, _, created) in pending.items() if created < cutoff))
+        if expired:
+            self.write([], [message_id for _, message_id in expired])
+        return len(expired)
+
+    def _active(self, shard: int) -> _Segment:
+        """The segment appends go to, rolling over to a new one past segment_bytes."""
+        segments = self._segments[shard]
+        segment = segments[-1] if segments else None
+        if segment is None or segment.size >= self.segment_bytes:
+            if segment is not None and segment.fd is not None:
+                os.close(segment.fd)
+                segment.fd = None
+            number = segment.number + 1 if segment is not None else 1
+            segment = _Segment(number, self._path(shard, number))
+            segments.append(segment)
+        if segment.fd is None:
+            fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            if segment.size == 0:
+                try:
+                    os.write(fd, MAGIC)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                segment.size = len(MAGIC)
+            segment.fd = fd
+        return segment
+
+    def _forget(self, message_id: int):
+        user_id = self._owner.pop(message_id, None)
+        if user_id is None:
+            return
+        pending = self._index[user_id]
+        _, segment, _, length, _ = pending.pop(message_id)
+        segment.live -= 1
+        segment.live_bytes -= HEADER.size + length
+        if not pending:
+            del self._index[user_id]
+
+    def _compact(self, shard: int):
+        """
+        Deletes the shard's oldest segments while they are fully delivered, never the active one. Once the
+        closed segments hold at least segment_bytes and no more than a quarter of that is still pending,
+        those messages are rewritten into a new active segment and all the closed ones can go.
+        """
+        segments = self._segments[shard]
+        closed = segments[:-1]
+        size = sum(segment.size for segment in closed)
+        live = sum(segment.live_bytes for segment in closed)
+        if live and size >= self.segment_bytes and live * 4 <= size:
+            self._rewrite(shard)
+        while len(segments) > 1 and segments[0].live == 0:
+            segment = segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    def _rewrite(self, shard: int):
+        """Copies the pending messages of the shard's closed segments into a new segment that takes the appends."""
+        segments = self._segments[shard]
+        closed = set(segments[:-1])
+        moved = sorted(
+            (message_id, user_id, entry)
+            for user_id, pending in self._index.items() if user_id % self.shards == shard
+            for message_id, entry in pending.items() if entry[1] in closed)
+        number = segments[-1].number + 1
+        segment = _Segment(number, self._path(shard, number))
+        chunks, offset, offsets = [MAGIC], len(MAGIC), []
+        for message_id, user_id, (seq, old, start, length, created) in moved:
+            chunks.append(HEADER.pack(MESSAGE, user_id, message_id, -1 if seq is None else seq, created, length))
+            chunks.append(old.read(start, length))
+            offset += HEADER.size
+            offsets.append(offset)
+            offset += length
+        created = False
+        try:
+            with open(segment.path, 'xb') as f:
+                created = True
+                f.write(b''.join(chunks))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except OSError:
+            # Nothing refers to the new file yet; the closed segments stay until a later attempt succeeds
+            logging.exception(f"Offline spool shard {shard}: rewriting {len(moved)} pending messages failed")
+            if created:
+                os.remove(segment.path)
+            return
+
+        if segments[-1].fd is not None:
+            os.close(segments[-1].fd)
+            segments[-1].fd = None
+        segments.append(segment)
+        segment.size = offset
+        for (message_id, user_id, (seq, old, _, length, created)), start in zip(moved, offsets):
+            self._index[user_id][message_id] = (seq, segment, start, length, created)
+            old.live -= 1
+            old.live_bytes -= HEADER.size + length
+            segment.live += 1
+            segment.live_bytes += HEADER.size + length
+
+    # --- reads ---
+
+    def messages(self, user_id: int) -> List[SpooledMessage]:
+        """The user's pending messages, ordered like OfflineMessageRepository.get_for_user."""
+        pending = [
+            SpooledMessage(message_id, user_id, seq, created, segment.read(offset, length))
+            for message_id, (seq, segment, offset, length, created) in self._index.get(user_id, {}).items()
+        ]
+        pending.sort(key=lambda m: (m.seq is not None, m.seq or 0, m.id))
+        return pending
+
+    def get(self, message_id: int) -> Optional[SpooledMessage]:
+        """A pending message by id; None once it is deleted."""
+        user_id = self._owner.get(message_id)
+        if user_id is None:
+            return None
+        seq, segment, offset, length, created = self._index[user_id][message_id]
+        return SpooledMessage(message_id, user_id, seq, created, segment.read(offset, length))
+
+    def stats(self) -> dict:
+        segments = [segment for shard in self._segments for segment in shard]
+        return {
+            'pending_messages': len(self._owner),
+            'users': len(self._index),
+            'segments': len(segments),
+            'bytes': sum(segment.size for segment in segments),
+        }
+
+    def close(self):
+        for shard in self._segments:
+            for segment in shard:
+                segment.close()
+
+    def _path(self, shard: int, number: int) -> str:
+        return os.path.join(self.directory, f"{shard:03d}-{number:08d}.seg")
+
+
+class SpoolOfflineMessageRepository:
+    """
+    OfflineMessageRepository backed by an OfflineSpool. Saves and deletes are buffered in the unit of
+    work and written by commit() just before the database transaction commits, while it still holds
+    SQLite's write lock: a login waiting for that lock reads the spool only after the send's message is
+    in it. If the database commit then fails, rollback() appends the inverse records, so no message is
+    left behind under a seq that will be allocated again and no delivered message is lost.
+    """
+    def __init__(self, spool: OfflineSpool, session: AsyncSession):
+        self._spool = spool
+        self._session = session
+        self._saved: List[tuple] = []
+        self._deleted: List[int] = []
+        # What commit() wrote, for rollback(): ids of the new messages and copies of the deleted ones
+        self._written: List[int] = []
+        self._restore: List[tuple] = []
+
+    async def get_for_user(self, user_id: int) -> list[SpooledMessage]:
+        # Login and resume have a login log row pending: flushing it takes SQLite's write lock before the
+        # spool is read, exactly as the autoflush of the offline_messages query does for the table store
+        await self._session.flush()
+        return self._spool.messages(user_id)
+
+    async def save(self, recipient_id: int, payload: str, seq: int | None = None):
+        self._saved.append((recipient_id, seq, bytes.fromhex(payload)))
+
+    async def save_many(self, recipient_id: int, messages: list[tuple[int, str]]):
+        self._saved.extend((recipient_id, seq, bytes.fromhex(payload)) for seq, payload in messages)
+
+    async def delete(self, message: SpooledMessage):
+        self._deleted.append(message.id)
+
+    async def delete_many(self, message_ids: list[int]):
+        self._deleted.extend(message_ids)
+
+    def commit(self):
+        if self._saved or self._deleted:
+            restore = [self._spool.get(message_id) for message_id in self._deleted]
+            self._restore = [(m.recipient_user_id, m.seq, m.frame) for m in restore if m is not None]
+            self._written = self._spool.write(self._saved, self._deleted)
+            self._saved, self._deleted = [], []
+
+    def rollback(self):
+        """Undoes commit(): tombstones the new messages and appends the deleted ones again."""
+        if self._written or self._restore:
+            self._spool.write(self._restore, self._written)
+        self._saved, self._deleted, self._written, self._restore = [], [], [], []
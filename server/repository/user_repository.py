@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from server.models import User
+from sqlalchemy import delete, insert, update
+from server.models import User, UserLoginLog, UserSession
 
 class UserRepository:
     """
@@ -15,13 +16,74 @@ class UserRepository:
         result = await self._session.execute(select(User).where(User.username == username))
         return result.scalars().first()
 
-    async def add(self, user: User):
-        """Adds a new user to the session."""
+    async def create(self, username: str, password_hash: str) -> User:
+        """Adds a new, regular user to the session."""
+        user = User(username=username, password_hash=password_hash, status=1, is_admin=False)
         self._session.add(user)
+        return user
+
+    async def create_session(self, user: User, token: str, keep: int):
+        """
+        Adds an auth token for a new session of the user. The user's other tokens stay valid (a reconnecting
+        device resumes with its own), except that only the newest `keep` tokens are kept.
+        """
+        newest = select(UserSession.id).where(UserSession.user_id == user.id) \
+            .order_by(UserSession.id.desc()).limit(keep - 1)
+        await self._session.execute(
+            delete(UserSession).where(UserSession.user_id == user.id, UserSession.id.not_in(newest)))
+        self._session.add(UserSession(token=token, user_id=user.id))
+
+    async def delete_session(self, token: str):
+        """Revokes one session's auth token."""
+        await self._session.execute(delete(UserSession).where(UserSession.token == token))
+
+    async def set_status(self, user: User, status: int):
+        """Bans (0) or permits (1) the user."""
+        user.status = status
+
+    async def add_login_log(self, user: User, ip: str):
+        """Records a login (or session resume) of the user."""
+        self._session.add(UserLoginLog(user_id=user.id, username=user.username, login_ip=ip))
 
     async def get_by_token(self, token: str) -> User | None:
         """Retrieves a user by their auth token."""
         if not token:
             return None
-        result = await self._session.execute(select(User).where(User.auth_token == token))
+        result = await self._session.execute(
+            select(User).join(UserSession, UserSession.user_id == User.id).where(UserSession.token == token))
         return result.scalars().first()
+
+    async def next_seq(self, user_id: int) -> int:
+        """Atomically allocates the user's next delivery sequence number."""
+        result = await self._session.execute(
+            update(User).where(User.id == user_id).values(last_seq=User.last_seq + 1).returning(User.last_seq)
+        )
+        return result.scalar_one()
+
+    async def existing_usernames(self, usernames: list[str]) -> set[str]:
+        """Returns which of the given usernames are already taken, with one query."""
+        result = await self._session.execute(select(User.username).where(User.username.in_(usernames)))
+        return set(result.scalars().all())
+
+    async def add_many(self, users: list[tuple[str, str]]) -> int:
+        """
+        Inserts (username, password_hash) rows with one multi-row statement, silently skipping usernames
+        that were taken in the meantime. Returns the number of users created.
+        """
+        if not users:
+            return 0
+        result = await self._session.execute(
+            # Table-level (Core) executemany insert: no ORM identity bookkeeping, and it reports rowcount
+            insert(User.__table__).prefix_with('OR IGNORE'),
+            [{'username': username, 'password_hash': password_hash, 'status': 1, 'is_admin': False}
+             for username, password_hash in users]
+        )
+        return result.rowcount
+
+    async def set_status_many(self, usernames: list[str], status: int) -> list[tuple[int, str]]:
+        """Sets the status of all listed non-admin users in one statement. Returns the (id, username) updated."""
+        result = await self._session.execute(
+            update(User).where(User.username.in_(usernames), User.is_admin.is_(False))
+            .values(status=status).returning(User.id, User.username)
+        )
+        return [tuple(row) for row in result.all()]
@@ -1,55 +1,160 @@
 import asyncio
+import itertools
 import logging
-from server.db.session import create_db_and_tables, close_engine
+import os
 from common.protocol import AsyncProtocol
+from common.transport import tune_writer
+from common.tls import server_context
+from server import config
 from server.handler import ServerMessageHandler
+from server.repository.backend import RepositoryBackend, create_backend
 from server.services.user_service import UserService
 from server.services.friend_service import FriendService
 from server.services.message_service import MessageService
+from server.services.search_service import SearchService
+from server.services.maintenance_service import MaintenanceService
 from server.services.admin_service import AdminService
 from server.managers.connection_manager import ConnectionManager
+from server.managers.connection import Connection
+from server.ratelimit import RateLimiter
+from server.admission import AdmissionController
+from server.profiler import SamplingProfiler
+from server.watchdog import LoopWatchdog
+from server.dedup import ReplayFilter
+from server.capture import TrafficCapture
+from common.protocol import protocol
+from server.metrics import registry, start_metrics_server
+
+_frames_in = registry.counter('frames_in_total')
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class ChatServer:
-    def __init__(self, host='127.0.0.1', port=8888):
+    def __init__(self, host='127.0.0.1', port=8888, backend: RepositoryBackend = None, unix_paths=None):
         self.host = host
         self.port = port
         self.server = None
+        self.unix_paths = list(config.UNIX_SOCKET_PATHS if unix_paths is None else unix_paths)
+        self.unix_servers = []
+        self.metrics_server = None
+        self._maintenance_task = None
+        self._search_index_task = None
+        self._conn_ids = itertools.count(1)
+        self.ssl_context = None
+        if config.TLS_CERTFILE:
+            self.ssl_context = server_context(config.TLS_CERTFILE, config.TLS_KEYFILE, config.TLS_NUM_TICKETS)
+        self.watchdog = None
+        if config.WATCHDOG_THRESHOLD is not None:
+            self.watchdog = LoopWatchdog(config.WATCHDOG_THRESHOLD, config.WATCHDOG_INTERVAL,
+                                         config.WATCHDOG_LOG_INTERVAL, config.WATCHDOG_STACK_DEPTH)
+        self.capture = None
+        if config.CAPTURE_DIR:
+            self.capture = TrafficCapture(config.CAPTURE_DIR, config.CAPTURE_MAX_BYTES, config.CAPTURE_MAX_FILES,
+                                          config.CAPTURE_REDACT_PASSWORDS)
         
+        # 0. Storage: config.REPOSITORY_BACKEND unless the caller brings its own
+        self.backend = backend or create_backend(config.REPOSITORY_BACKEND)
+
         # 1. Instantiate Managers and Services, injecting dependencies
-        connection_manager = ConnectionManager()
-        user_service = UserService(connection_manager)
+        connection_manager = ConnectionManager(max_sessions=config.MAX_SESSIONS_PER_USER)
+        rate_limiter = RateLimiter(max_buckets=config.RATE_LIMIT_MAX_BUCKETS)
+        rate_limiter.enabled = config.RATE_LIMIT_ENABLED
+        self.admission = AdmissionController(
+            max_connections=config.MAX_CONNECTIONS,
+            max_inflight_logins=config.MAX_INFLIGHT_LOGINS,
+            max_loop_lag=config.SHED_LOOP_LAG,
+            max_queue_depth=config.SHED_QUEUE_DEPTH,
+            retry_after=config.SHED_RETRY_AFTER,
+        )
+        user_service = UserService(connection_manager, self.backend)
+        self.user_service = user_service
         friend_service = FriendService(connection_manager)
         message_service = MessageService(connection_manager)
-        admin_service = AdminService(connection_manager)
+        self.message_service = message_service
+        # Full-text search and TTL maintenance run SQL directly; the in-memory backend goes without them
+        self.search_service = SearchService() if self.backend.sql else None
+        self.maintenance_service = MaintenanceService(self.backend.spool) if self.backend.sql else None
+        self.profiler = SamplingProfiler(config.PROFILE_OUTPUT_DIR, config.PROFILE_INTERVAL)
+        admin_service = AdminService(connection_manager, rate_limiter, self.profiler, self.backend)
         
         # 2. Inject all dependencies into the handler
         self.handler = ServerMessageHandler(
             self, 
+            self.backend,
             user_service, 
             friend_service,
             message_service,
+            self.search_service,
+            self.maintenance_service,
             admin_service,
-            connection_manager
+            connection_manager,
+            rate_limiter,
+            self.admission,
+            ReplayFilter(config.DEDUP_MAX_IDS)
         )
 
+        # Registered while the server runs (see start())
+        self._metrics_collector = lambda: self._collect_metrics(rate_limiter)
+
+    def _collect_metrics(self, rate_limiter: RateLimiter):
+        """Exposes limiter and admission state, read only when metrics are rendered."""
+        for (scope, command), count in rate_limiter.throttled.items():
+            yield 'throttled_total', {'scope': scope, 'command': command}, count
+        yield 'ratelimit_buckets', {}, rate_limiter.stats()['buckets']
+        admission = self.admission
+        yield 'connections', {}, admission.connections
+        yield 'inflight_requests', {}, admission.inflight_requests
+        yield 'inflight_logins', {}, admission.inflight_logins
+        yield 'loop_lag_seconds', {}, admission.loop_lag
+        for reason, count in admission.shed.items():
+            yield 'shed_total', {'reason': reason}, count
+        yield 'duplicates_dropped_total', {}, self.handler.replay_filter.duplicates
+
     async def handle_client(self, reader, writer):
-        addr = writer.get_extra_info('peername')
+        retry_after = self.admission.admit_connection()
+        if retry_after:
+            # Shed before any per-connection work; the client reconnects after retry_after
+            try:
+                writer.write(protocol.create_shed(retry_after, "Server is busy, please reconnect later."))
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+            return
+        conn = Connection(next(self._conn_ids), reader, writer)
+        addr = conn.peername
         logging.info(f"New connection from {addr}")
-        buffer = b''
-        user_id = None
+        tune_writer(
+            writer,
+            nodelay=config.TCP_NODELAY,
+            sndbuf=config.SOCKET_SNDBUF,
+            rcvbuf=config.SOCKET_RCVBUF,
+            write_high=config.WRITE_BUFFER_HIGH,
+            write_low=config.WRITE_BUFFER_LOW,
+        )
+        capture = self.capture
+        if capture:
+            capture.opened(conn.conn_id, capture.now())
 
         try:
             while True:
-                message, buffer = await AsyncProtocol.deserialize_stream(reader, buffer)
+                # The connection is the stream: it counts inbound bytes and keeps the decoder buffer
+                message, conn.buffer = await AsyncProtocol.deserialize_stream(conn, conn.buffer)
                 if message is None:
                     break
-                
-                # The handler now returns the user_id upon a successful login
-                logged_in_user_id = await self.handler.handle_message(writer, message)
-                if logged_in_user_id:
-                    user_id = logged_in_user_id
+                conn.frames_in += 1
+                _frames_in.value += 1
+                if not capture:
+                    # login/resume bind conn.user_id through the connection manager
+                    await self.handler.handle_message(conn, message)
+                    continue
+                received, body = capture.now(), capture.encode(message)
+                try:
+                    await self.handler.handle_message(conn, message)
+                finally:
+                    # Also recorded when handling raises or the connection is cancelled meanwhile
+                    capture.frame(conn.conn_id, received, capture.now() - received, body)
 
         except asyncio.CancelledError:
             logging.info(f"Connection from {addr} cancelled.")
@@ -57,17 +162,69 @@ class ChatServer:
             logging.error(f"An error occurred with {addr}: {e}")
         finally:
             logging.info(f"Connection from {addr} closed.")
-            if user_id:
-                self.handler.connection_manager.remove_user(user_id)
+            conn.discard()
+            if capture:
+                capture.closed(conn.conn_id)
+            if conn.user_id:
+                self.handler.connection_manager.remove_user(conn.user_id, conn)
+                try:
+                    await self.user_service.persist_unacked(conn)
+                except Exception:
+                    logging.exception(f"Failed to store unacked messages of user {conn.user_id}")
+            self.admission.release_connection()
             writer.close()
             await writer.wait_closed()
 
+    async def _search_index_loop(self):
+        """Adds newly written messages to the full-text index in batches."""
+        while True:
+            try:
+                await self.search_service.sync_index(config.SEARCH_SYNC_BATCH)
+            except Exception:
+                logging.exception("Search index sync failed")
+            await asyncio.sleep(config.SEARCH_SYNC_INTERVAL)
+
     async def start(self):
+        # Unix listeners first: self.server being set is the signal that the server is up
+        for path in self.unix_paths:
+            self.unix_servers.append(await asyncio.start_unix_server(
+                self.handle_client, path, backlog=config.LISTEN_BACKLOG))
+            os.chmod(path, config.UNIX_SOCKET_MODE)
+            logging.info(f"Serving on unix:{path}")
         self.server = await asyncio.start_server(
-            self.handle_client, self.host, self.port)
+            self.handle_client, self.host, self.port, backlog=config.LISTEN_BACKLOG, ssl=self.ssl_context,
+            ssl_handshake_timeout=config.TLS_HANDSHAKE_TIMEOUT if self.ssl_context else None)
 
         addr = self.server.sockets[0].getsockname()
-        logging.info(f'Serving on {addr}')
+        logging.info(f"Serving on {addr}{' (TLS)' if self.ssl_context else ''}, {self.backend.name} storage")
+        self.admission.start()
+        if self.watchdog:
+            self.watchdog.start()
+        if self.maintenance_service:
+            self._maintenance_task = asyncio.create_task(self.maintenance_service.run_forever())
+        if self.search_service:
+            self._search_index_task = asyncio.create_task(self._search_index_loop())
+        if config.METRICS_PORT is not None:
+            self.metrics_server = await start_metrics_server(registry, config.METRICS_HOST, config.METRICS_PORT)
+        registry.add_collector('server', self._metrics_collector)
 
-        async with self.server:
-            await self.server.serve_forever()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            for unix_server, path in zip(self.unix_servers, self.unix_paths):
+                unix_server.close()
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.unix_servers = []
+            registry.remove_collector('server', self._metrics_collector)
+            self.admission.stop()
+            if self.watchdog:
+                self.watchdog.stop()
+            if self.capture:
+                self.capture.close()
+            for task in (self._maintenance_task, self._search_index_task):
+                if task:
+                    task.cancel()
@@ -1,11 +1,70 @@
-from common.dto import Request, Response
+from common.dto import Response
+from server.dto import Request
 from server.managers.connection_manager import ConnectionManager
 from common.protocol import protocol
-from server.repository.user_repository import UserRepository
+from server.repository.backend import RepositoryBackend
+from server.ratelimit import RateLimiter
+from server.metrics import registry
+from server.profiler import SamplingProfiler, ProfilerBusyError
+from server import config
+from server import auth
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import csv
+import io
+import json
+import logging
+import time
+
+
+def parse_user_records(data: str, fmt: str) -> list[tuple[str, str]]:
+    """
+    Parses an import file into (username, password) pairs.
+    csv: two columns, with an optional 'username,password' header row; jsonl: one {"username", "password"} object per line.
+    Raises ValueError on malformed input.
+    """
+    records = []
+    if fmt == 'csv':
+        reader = csv.reader(io.StringIO(data))
+        for row in reader:
+            if not row or (not records and [c.strip().lower() for c in row[:2]] == ['username', 'password']):
+                continue
+            if len(row) < 2:
+                raise ValueError(f"Line {reader.line_num}: expected 'username,password'.")
+            records.append((row[0].strip(), row[1]))
+    elif fmt == 'jsonl':
+        for number, line in enumerate(data.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                records.append((str(item['username']).strip(), str(item['password'])))
+            except (ValueError, KeyError, TypeError):
+                raise ValueError(f"Line {number}: expected a JSON object with username and password.")
+    else:
+        raise ValueError(f"Unsupported format '{fmt}', use csv or jsonl.")
+    return records
+
+
+def parse_usernames(value) -> list[str]:
+    """Accepts a list or a comma/whitespace separated string of usernames."""
+    if isinstance(value, str):
+        value = value.replace(',', ' ').split()
+    return list(dict.fromkeys(name for name in (value or []) if name))
+
+
+BAN_NOTICE = protocol.create_sys_notify("Your account has been banned. You are being disconnected.")
+
+
 class AdminService:
     """Contains business logic for administrator-only operations."""
-    def __init__(self, connection_manager: ConnectionManager):
+    def __init__(self, connection_manager: ConnectionManager, rate_limiter: RateLimiter, profiler: SamplingProfiler,
+                 backend: RepositoryBackend):
         self._connection_manager = connection_manager
+        self._backend = backend
+        self._rate_limiter = rate_limiter
+        self._profiler = profiler
+        self._import_task = None
 
     async def broadcast_message(self, request: Request) -> Response:
         """Sends a message to all online users."""
@@ -30,7 +89,7 @@ class AdminService:
         if not username_to_ban:
             return Response(is_success=False, message="Username is required.")
 
-        repo = UserRepository(request.db_session)
+        repo = request.repos.users
         user_to_ban = await repo.get_by_username(username_to_ban)
 
         if not user_to_ban:
@@ -39,16 +98,10 @@ class AdminService:
         if user_to_ban.is_admin:
             return Response(is_success=False, message="Cannot ban an administrator.")
 
-        user_to_ban.status = 0  # Set status to banned
+        await repo.set_status(user_to_ban, 0)  # Set status to banned
         
         # If the user is online, kick them
-        if self._connection_manager.is_online(user_to_ban.id):
-            kick_message = protocol.create_sys_notify("Your account has been banned. You are being disconnected.")
-            await self._connection_manager.send_to_user(user_to_ban.id, kick_message)
-            # The connection will be closed by the manager if send fails, or we can force it.
-            # For simplicity, we'll let the send_to_user handle dead connections.
-            self._connection_manager.remove_user(user_to_ban.id)
-
+        self._connection_manager.kick_users([user_to_ban.id], BAN_NOTICE)
 
         return Response(is_success=True, message=f"User '{username_to_ban}' has been banned.")
 
@@ -61,13 +114,163 @@ class AdminService:
         if not username_to_ban:
             return Response(is_success=False, message="请输入要禁用的用户。")
 
-        repo = UserRepository(request.db_session)
+        repo = request.repos.users
         user_to_ban = await repo.get_by_username(username_to_ban)
 
         if not user_to_ban:
             return Response(is_success=False, message=f"用户 '{username_to_ban}' 不存在.")
 
-        user_to_ban.status = 1  # Set status to banned
+        await repo.set_status(user_to_ban, 1)  # Set status to permitted
 
 
         return Response(is_success=True, message=f"用户 '{username_to_ban}' 已经解禁，能正常使用.")
+
+    async def rate_limit_stats(self, request: Request) -> Response:
+        """Reports how many requests have been throttled, per scope and command."""
+        if not request.user or not request.user.is_admin:
+            return Response(is_success=False, message="Permission denied.")
+
+        stats = self._rate_limiter.stats()
+        lines = [f"Rate limiter: {stats['buckets']} active buckets"]
+        for key, count in sorted(stats['throttled'].items()):
+            lines.append(f"- {key}: {count} throttled")
+        return Response(is_success=True, message="\n".join(lines))
+
+    async def stats(self, request: Request) -> Response:
+        """Returns a snapshot of the server metrics registry."""
+        if not request.user or not request.user.is_admin:
+            return Response(is_success=False, message="Permission denied.")
+
+        return Response(is_success=True, message=registry.render_text())
+
+    async def profile(self, request: Request) -> Response:
+        """Starts a sampling profiler on the live server for N seconds; the output stays server-side."""
+        if not request.user or not request.user.is_admin:
+            return Response(is_success=False, message="Permission denied.")
+
+        try:
+            seconds = float(request.payload.get('seconds', 0))
+        except (TypeError, ValueError):
+            seconds = 0
+        if not 0 < seconds <= config.PROFILE_MAX_SECONDS:
+            return Response(is_success=False, message=f"Seconds must be between 0 and {config.PROFILE_MAX_SECONDS}.")
+
+        loop = asyncio.get_running_loop()
+        admin_id = request.user.id
+
+        def on_done(path, samples):
+            # Runs on the profiler thread; hop back to the loop to notify the admin
+            notice = protocol.create_sys_notify(f"Profile finished: {path} ({samples} samples).")
+            loop.call_soon_threadsafe(
+                lambda: asyncio.ensure_future(self._connection_manager.send_to_user(admin_id, notice)))
+
+        try:
+            # Sample the event-loop thread, i.e. the thread running this coroutine
+            path = self._profiler.start(seconds, on_done=on_done)
+        except ProfilerBusyError as e:
+            return Response(is_success=False, message=str(e))
+
+        return Response(is_success=True, message=f"Profiling for {seconds:g}s, writing {path}.")
+
+    async def import_users(self, request: Request) -> Response:
+        """
+        Creates users in bulk from an uploaded CSV/JSONL file. Runs as a background job: passwords are hashed
+        in a thread pool and users inserted in chunks, with a progress notice to the admin after each chunk.
+        """
+        if not request.user or not request.user.is_admin:
+            return Response(is_success=False, message="Permission denied.")
+
+        try:
+            records = parse_user_records(request.payload.get('data') or '', request.payload.get('format', 'csv'))
+        except ValueError as e:
+            return Response(is_success=False, message=f"Invalid import file: {e}")
+        if not records:
+            return Response(is_success=False, message="The import file contains no users.")
+        if len(records) > config.IMPORT_MAX_USERS:
+            return Response(is_success=False, message=f"At most {config.IMPORT_MAX_USERS} users per import.")
+        if self._import_task and not self._import_task.done():
+            return Response(is_success=False, message="An import is already running.")
+
+        self._import_task = asyncio.create_task(self._run_import(request.user.id, records))
+        return Response(is_success=True, message=f"Importing {len(records)} users, progress will be reported.")
+
+    async def _run_import(self, admin_id: int, records: list[tuple[str, str]]):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        total, created, skipped = len(records), 0, 0
+        seen = set()
+        workers = config.IMPORT_HASH_WORKERS
+
+        async def notify(text):
+            await self._connection_manager.send_to_user(admin_id, protocol.create_sys_notify(text))
+
+        try:
+            with ThreadPoolExecutor(workers, thread_name_prefix='import-hash') as pool:
+                for offset in range(0, total, config.IMPORT_CHUNK_SIZE):
+                    chunk = records[offset:offset + config.IMPORT_CHUNK_SIZE]
+                    # Skip blanks, repeats within the file and (one query per chunk) existing users before hashing
+                    candidates = []
+                    for username, password in chunk:
+                        if username and password and username not in seen:
+                            seen.add(username)
+                            candidates.append((username, password))
+                    if candidates:
+                        async with self._backend.transaction() as repos:
+                            taken = await repos.users.existing_usernames([u for u, _ in candidates])
+                        candidates = [(u, p) for u, p in candidates if u not in taken]
+
+                    # Hash outside of any transaction, split across the workers
+                    step = -(-len(candidates) // workers) if candidates else 1
+                    batches = await asyncio.gather(*(
+                        loop.run_in_executor(pool, auth.hash_passwords, [p for _, p in candidates[i:i + step]])
+                        for i in range(0, len(candidates), step)
+                    ))
+                    hashes = [h for batch in batches for h in batch]
+
+                    async with self._backend.transaction() as repos:
+                        inserted = await repos.users.add_many(
+                            [(username, h) for (username, _), h in zip(candidates, hashes)])
+                    created += inserted
+                    skipped += len(chunk) - inserted
+                    await notify(f"Import progress: {offset + len(chunk)}/{total} "
+                                 f"(created {created}, skipped {skipped}).")
+        except Exception as e:
+            logging.exception("User import failed")
+            await notify(f"Import failed after creating {created} users: {e}")
+            return
+        await notify(f"Import finished: created {created}, skipped {skipped} in {time.perf_counter() - start:.1f}s.")
+
+    async def ban_users(self, request: Request) -> Response:
+        """Bans a list of users in one transaction and kicks those online in one batch."""
+        return await self._set_status_many(request, 0)
+
+    async def permit_users(self, request: Request) -> Response:
+        """Lifts the ban on a list of users in one transaction."""
+        return await self._set_status_many(request, 1)
+
+    async def _set_status_many(self, request: Request, status: int) -> Response:
+        if not request.user or not request.user.is_admin:
+            return Response(is_success=False, message="Permission denied.")
+
+        usernames = parse_usernames(request.payload.get('usernames'))
+        if not usernames:
+            return Response(is_success=False, message="At least one username is required.")
+
+        repo = request.repos.users
+        updated = []
+        # Stay below SQLite's bound parameter limit; all chunks share the request's transaction
+        for i in range(0, len(usernames), 10_000):
+            updated += await repo.set_status_many(usernames[i:i + 10_000], status)
+
+        kicked = 0
+        if status == 0:
+            kicked = self._connection_manager.kick_users([user_id for user_id, _ in updated], BAN_NOTICE)
+
+        action = 'Banned' if status == 0 else 'Permitted'
+        message = f"{action} {len(updated)} of {len(usernames)} users"
+        if status == 0:
+            message += f", disconnected {kicked} online"
+        missing = len(usernames) - len(updated)
+        if missing:
+            message += f" ({missing} not found or administrators)"
+        return Response(is_success=True, message=message + ".")
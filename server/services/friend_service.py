@@ -1,6 +1,5 @@
-from common.dto import Request, Response
-from server.repository.user_repository import UserRepository
-from server.repository.friend_repository import FriendRepository
+from common.dto import Response
+from server.dto import Request
 from server.managers.connection_manager import ConnectionManager
 from common.protocol import protocol
 
@@ -14,12 +13,12 @@ class FriendService:
         """处理发起好友请求的逻辑"""
         requester = request.user
         target_username = request.payload.get('username')
-        session = request.db_session
+        repos = request.repos
 
         if not target_username:
             return Response(is_success=False, message="必须提供要添加的好友用户名。" )
 
-        user_repo = UserRepository(session)
+        user_repo = repos.users
         target_user = await user_repo.get_by_username(target_username)
 
         if not target_user:
@@ -28,7 +27,7 @@ class FriendService:
         if requester.id == target_user.id:
             return Response(is_success=False, message="不能添加自己为好友。" )
 
-        friend_repo = FriendRepository(session)
+        friend_repo = repos.friends
         existing_relation = await friend_repo.get_friend_relationship(requester.id, target_user.id)
 
         if existing_relation:
@@ -55,18 +54,18 @@ class FriendService:
         """处理接受好友请求的逻辑"""
         accepter = request.user
         requester_username = request.payload.get('username')
-        session = request.db_session
+        repos = request.repos
 
         if not requester_username:
             return Response(is_success=False, message="必须提供好友的用户名。" )
 
-        user_repo = UserRepository(session)
+        user_repo = repos.users
         requester = await user_repo.get_by_username(requester_username)
 
         if not requester:
             return Response(is_success=False, message=f"用户 '{requester_username}' 不存在。" )
 
-        friend_repo = FriendRepository(session)
+        friend_repo = repos.friends
         relation = await friend_repo.get_friend_relationship(accepter.id, requester.id)
 
         if not relation or relation.status == 1:
@@ -76,7 +75,7 @@ class FriendService:
         if relation.requester_id == accepter.id:
             return Response(is_success=False, message="不能接受自己的好友请求。" )
 
-        relation.status = 1  # 更新状态为“已接受”
+        await friend_repo.accept_request(relation)
 
         # 如果对方在线，发送实时通知
         notification_msg = protocol.create_sys_notify(f"用户 '{accepter.username}' 已同意您的好友请求。" )
@@ -87,17 +86,21 @@ class FriendService:
     async def list_friends(self, request: Request) -> Response:
         """处理查询好友列表的逻辑"""
         user = request.user
-        session = request.db_session
-        friend_repo = FriendRepository(session)
+        repos = request.repos
+        friend_repo = repos.friends
         
         friends = await friend_repo.list_friends(user.id)
         
         if not friends:
-            return Response(is_success=True, message="您的好友列表为空。" )
-
-        friend_list_str = "您的好友列表：\n"
-        for friend in friends:
-            status = "在线" if self._connection_manager.is_online(friend.id) else "离线"
-            friend_list_str += f"- {friend.username} ({status})\n"
-            
-        return Response(is_success=True, message=friend_list_str)
+            return Response(is_success=True, message="您的好友列表为空。", data={'message': "您的好友列表为空。", 'friends': []})
+
+        # 同时返回文本和结构化列表，供 SDK 使用
+        friend_list = [
+            {'username': friend.username, 'online': self._connection_manager.is_online(friend.id)}
+            for friend in friends
+        ]
+        lines = ["您的好友列表："]
+        lines += [f"- {f['username']} ({'在线' if f['online'] else '离线'})" for f in friend_list]
+        friend_list_str = "\n".join(lines) + "\n"
+
+        return Response(is_success=True, message=friend_list_str, data={'message': friend_list_str, 'friends': friend_list})
@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import Counter
+from common.dto import Response
+from server.dto import Request
+from server.db import session as db_session
+from server.db.session import get_session
+from server.repository.history_repository import HistoryRepository
+from server.repository.maintenance_repository import MaintenanceRepository
+from server.repository.spool import OfflineSpool
+from server.metrics import registry
+from server import config
+
+
+class MaintenanceService:
+    """
+    后台维护任务：按 TTL 分批删除过期的离线消息、登录日志（可先汇总为按天统计）和聊天记录，
+    然后做增量 vacuum。每批一个短事务，批次之间暂停，避免长时间占用 SQLite 写锁。
+    离线消息存放在 spool 时，过期消息通过追加删除标记清理。
+    """
+    def __init__(self, spool: OfflineSpool = None):
+        self.spool = spool
+        self.running = None         # name of the step in progress, None when idle
+        self.last_started = None    # datetime of the last run
+        self.last_duration = None
+        self.last_run = Counter()   # rows removed (or pages freed, for 'vacuum') in the last run, per step
+        self.totals = Counter()     # since server start
+        self._task = None
+
+    def _steps(self):
+        """(name, ttl in days, async batch function(cutoff, batch) -> rows) of the expiry steps."""
+        if self.spool is not None:
+            offline = self._expire_spooled
+        else:
+            offline = self._in_session(lambda s, cutoff, batch: MaintenanceRepository(s).expire_offline_messages(cutoff, batch))
+        return [
+            ('offline_messages', config.OFFLINE_MESSAGE_TTL_DAYS, offline),
+            ('login_logs', config.LOGIN_LOG_TTL_DAYS, self._in_session(
+                lambda s, cutoff, batch: MaintenanceRepository(s).expire_login_logs(cutoff, batch, config.LOGIN_LOG_AGGREGATE))),
+            ('chat_messages', config.HISTORY_RETENTION_DAYS, self._in_session(
+                lambda s, cutoff, batch: HistoryRepository(s).delete_older_than(cutoff, batch))),
+        ]
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Maintenance run failed")
+            await asyncio.sleep(config.MAINTENANCE_INTERVAL)
+
+    async def run_once(self):
+        if self.running:
+            return
+        self.running = 'starting'
+        self.last_started = datetime.datetime.utcnow()
+        self.last_run.clear()
+        start = time.perf_counter()
+        try:
+            now = datetime.datetime.utcnow()
+            for name, ttl_days, expire in self._steps():
+                if ttl_days is None:
+                    continue
+                self.running = name
+                cutoff = now - datetime.timedelta(days=ttl_days)
+                await self._paced(name, lambda batch, expire=expire, cutoff=cutoff: expire(cutoff, batch),
+                                  config.MAINTENANCE_BATCH)
+            if config.MAINTENANCE_VACUUM_PAGES:
+                self.running = 'vacuum'
+                await self._paced('vacuum', db_session.incremental_vacuum, config.MAINTENANCE_VACUUM_PAGES)
+        finally:
+            self.running = None
+            self.last_duration = time.perf_counter() - start
+        removed = {name: count for name, count in self.last_run.items() if count}
+        if removed:
+            logging.info(f"Maintenance finished in {self.last_duration:.1f}s: {removed}")
+
+    @staticmethod
+    def _in_session(expire):
+        """Runs expire(session, cutoff, batch) in a transaction of its own per batch."""
+        async def batch_in_session(cutoff, batch) -> int:
+            async with get_session() as session:
+                return await expire(session, cutoff, batch)
+        return batch_in_session
+
+    async def _expire_spooled(self, cutoff: datetime.datetime, batch: int) -> int:
+        return self.spool.expire(cutoff.replace(tzinfo=datetime.timezone.utc).timestamp(), batch)
+
+    async def _paced(self, name, step, batch: int):
+        """Runs step(batch) until it handles less than a full batch, pausing between calls."""
+        counter = registry.counter('maintenance_reclaimed_total', step=name)
+        while True:
+            done = await step(batch)
+            self.last_run[name] += done
+            self.totals[name] += done
+            counter.value += done
+            if done < batch:
+                return
+            await asyncio.sleep(config.MAINTENANCE_PAUSE)
+
+    async def maintenance(self, request: Request) -> Response:
+        """管理员命令：查看维护任务进度与回收情况；'maintenance run' 立即触发一次。"""
+        if not request.user or not request.user.is_admin:
+            return Response(is_success=False, message="Permission denied.")
+
+        if request.payload.get('action') == 'run':
+            if self.running:
+                return Response(is_success=False, message=f"Maintenance is already running ({self.running}).")
+            self._task = asyncio.create_task(self.run_once())
+            return Response(is_success=True, message="Maintenance run started.")
+
+        stats = await db_session.database_stats()
+        lines = [f"Maintenance: {'running (' + self.running + ')' if self.running else 'idle'}"]
+        if self.last_started:
+            duration = f", took {self.last_duration:.1f}s" if self.last_duration is not None and not self.running else ''
+            lines.append(f"Last run: {self.last_started:%Y-%m-%d %H:%M:%S} UTC{duration}")
+        for name, ttl_days, _ in self._steps():
+            ttl = f"{ttl_days}d" if ttl_days is not None else 'off'
+            lines.append(f"- {name} (ttl {ttl}): {self.last_run[name]} rows last run, {self.totals[name]} total")
+        lines.append(f"- vacuum: {self.last_run['vacuum']} pages last run, {self.totals['vacuum']} total")
+        page_size = stats['page_size']
+        lines.append(f"Database: {stats['page_count'] * page_size / 1e6:.1f} MB, "
+                     f"{stats['freelist_count'] * page_size / 1e6:.1f} MB free pages"
+                     + ("" if stats['auto_vacuum'] == 2 else " (auto_vacuum is not INCREMENTAL, vacuum has no effect)"))
+        return Response(is_success=True, message="\n".join(lines))
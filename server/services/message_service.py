@@ -1,9 +1,8 @@
-from common.dto import Request, Response
-from server.repository.user_repository import UserRepository
-from server.repository.friend_repository import FriendRepository
-from server.repository.message_repository import MessageRepository
+from common.dto import Response
+from server.dto import Request
 from server.managers.connection_manager import ConnectionManager
 from common.protocol import protocol
+from server import config
 
 class MessageService:
     """包含消息发送相关的核心业务逻辑"""
@@ -15,18 +14,18 @@ class MessageService:
         sender = request.user
         target_username = request.payload.get('username')
         message_text = request.payload.get('message')
-        session = request.db_session
+        repos = request.repos
 
         if not target_username or not message_text:
             return Response(is_success=False, message="必须提供接收者用户名和消息内容。")
 
-        user_repo = UserRepository(session)
+        user_repo = repos.users
         target_user = await user_repo.get_by_username(target_username)
 
         if not target_user:
             return Response(is_success=False, message=f"用户 '{target_username}' 不存在。")
 
-        friend_repo = FriendRepository(session)
+        friend_repo = repos.friends
         relation = await friend_repo.get_friend_relationship(sender.id, target_user.id)
 
         if not relation:
@@ -35,18 +34,61 @@ class MessageService:
         if relation.status == 0:
             return Response(is_success=False, message=f"您与 '{target_username}' 的好友请求尚未通过验证，暂时无法发送消息。")
 
-        # 构造要发送的消息体
-        message_to_send = protocol.create_client_user_send_message(sender.username, message_text)
+        # 写入会话历史（与投递在同一事务中）
+        await repos.history.save(sender.id, target_user.id, message_text)
 
-        # 检查对方是否在线
-        if self._connection_manager.is_online(target_user.id):
-            await self._connection_manager.send_to_user(target_user.id, message_to_send)
+        # 为接收者分配递增的投递序号，客户端据此确认并在重连时只补发缺失部分
+        seq = await user_repo.next_seq(target_user.id)
+        message_to_send = protocol.create_client_user_send_message(sender.username, message_text, seq)
+
+        # 在线则直接投递（未确认前保留在 ConnectionManager 的窗口中），否则存为离线消息。
+        # 事务中只把消息交给接收者的连接，等待其排空（背压）放到提交之后，慢接收者不会拖住 SQLite 写锁
+        sessions = self._connection_manager.enqueue_to_user(target_user.id, message_to_send, seq)
+        if sessions is not None:
+            request.after_commit.append(lambda: self._connection_manager.drain(sessions))
             # 给发送者一个直接的成功反馈
             feedback_msg = f"你悄悄地对 '{target_username}' 说: {message_text}"
             return Response(is_success=True, message=feedback_msg)
         else:
-            # 对方不在线，存储为离线消息
-            msg_repo = MessageRepository(session)
-
-            await msg_repo.save_offline_message(target_user.id, message_to_send.hex())
+            await repos.offline.save(target_user.id, message_to_send.hex(), seq)
             return Response(is_success=True, message=f"好友 '{target_username}' 当前不在线，消息将作为离线消息发送。")
+
+    async def history(self, request: Request) -> Response:
+        """查询与某个用户的聊天记录，按消息 id 倒序分页（before_id 为上一页返回的游标）"""
+        user = request.user
+        target_username = request.payload.get('username')
+        repos = request.repos
+
+        if not target_username:
+            return Response(is_success=False, message="必须提供对方的用户名。")
+        try:
+            before_id = request.payload.get('before_id')
+            before_id = int(before_id) if before_id not in (None, '') else None
+            limit = int(request.payload.get('limit') or config.HISTORY_PAGE_SIZE)
+        except (TypeError, ValueError):
+            return Response(is_success=False, message="before_id 和 limit 必须是整数。")
+        limit = max(1, min(limit, config.HISTORY_MAX_PAGE_SIZE))
+
+        target_user = await repos.users.get_by_username(target_username)
+        if not target_user:
+            return Response(is_success=False, message=f"用户 '{target_username}' 不存在。")
+
+        # 只能查询自己参与的会话，因此无需额外的权限校验
+        rows = await repos.history.get_page(user.id, target_user.id, before_id, limit)
+        names = {user.id: user.username, target_user.id: target_user.username}
+        messages = [
+            {'id': m.id, 'from': names[m.sender_id], 'message': m.message, 'time': m.create_time.isoformat()}
+            for m in reversed(rows)
+        ]
+        # 不足一页说明已经到最早的消息
+        next_before_id = rows[-1].id if len(rows) == limit else None
+
+        if messages:
+            lines = [f"[{m['id']}] {m['time'][:19].replace('T', ' ')} {m['from']}: {m['message']}" for m in messages]
+            if next_before_id is not None:
+                lines.append(f"更早的消息: history {target_username} {next_before_id}")
+            text = f"与 '{target_username}' 的聊天记录:\n" + "\n".join(lines)
+        else:
+            text = f"没有与 '{target_username}' 的更早聊天记录。"
+        return Response(is_success=True, message=text,
+                        data={'message': text, 'messages': messages, 'next_before_id': next_before_id})
@@ -0,0 +1,52 @@
+import asyncio
+from common.dto import Response
+from server.dto import Request
+from server.repository.search_repository import SearchRepository
+from server.db.session import get_session
+from server import config
+
+
+class SearchService:
+    """聊天记录全文检索（SQLite FTS5），以及索引的增量同步；仅用于 SQLAlchemy 后端"""
+
+    async def search(self, request: Request) -> Response:
+        """在用户参与的会话中检索消息，按相关度排序分页返回"""
+        terms = (request.payload.get('keyword') or '').strip()
+        if not terms:
+            return Response(is_success=False, message="必须提供搜索关键词。")
+        try:
+            page = int(request.payload.get('page') or 1)
+        except (TypeError, ValueError):
+            return Response(is_success=False, message="page 必须是整数。")
+        if not 1 <= page <= config.SEARCH_MAX_PAGE:
+            return Response(is_success=False, message=f"page 必须在 1 到 {config.SEARCH_MAX_PAGE} 之间。")
+
+        size = config.SEARCH_PAGE_SIZE
+        # 多取一条用于判断是否还有下一页
+        rows = await SearchRepository(request.repos.session).search(request.user.id, terms, size + 1, (page - 1) * size)
+        has_more = len(rows) > size
+        hits = [
+            {'id': r.id, 'from': r.sender, 'with': r.peer, 'message': r.message, 'time': str(r.create_time)[:19]}
+            for r in rows[:size]
+        ]
+
+        if hits:
+            lines = [f"[{h['id']}] {h['time']} {h['from']} (与 {h['with']}): {h['message']}" for h in hits]
+            if has_more:
+                lines.append(f"下一页: search {terms} {page + 1}")
+            text = f"'{terms}' 的搜索结果（第 {page} 页）:\n" + "\n".join(lines)
+        else:
+            text = f"没有找到包含 '{terms}' 的消息。"
+        return Response(is_success=True, message=text,
+                        data={'message': text, 'hits': hits, 'next_page': page + 1 if has_more else None})
+
+    async def sync_index(self, batch: int) -> int:
+        """把尚未索引的消息分批写入全文索引，每批一个短事务。返回本次索引的消息数。"""
+        total = 0
+        while True:
+            async with get_session() as session:
+                indexed = await SearchRepository(session).sync_batch(batch)
+            total += indexed
+            if indexed < batch:
+                return total
+            await asyncio.sleep(0)
@@ -1,40 +1,36 @@
 import logging
-from common.dto import Request, Response
-from server.repository.user_repository import UserRepository
-from server.repository.offline_message_repository import OfflineMessageRepository # Assuming this will be created
-from server.models import User, UserLoginLog
+from common.dto import Response
+from server.dto import Request
+from server.repository.backend import Repositories, RepositoryBackend
+from server.models import User
 from server.managers.connection_manager import ConnectionManager
-from server import auth
-from common import protocol
+from server.managers.connection import Connection, Priority
+from server import auth, config
+from server.tracing import span
 
 class UserService:
     """Contains business logic for user-related operations."""
-    def __init__(self, connection_manager: ConnectionManager):
+    def __init__(self, connection_manager: ConnectionManager, backend: RepositoryBackend):
         self._connection_manager = connection_manager
+        self._backend = backend
 
     async def register(self, request: Request) -> Response:
         """Handles new user registration."""
         username = request.payload.get('username')
         password = request.payload.get('password')
-        session = request.db_session
 
         if not username or not password:
             return Response(is_success=False, message="Username and password are required.")
 
-        repo = UserRepository(session)
+        repo = request.repos.users
         if await repo.get_by_username(username):
             return Response(is_success=False, message="Username already exists.")
 
-        salt, password_hash = auth.hash_password(password)
+        with span('pbkdf2'):
+            salt, password_hash = auth.hash_password(password)
         full_password_hash = f"{salt}:{password_hash}"
-        
-        new_user = User(
-            username=username,
-            password_hash=full_password_hash,
-            status=1,
-            is_admin=False
-        )
-        await repo.add(new_user)
+
+        await repo.create(username, full_password_hash)
         
         return Response(is_success=True, message=f"User '{username}' registered successfully.")
 
@@ -42,12 +38,12 @@ class UserService:
         """Handles user login, session management, and offline message delivery."""
         username = request.payload.get('username')
         password = request.payload.get('password')
-        session = request.db_session
+        repos = request.repos
 
         if not username or not password:
             return Response(is_success=False, message="Username and password are required.")
 
-        user_repo = UserRepository(session)
+        user_repo = repos.users
         user = await user_repo.get_by_username(username)
 
         if not user:
@@ -59,29 +55,23 @@ class UserService:
             logging.error(f"Password hash for user '{username}' is malformed.")
             return Response(is_success=False, message="Server error: authentication data is corrupt.")
 
-        if not auth.verify_password(stored_hash, salt, password):
+        with span('pbkdf2'):
+            password_ok = auth.verify_password(stored_hash, salt, password)
+        if not password_ok:
             return Response(is_success=False, message="Invalid username or password.")
         
         if user.status == 0:
             return Response(is_success=False, message="This user account is banned.")
 
         # --- Login successful ---
+        # A token per session: logging in on another device leaves this user's other devices signed in
         auth_token = auth.generate_auth_token()
-        user.auth_token = auth_token
-        
-        login_ip = request.writer_info.get('peername', ('unknown',))[0]
-        login_log = UserLoginLog(user_id=user.id, username=user.username, login_ip=login_ip)
-        session.add(login_log)
-        
-        # Add user to the connection manager
-        self._connection_manager.add_user(user.id, request.writer)
-        
-        # Fetch and deliver offline messages
-        offline_repo = OfflineMessageRepository(session)
-        offline_messages = await offline_repo.get_for_user(user.id)
-        for msg in offline_messages:
-            await self._connection_manager.send_to_user(user.id, bytes.fromhex(msg.message_payload))
-            await offline_repo.delete(msg)
+        await user_repo.create_session(user, auth_token, config.MAX_SESSIONS_PER_USER)
+        await user_repo.add_login_log(user, request.connection.ip)
+        request.connection.auth_token = auth_token
+
+        # Register the connection and deliver what the client has not received yet
+        await self._attach(repos, user, request.connection, request.payload.get('last_seq'))
 
         return Response(
             is_success=True,
@@ -93,4 +83,65 @@ class UserService:
                 'is_admin': user.is_admin,
                 'user_id': user.id
             }
-        )
\ No newline at end of file
+        )
+
+    async def resume(self, request: Request) -> Response:
+        """Re-binds a reconnected client to its session by auth token and replays undelivered messages."""
+        user = request.user
+        repos = request.repos
+        # Like login, this write makes the transaction take the backend's write lock before the offline
+        # messages are read, so a concurrent send either commits before the read or sees the user online.
+        await repos.users.add_login_log(user, request.connection.ip)
+        request.connection.auth_token = request.payload.get('auth_token')
+        await self._attach(repos, user, request.connection, request.payload.get('last_seq'))
+        return Response(
+            is_success=True,
+            message="Session resumed.",
+            data={'message': "Session resumed.", 'is_admin': user.is_admin, 'user_id': user.id}
+        )
+
+    async def _attach(self, repos: Repositories, user: User, conn: Connection, last_seq):
+        """
+        Adds the connection as a session of the user and delivers the backlog: offline messages plus any
+        messages still unacked on older sessions closed for the session limit. Clients that send last_seq ack
+        deliveries; for them only the gap after last_seq is replayed and the unacked window is enabled.
+        """
+        track_acks = last_seq is not None
+        if track_acks:
+            try:
+                last_seq = int(last_seq)
+            except (TypeError, ValueError):
+                last_seq = 0
+        evicted = self._connection_manager.add_user(user.id, conn, track_acks)
+        in_flight = [item for old in evicted for item in old.take_unacked()]
+        # A session closed for the session limit is signed out: its token cannot resume it
+        for old in evicted:
+            if old.auth_token and old.auth_token != conn.auth_token:
+                await repos.users.delete_session(old.auth_token)
+
+        offline_repo = repos.offline
+        offline_messages = await offline_repo.get_for_user(user.id)
+        backlog = [(msg.seq, bytes.fromhex(msg.message_payload)) for msg in offline_messages] + in_flight
+        if track_acks:
+            backlog = [(seq, frame) for seq, frame in backlog if seq is None or seq > last_seq]
+        # Rows written before sequencing (seq NULL) first, then in sequence order
+        backlog.sort(key=lambda item: (item[0] is not None, item[0] or 0))
+        # Only to this session: the user's other sessions got these messages live or replay them on their own
+        for seq, frame in backlog:
+            await self._connection_manager.send_to_connection(conn, frame, seq, Priority.BULK)
+        # One bulk DELETE instead of one per delivered message
+        await offline_repo.delete_many([msg.id for msg in offline_messages])
+
+    async def persist_unacked(self, conn: Connection):
+        """
+        Called when a connection closes: stores the messages its client never acknowledged as offline
+        messages, so they are replayed on the next login. A session closed for the session limit has
+        already handed them to the newer session in _attach, leaving nothing to store.
+        """
+        leftovers = conn.take_unacked()
+        if not leftovers:
+            return
+        user_id = conn.user_id
+        async with self._backend.transaction() as repos:
+            await repos.offline.save_many(user_id, [(seq, frame.hex()) for seq, frame in leftovers])
+        logging.info(f"Stored {len(leftovers)} unacked messages of user {user_id} as offline messages.")
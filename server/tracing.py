@@ -0,0 +1,104 @@
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+from server import config
+
+
+class RequestTrace:
+    """Timing breakdown of one request: named stage spans plus DB query count and time."""
+    __slots__ = ('command', 'start', 'duration', 'spans', 'queries', 'db_time')
+
+    def __init__(self, command: str):
+        self.command = command
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.spans = []  # (name, seconds), in completion order
+        self.queries = 0
+        self.db_time = 0.0
+
+    def summary(self) -> str:
+        stages = ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.spans)
+        return (f"'{self.command}' {self.duration * 1000:.1f}ms: {stages} "
+                f"(db: {self.queries} queries, {self.db_time * 1000:.1f}ms)")
+
+
+_current: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar('request_trace', default=None)
+_listeners: List[Callable[[RequestTrace], None]] = []
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+@contextmanager
+def trace_request(command: str):
+    """Opens a trace for the current request; spans and DB hooks inside it attach to it."""
+    trace = RequestTrace(command)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.duration = time.perf_counter() - trace.start
+        threshold = config.SLOW_REQUEST_THRESHOLD
+        if threshold is not None and trace.duration >= threshold:
+            logging.warning(f"Slow request {trace.summary()}")
+        for listener in _listeners:
+            listener(trace)
+
+
+@contextmanager
+def span(name: str):
+    """Times a stage of the current request. A no-op outside of trace_request()."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, time.perf_counter() - start))
+
+
+def record_query(seconds: float):
+    """Called by the SQLAlchemy cursor hooks for every executed statement."""
+    trace = _current.get()
+    if trace is not None:
+        trace.queries += 1
+        trace.db_time += seconds
+
+
+def add_listener(listener: Callable[[RequestTrace], None]):
+    _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[RequestTrace], None]):
+    _listeners.remove(listener)
+
+
+@contextmanager
+def max_queries(command: str, limit: int):
+    """
+    Test helper: asserts that every '{command}' request finished inside the block ran at most
+    `limit` SQL statements, to catch N+1 query regressions.
+
+        with max_queries('login', 8):
+            await client.login(...)
+    """
+    seen = []
+
+    def listener(trace: RequestTrace):
+        if trace.command == command:
+            seen.append(trace)
+
+    add_listener(listener)
+    try:
+        yield seen
+    finally:
+        remove_listener(listener)
+    assert seen, f"no '{command}' request was traced"
+    worst = max(seen, key=lambda t: t.queries)
+    assert worst.queries <= limit, f"'{command}' ran {worst.queries} queries (limit {limit}): {worst.summary()}"
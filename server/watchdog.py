@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from server.metrics import registry
+
+_lag = registry.histogram('loop_lag_histogram_seconds')
+_stalls = registry.counter('loop_stalls_total')
+
+
+class LoopWatchdog:
+    """
+    Finds synchronous work that blocks the event loop (PBKDF2, large json.loads, long string building).
+    A daemon thread posts a heartbeat to the loop every `interval` seconds; the heartbeat records how long
+    the loop took to run it into the loop_lag_histogram_seconds histogram, on the loop thread like every
+    other writer of the (unsynchronized) histograms. A heartbeat still pending after
+    `threshold` seconds means the loop thread is stuck: the watchdog logs that thread's current stack and
+    the task it is running, at most once per `log_interval` seconds (stalls in between are only counted).
+    Works from outside the loop, so it also reports stalls that never end.
+    """
+    def __init__(self, threshold: float, interval: float = 0.05, log_interval: float = 10.0, stack_depth: int = 20):
+        self.threshold = threshold
+        self.interval = interval
+        self.log_interval = log_interval
+        self.stack_depth = stack_depth
+        self.stalls = 0
+        self.suppressed = 0    # stalls not logged since the last report
+        self._last_log = float('-inf')
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._beat = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Starts watching the running loop. Must be called from the loop thread."""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._beat.set()  # release a pending wait: the loop thread is busy joining, not stalled
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._beat.clear()
+            posted = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(self._heartbeat, posted)
+            except RuntimeError:  # loop closed
+                return
+            if not self._beat.wait(self.threshold):
+                self._stalled(posted)
+                # Keep waiting for this heartbeat, so one long stall is reported once
+                self._beat.wait()
+
+    def _heartbeat(self, posted: float):
+        """Runs on the loop."""
+        _lag.record(time.monotonic() - posted)
+        self._beat.set()
+
+    def _stalled(self, posted: float):
+        self.stalls += 1
+        _stalls.value += 1
+        now = time.monotonic()
+        if now - self._last_log < self.log_interval:
+            self.suppressed += 1
+            return
+        self._last_log = now
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = ''.join(traceback.format_stack(frame, limit=self.stack_depth)) if frame is not None else ''
+        del frame
+        suppressed = f" ({self.suppressed} more stalls since the last report)" if self.suppressed else ''
+        self.suppressed = 0
+        logging.warning(f"Event loop blocked for {now - posted:.3f}s in {self._describe_task()}{suppressed}:\n{stack}")
+
+    def _describe_task(self) -> str:
+        # Read from this thread without synchronization: a stale answer only makes the report less precise
+        task = asyncio.current_task(self._loop)
+        if task is None:
+            return 'a callback (no task running)'
+        coro = task.get_coro()
+        return f"task {task.get_name()!r} ({getattr(coro, '__qualname__', coro)})"
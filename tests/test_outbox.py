@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+from client.outbox import Outbox
+
+
+def test_outbox_keeps_order_across_memory_and_spill_file():
+    with tempfile.TemporaryDirectory() as tmp:
+        spill = os.path.join(tmp, 'outbox.bin')
+        outbox = Outbox(max_messages=2, spill_path=spill)
+        for frame in (b'a', b'b', b'c', b'd'):
+            assert outbox.put(frame)
+        assert len(outbox) == 4
+        assert outbox.peek() == b'abcd'
+        outbox.clear()
+        assert len(outbox) == 0 and not os.path.exists(spill)
+
+
+def test_outbox_without_spill_file_rejects_when_full():
+    outbox = Outbox(max_messages=1)
+    assert outbox.put(b'a')
+    assert not outbox.put(b'b')
+    assert outbox.peek() == b'a'
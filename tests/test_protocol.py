@@ -1 +1,13 @@
-  
+import subprocess
+import sys
+
+
+def test_client_import_path_stays_light():
+    """The client and the wire codec must not drag in the server/ORM stack."""
+    probe = (
+        "import sys, client.client, common.protocol, common.dto\n"
+        "heavy = [m for m in sys.modules if m.split('.')[0] in ('sqlalchemy', 'aiosqlite', 'server')]\n"
+        "print(','.join(heavy))"
+    )
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ''
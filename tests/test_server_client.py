@@ -1 +1,1118 @@
- 
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from common.protocol import AsyncProtocol, protocol
+from server.db import session as db_session
+from server.server import ChatServer
+from server.repository.memory import MemoryBackend
+from server.repository.backend import create_backend
+from server.repository.spool import OfflineSpool
+from server.tracing import max_queries
+from server.watchdog import LoopWatchdog
+from server.metrics import registry
+
+
+class Peer:
+    """Minimal test client speaking the wire protocol directly."""
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.buffer = b''
+        self.auth_token = None
+
+    async def request(self, msg_type, **payload):
+        payload['auth_token'] = self.auth_token
+        self.writer.write(protocol.create_payload(msg_type, payload))
+        await self.writer.drain()
+        return await self.receive()
+
+    async def receive(self):
+        message, self.buffer = await asyncio.wait_for(
+            AsyncProtocol.deserialize_stream(self.reader, self.buffer), timeout=10)
+        return message
+
+    async def login(self, username, password):
+        response = await self.request('login', username=username, password=password)
+        self.auth_token = response['payload']['auth_token']
+        return response
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def run_with_server(scenario, backend=None, prepare=None):
+    """
+    Runs scenario(port) against a ChatServer backed by a scratch SQLite database (or the given backend).
+    prepare(path), if given, is called with the database file path before the tables are created.
+    """
+    async def main():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.db')
+            if prepare:
+                prepare(path)
+            db_session.configure_engine(f"sqlite+aiosqlite:///{path}")
+            await db_session.create_db_and_tables()
+            server = ChatServer(port=0, backend=backend)
+            serve_task = asyncio.create_task(server.start())
+            while server.server is None:
+                await asyncio.sleep(0.01)
+            try:
+                await scenario(server.server.sockets[0].getsockname()[1])
+            finally:
+                serve_task.cancel()
+                await asyncio.gather(serve_task, return_exceptions=True)
+                await db_session.close_engine()
+    asyncio.run(main())
+
+
+def test_login_offline_delivery_query_count_is_constant():
+    async def scenario(port):
+        alice, bob = Peer(), Peer()
+        await alice.connect(port)
+        await bob.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        await bob.close()
+
+        await asyncio.sleep(0.1)
+        for i in range(10):
+            response = await alice.request('send', username='bob', message=f'offline {i}')
+            assert '离线' in response['payload']['message']
+
+        bob = Peer()
+        await bob.connect(port)
+        # Delivering 10 offline messages must not cost a query per message
+        with max_queries('login', 6):
+            frames = [await bob.request('login', username='bob', password='pw')]
+            frames += [await bob.receive() for _ in range(10)]
+        delivered = [m['payload']['message'] for m in frames if m['type'] == 'usersend']
+        assert delivered == [f'offline {i}' for i in range(10)]
+
+    run_with_server(scenario)
+
+
+def test_replayed_msg_id_is_delivered_once():
+    async def scenario(port):
+        alice, bob = Peer(), Peer()
+        await alice.connect(port)
+        await bob.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+
+        # The same message replayed from a client outbox after a reconnect
+        first = await alice.request('send', username='bob', message='hi', msg_id='m-1')
+        second = await alice.request('send', username='bob', message='hi', msg_id='m-1')
+        assert not first['payload'].get('duplicate')
+        assert second['payload']['duplicate'] is True
+        await alice.request('send', username='bob', message='bye', msg_id='m-2')
+
+        assert (await bob.receive())['payload']['message'] == 'hi'
+        assert (await bob.receive())['payload']['message'] == 'bye'
+
+        # msg_ids are per user: bob's m-1 is not alice's
+        assert not (await bob.request('send', username='alice', message='yo', msg_id='m-1'))['payload'].get('duplicate')
+        assert (await alice.receive())['payload']['message'] == 'yo'
+
+        # A first attempt that failed is not remembered: its replay is processed
+        carol = Peer()
+        await carol.connect(port)
+        await carol.request('reg', username='carol', password='pw')
+        await carol.login('carol', 'pw')
+        failed = await alice.request('send', username='carol', message='late', msg_id='m-3')
+        assert failed['payload']['ok'] is False
+        await alice.request('add_friend', username='carol')
+        await carol.receive()  # friend request notification
+        await carol.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        replayed = await alice.request('send', username='carol', message='late', msg_id='m-3')
+        assert replayed['payload']['ok'] is True and not replayed['payload'].get('duplicate')
+        assert (await carol.receive())['payload']['message'] == 'late'
+
+    run_with_server(scenario)
+
+
+def test_history_keyset_pagination():
+    async def scenario(port):
+        alice, bob = Peer(), Peer()
+        await alice.connect(port)
+        await bob.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        await bob.close()
+
+        for i in range(5):
+            await alice.request('send', username='bob', message=f'm{i}')
+
+        pages, before_id = [], None
+        while True:
+            response = await alice.request('history', username='bob', before_id=before_id, limit=2)
+            body = response['payload']
+            pages.append([m['message'] for m in body['messages']])
+            before_id = body['next_before_id']
+            if before_id is None:
+                break
+        assert pages == [['m3', 'm4'], ['m1', 'm2'], ['m0']]
+
+        # Each page must be one range scan of the conversation index, not a table scan
+        async with db_session.engine.connect() as conn:
+            plan = await conn.exec_driver_sql(
+                "EXPLAIN QUERY PLAN SELECT * FROM chat_messages WHERE user_low_id = 1 AND user_high_id = 2 "
+                "AND id < 10 ORDER BY id DESC LIMIT 2")
+            detail = ' '.join(row[-1] for row in plan)
+        assert 'ix_chat_messages_conversation' in detail and 'TEMP B-TREE' not in detail
+
+    run_with_server(scenario)
+
+
+def test_search_is_ranked_and_limited_to_own_conversations():
+    async def scenario(port):
+        alice, bob, carol = Peer(), Peer(), Peer()
+        for peer, name in ((alice, 'alice'), (bob, 'bob'), (carol, 'carol')):
+            await peer.connect(port)
+            await peer.request('reg', username=name, password='pw')
+            await peer.login(name, 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.receive()  # friend request notification
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        await bob.close()
+
+        for text in ('deploy the release tonight', 'release release release', 'lunch?', '今天你好世界'):
+            await alice.request('send', username='bob', message=text)
+
+        # The index is synced in the background; wait for it to catch up
+        for _ in range(50):
+            body = (await alice.request('search', keyword='release'))['payload']
+            if body['hits']:
+                break
+            await asyncio.sleep(0.1)
+        assert [h['message'] for h in body['hits']] == ['release release release', 'deploy the release tonight']
+        assert body['hits'][0]['with'] == 'bob'
+
+        body = (await alice.request('search', keyword='你好'))['payload']
+        assert [h['message'] for h in body['hits']] == ['今天你好世界']
+
+        body = (await carol.request('search', keyword='release'))['payload']
+        assert body['hits'] == []
+
+    run_with_server(scenario)
+
+
+def test_unacked_messages_are_replayed_from_last_seq():
+    async def scenario(port):
+        alice, bob = Peer(), Peer()
+        await alice.connect(port)
+        await bob.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        # A client that sends last_seq acknowledges deliveries
+        response = await bob.request('login', username='bob', password='pw', last_seq=0)
+        bob.auth_token = response['payload']['auth_token']
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+
+        for i in range(3):
+            await alice.request('send', username='bob', message=f'live {i}')
+        received = [(await bob.receive())['payload'] for _ in range(3)]
+        assert [p['seq'] for p in received] == [1, 2, 3]
+
+        # Ack the first two only, then drop the connection: seq 3 must survive as an offline message
+        bob.writer.write(protocol.create_ack(2))
+        await bob.close()
+        await asyncio.sleep(0.1)
+        await alice.request('send', username='bob', message='offline 3')
+
+        # The client did receive seq 3 before the drop; only the gap after it is replayed
+        bob = Peer()
+        await bob.connect(port)
+        frames = [await bob.request('login', username='bob', password='pw', last_seq=3), await bob.receive()]
+        pushed = [m['payload'] for m in frames if m['type'] == 'usersend']
+        assert [(p['seq'], p['message']) for p in pushed] == [(4, 'offline 3')]
+
+        # A client without last_seq gets the whole stored backlog, as before: seq 4 was never acked
+        await bob.close()
+        await asyncio.sleep(0.1)
+        bob2 = Peer()
+        await bob2.connect(port)
+        frames = [await bob2.request('login', username='bob', password='pw'), await bob2.receive()]
+        assert [m['payload']['seq'] for m in frames if m['type'] == 'usersend'] == [4]
+
+    run_with_server(scenario)
+
+
+def test_bulk_import_and_bulk_ban():
+    async def scenario(port):
+        admin = Peer()
+        await admin.connect(port)
+        await admin.request('reg', username='root', password='pw')
+        await admin.request('reg', username='taken', password='pw')
+        async with db_session.engine.begin() as conn:
+            await conn.exec_driver_sql("UPDATE users SET is_admin = 1 WHERE username = 'root'")
+        await admin.login('root', 'pw')
+
+        data = "username,password\nu1,p1\nu2,p2\ntaken,x\nu1,again\nu3,p3\n"
+        response = await admin.request('import_users', data=data, format='csv')
+        assert response['payload']['ok'], response
+        notices = []
+        while not notices or 'finished' not in notices[-1]:
+            notices.append((await admin.receive())['payload']['message'])
+        assert 'created 3, skipped 2' in notices[-1]
+
+        u1 = Peer()
+        await u1.connect(port)
+        await u1.login('u1', 'p1')
+
+        response = await admin.request('ban_users', usernames='u1, u2 root nobody')
+        assert 'Banned 2 of 4 users, disconnected 1 online' in response['payload']['message']
+        assert 'banned' in (await u1.receive())['payload']['message']
+        assert await u1.reader.read() == b''  # kicked
+
+        u2 = Peer()
+        await u2.connect(port)
+        assert not (await u2.request('login', username='u2', password='p2'))['payload']['ok']
+        await admin.request('permit_users', usernames=['u1', 'u2'])
+        assert (await u2.request('login', username='u2', password='p2'))['type'] == 'login_success'
+
+    run_with_server(scenario)
+
+
+def test_maintenance_expires_old_rows_in_batches(monkeypatch):
+    from server import config
+    monkeypatch.setattr(config, 'MAINTENANCE_BATCH', 2)
+    monkeypatch.setattr(config, 'MAINTENANCE_PAUSE', 0)
+
+    async def scenario(port):
+        admin = Peer()
+        await admin.connect(port)
+        await admin.request('reg', username='root', password='pw')
+        await admin.request('reg', username='away', password='pw')  # stays offline, keeps its backlog
+        async with db_session.engine.begin() as conn:
+            await conn.exec_driver_sql("UPDATE users SET is_admin = 1 WHERE username = 'root'")
+            for i in range(5):
+                await conn.exec_driver_sql(
+                    "INSERT INTO user_login_log (user_id, username, login_time) "
+                    f"VALUES (1, 'root', '2020-01-0{1 + i % 2} 10:00:00.000000')")
+                await conn.exec_driver_sql(
+                    "INSERT INTO offline_messages (recipient_user_id, message_payload, timestamp) "
+                    "VALUES (2, '00', '2020-01-01 10:00:00.000000')")
+        await admin.login('root', 'pw')  # one fresh login log row, kept
+
+        assert (await admin.request('maintenance', action='run'))['payload']['ok']
+        for _ in range(50):
+            report = (await admin.request('maintenance'))['payload']['message']
+            if 'idle' in report and 'Last run' in report:
+                break
+            await asyncio.sleep(0.05)
+        assert '- offline_messages (ttl 30d): 5 rows last run' in report
+        assert '- login_logs (ttl 90d): 5 rows last run' in report
+
+        async with db_session.engine.connect() as conn:
+            daily = (await conn.exec_driver_sql(
+                "SELECT day, user_id, logins FROM user_login_daily ORDER BY day")).all()
+            remaining = (await conn.exec_driver_sql("SELECT count(*) FROM user_login_log")).scalar()
+        assert [tuple(row) for row in daily] == [('2020-01-01', 1, 3), ('2020-01-02', 1, 2)]
+        assert remaining == 1
+
+    run_with_server(scenario)
+
+
+def test_unacked_window_is_allocated_only_while_messages_are_pending():
+    from server.managers.connection import Connection
+
+    class Writer:
+        def get_extra_info(self, name):
+            return ('127.0.0.1', 5000)
+
+        def write(self, frame):
+            pass
+
+    conn = Connection(1, None, Writer())
+    assert not hasattr(conn, '__dict__')
+    assert conn.unacked is None and conn.ip == '127.0.0.1'
+    conn.push_unacked(1, b'a')
+    conn.push_unacked(2, b'b')
+    conn.ack(1)
+    assert conn.take_unacked() == [(2, b'b')]
+    conn.push_unacked(3, b'c')
+    conn.ack(3)
+    assert conn.unacked is None
+
+
+def test_capture_is_redacted_rotated_and_replayable(monkeypatch, tmp_path):
+    from server import config
+    from server.capture import FRAME, REDACTED, read_capture
+    from tools.replay import replay
+    monkeypatch.setattr(config, 'CAPTURE_DIR', str(tmp_path))
+    monkeypatch.setattr(config, 'CAPTURE_MAX_BYTES', 200)
+    tokens = []
+
+    async def capture(port):
+        alice = Peer()
+        await alice.connect(port)
+        await alice.request('reg', username='alice', password='secret')
+        await alice.login('alice', 'secret')
+        tokens.append(alice.auth_token)
+        await alice.request('myfriends')
+        await alice.close()
+
+    run_with_server(capture)
+    files = sorted(str(p) for p in tmp_path.glob('capture-*.bin'))
+    assert len(files) > 1
+    frames = [r.message for r in read_capture(files) if r.kind == FRAME]
+    assert [m['type'] for m in frames] == ['reg', 'login', 'myfriends']
+    assert frames[1]['payload']['password'] == REDACTED
+    captured = ''.join(open(f, 'rb').read().decode('utf8', 'replace') for f in files)
+    assert 'secret' not in captured
+    # The live session token is stored as a pseudonym only
+    assert tokens[0] not in captured and frames[2]['payload']['auth_token'].startswith('tok-')
+
+    monkeypatch.setattr(config, 'CAPTURE_DIR', None)
+
+    async def replay_capture(port):
+        report = await replay(files, port=port, speed=0)
+        assert set(report['commands']) == {'reg', 'login', 'myfriends'}
+        # The replayed myfriends only succeeds with the token issued by the replayed login
+        assert all(r['count'] == 1 and r['failed'] == 0 and r['timeouts'] == 0 for r in report['commands'].values())
+
+    run_with_server(replay_capture)
+
+
+@pytest.mark.skipif(shutil.which('openssl') is None, reason='needs the openssl CLI to create a certificate')
+def test_capture_records_frames_whose_handling_raises(monkeypatch, tmp_path):
+    from server import config
+    from server.capture import FRAME, read_capture
+    from server.handler import ServerMessageHandler
+    monkeypatch.setattr(config, 'CAPTURE_DIR', str(tmp_path))
+    handle_message = ServerMessageHandler.handle_message
+
+    async def failing(self, conn, message):
+        if message.get('type') == 'myfriends':
+            raise RuntimeError('handler bug')
+        await handle_message(self, conn, message)
+    monkeypatch.setattr(ServerMessageHandler, 'handle_message', failing)
+
+    async def scenario(port):
+        alice = Peer()
+        await alice.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        alice.writer.write(protocol.create_payload('myfriends', {}))
+        await alice.reader.read()  # the server drops the connection
+
+    run_with_server(scenario)
+    records = list(read_capture(sorted(str(p) for p in tmp_path.glob('capture-*.bin'))))
+    assert [r.message['type'] for r in records if r.kind == FRAME] == ['reg', 'myfriends']
+
+
+def test_tls_reconnect_resumes_the_session(monkeypatch, tmp_path):
+    from server import config
+    from client.sdk import AsyncChatClient
+    from common.tls import client_context, generate_self_signed_cert
+    certfile, keyfile = generate_self_signed_cert(str(tmp_path), key='ec')
+    monkeypatch.setattr(config, 'TLS_CERTFILE', certfile)
+    monkeypatch.setattr(config, 'TLS_KEYFILE', keyfile)
+
+    async def scenario(port):
+        context = client_context(certfile)
+        reused = []
+        for _ in range(3):
+            async with AsyncChatClient('127.0.0.1', port, reconnect=False, ssl_context=context,
+                                       server_hostname='localhost') as client:
+                if not reused:
+                    await client.register('alice', 'pw')
+                assert (await client.login('alice', 'pw'))['user_id']
+                reused.append(client._writer.get_extra_info('ssl_object').session_reused)
+        assert reused == [False, True, True]
+
+    run_with_server(scenario)
+
+
+def test_control_frames_overtake_queued_bulk_frames(monkeypatch):
+    from server import config
+    from server.managers.connection import Connection, Priority
+    monkeypatch.setattr(config, 'WRITE_BUFFER_HIGH', 100)
+
+    class Transport:
+        size = 100  # backed up: the client is not reading
+
+        def get_write_buffer_size(self):
+            return self.size
+
+    class Writer:
+        def __init__(self):
+            self.transport = Transport()
+            self.sent = []
+            self.readable = asyncio.Event()
+
+        def get_extra_info(self, name):
+            return None
+
+        def write(self, frame):
+            self.sent.append(frame)
+            self.transport.size += len(frame)
+
+        async def drain(self):
+            await self.readable.wait()
+
+    async def main():
+        writer = Writer()
+        conn = Connection(1, None, writer)
+        backlog = [b'B%02d' % i for i in range(30)]
+        for frame in backlog:
+            await conn.send(frame, Priority.BULK, seq=1)
+        await conn.send(b'SEQ', Priority.INTERACTIVE, seq=2)  # must stay behind the sequenced backlog
+        await conn.send(b'INT', Priority.INTERACTIVE)
+        await conn.send(b'CTL', Priority.CONTROL)
+        assert writer.sent == [] and conn.queued_bytes == 99
+
+        writer.readable.set()
+        while conn.sender is not None:
+            await asyncio.sleep(0)
+        assert writer.sent == [b'CTL', b'INT'] + backlog + [b'SEQ']
+        assert conn.queues is None
+
+        # A sender that dies of an unexpected error must not leave send() waiting for a drain forever
+        async def broken_drain():
+            raise RuntimeError('transport bug')
+        writer.drain = broken_drain
+        writer.transport.size = 100
+        waiting = asyncio.create_task(conn.send(b'X' * 150, Priority.BULK))
+        await asyncio.wait_for(waiting, timeout=1)
+        assert conn.sender is None and conn.queued_bytes == 0
+
+    asyncio.run(main())
+
+
+def test_backpressure_from_a_slow_recipient_is_awaited_after_the_commit(monkeypatch):
+    from server.managers.connection import Connection
+    stalled, released = [False], asyncio.Event()
+    blocked = []
+    drain = Connection.drain
+
+    async def slow_drain(self):
+        if stalled[0] and self.user_id == 2:  # bob stops reading
+            blocked.append(self.conn_id)
+            await released.wait()
+        await drain(self)
+    monkeypatch.setattr(Connection, 'drain', slow_drain)
+
+    async def scenario(port):
+        alice, bob, carol = Peer(), Peer(), Peer()
+        for peer in (alice, bob, carol):
+            await peer.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        stalled[0] = True
+
+        sending = asyncio.create_task(alice.request('send', username='bob', message='hi'))
+        while not blocked:
+            await asyncio.sleep(0.01)
+        # The send waits for bob with its transaction committed: other writers are not held up
+        assert (await carol.request('reg', username='carol', password='pw'))['payload']['ok'] is True
+        assert not sending.done()
+        released.set()
+        assert (await sending)['payload']['ok'] is True
+        assert (await bob.receive())['payload']['message'] == 'hi'
+
+    run_with_server(scenario, MemoryBackend())
+
+
+def test_memory_backend_serves_the_same_protocol():
+    backend = MemoryBackend(admins=('root',))
+
+    async def scenario(port):
+        alice, bob, root = Peer(), Peer(), Peer()
+        for peer in (alice, bob, root):
+            await peer.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await root.request('reg', username='root', password='pw')
+        assert not (await alice.request('reg', username='alice', password='pw'))['payload']['ok']
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        friends = (await alice.request('myfriends'))['payload']['friends']
+        assert friends == [{'username': 'bob', 'online': True}]
+        await bob.close()
+
+        await asyncio.sleep(0.1)
+        for i in range(3):
+            await alice.request('send', username='bob', message=f'offline {i}')
+        bob = Peer()
+        await bob.connect(port)
+        frames = [await bob.request('login', username='bob', password='pw')] + [await bob.receive() for _ in range(3)]
+        bob.auth_token = next(m['payload']['auth_token'] for m in frames if m['type'] == 'login_success')
+        delivered = [m['payload']['message'] for m in frames if m['type'] == 'usersend']
+        assert delivered == [f'offline {i}' for i in range(3)]
+        assert not backend.offline and not backend.offline_by_id
+
+        page = (await bob.request('history', username='alice', limit=2))['payload']
+        assert [m['message'] for m in page['messages']] == ['offline 1', 'offline 2']
+        page = (await bob.request('history', username='alice', before_id=page['next_before_id']))['payload']
+        assert [m['message'] for m in page['messages']] == ['offline 0']
+        # SQL-only commands are not offered
+        assert 'Unknown command' in (await bob.request('search', keyword='offline'))['payload']['message']
+
+        await root.login('root', 'pw')
+        assert (await root.request('ban_users', usernames='alice'))['payload']['ok']
+        assert backend.users_by_name['alice'].status == 0
+
+    run_with_server(scenario, backend)
+
+
+def test_watchdog_reports_the_blocking_call_once_per_log_interval(monkeypatch, caplog):
+    import threading
+    from server import watchdog as watchdog_module
+    lag = registry.histogram('loop_lag_histogram_seconds')
+    recorded_on = set()
+
+    class Lag:
+        def record(self, seconds):
+            recorded_on.add(threading.get_ident())
+            lag.record(seconds)
+    monkeypatch.setattr(watchdog_module, '_lag', Lag())
+
+    async def blocking_handler():
+        time.sleep(0.3)
+
+    async def main():
+        watchdog = LoopWatchdog(threshold=0.1, interval=0.02, log_interval=60)
+        watchdog.start()
+        try:
+            await asyncio.sleep(0.1)
+            beats = lag.count
+            for _ in range(2):
+                await asyncio.create_task(blocking_handler(), name='handler')
+                await asyncio.sleep(0.1)
+        finally:
+            watchdog.stop()
+        return watchdog, beats
+
+    with caplog.at_level('WARNING'):
+        watchdog, beats = asyncio.run(main())
+    reports = [r.getMessage() for r in caplog.records if 'Event loop blocked' in r.getMessage()]
+    assert watchdog.stalls == 2 and watchdog.suppressed == 1
+    assert len(reports) == 1
+    assert "task 'handler' (test_watchdog_reports_the_blocking_call_once_per_log_interval.<locals>.blocking_handler)" in reports[0]
+    assert 'time.sleep(0.3)' in reports[0]
+    assert beats > 0 and lag.max >= 0.25
+    # Histograms are not thread-safe: the lag is recorded on the loop thread, not the watchdog's
+    assert recorded_on == {threading.get_ident()}
+
+
+def test_spool_offline_store_replays_and_compacts(monkeypatch, tmp_path):
+    from server import config
+    monkeypatch.setattr(config, 'OFFLINE_STORE', 'spool')
+    monkeypatch.setattr(config, 'SPOOL_DIR', str(tmp_path))
+    monkeypatch.setattr(config, 'SPOOL_SEGMENT_BYTES', 256)  # a few messages per segment
+    backend = create_backend('sqlalchemy')
+    spool = backend.spool
+
+    async def scenario(port):
+        alice, bob = Peer(), Peer()
+        await alice.connect(port)
+        await bob.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        await bob.close()
+
+        await asyncio.sleep(0.1)
+        for i in range(10):
+            await alice.request('send', username='bob', message=f'offline {i}')
+        assert spool.stats()['pending_messages'] == 10 and spool.stats()['segments'] > 1
+        async with db_session.engine.connect() as conn:
+            assert (await conn.exec_driver_sql("SELECT COUNT(*) FROM offline_messages")).scalar() == 0
+        # The index is rebuilt from the segment files alone
+        assert [m.seq for m in OfflineSpool(str(tmp_path), config.SPOOL_SHARDS).messages(2)] == list(range(1, 11))
+
+        bob = Peer()
+        await bob.connect(port)
+        frames = [await bob.request('login', username='bob', password='pw')] + [await bob.receive() for _ in range(10)]
+        delivered = [m['payload']['message'] for m in frames if m['type'] == 'usersend']
+        assert delivered == [f'offline {i}' for i in range(10)]
+        # Fully delivered segments are deleted, only the segment taking appends stays
+        assert spool.stats()['pending_messages'] == 0 and spool.stats()['segments'] == 1
+        assert OfflineSpool(str(tmp_path), config.SPOOL_SHARDS).messages(2) == []
+
+    run_with_server(scenario, backend)
+    spool.close()
+
+
+def test_spool_writes_are_undone_when_the_commit_fails(monkeypatch, tmp_path):
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from server.repository.backend import SqlAlchemyBackend
+    frame = protocol.create_sys_notify('hello').hex()
+
+    async def main():
+        db_session.configure_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+        await db_session.create_db_and_tables()
+        backend = SqlAlchemyBackend(OfflineSpool(str(tmp_path / 'spool')))
+        async with backend.transaction() as repos:
+            await repos.offline.save(2, frame, 1)
+        kept = backend.spool.messages(2)
+
+        async def failing_commit(self):
+            raise RuntimeError('disk I/O error')
+        monkeypatch.setattr(AsyncSession, 'commit', failing_commit)
+        with pytest.raises(RuntimeError):
+            async with backend.transaction() as repos:
+                # Written to the spool before the commit, so both have to be undone
+                await repos.offline.save(2, frame, 2)
+                await repos.offline.delete_many([m.id for m in kept])
+        assert [(m.seq, m.message_payload) for m in backend.spool.messages(2)] == [(1, frame)]
+        await backend.close()
+
+    asyncio.run(main())
+
+
+def test_spool_rewrites_old_segments_expires_and_undoes_failed_writes(monkeypatch, tmp_path):
+    from server import config
+    from server.repository import spool as spool_module
+    from server.services.maintenance_service import MaintenanceService
+    frame = protocol.create_sys_notify('hello').hex()
+    spool = OfflineSpool(str(tmp_path), shards=2, segment_bytes=256)
+
+    # One old message of user 2 among many delivered ones: its segment is rewritten, not kept forever
+    spool.write([(2, 1, bytes.fromhex(frame))], [])
+    ids = spool.write([(4, seq, bytes.fromhex(frame)) for seq in range(1, 21)], [])
+    spool.write([], ids)
+    # Segment 1 held the message, segment 2 the tombstones; only the copy in segment 3 is left
+    assert [p.name for p in tmp_path.glob('*.seg')] == ['000-00000003.seg']
+    assert [m.message_payload for m in spool.messages(2)] == [frame]
+    assert [m.seq for m in OfflineSpool(str(tmp_path), shards=2).messages(2)] == [1]
+
+    # A write to two shards whose second append fails leaves both shards as they were
+    sizes = {p.name: p.stat().st_size for p in tmp_path.glob('*.seg')}
+    real_write = os.write
+    calls = []
+    def failing_write(fd, data):
+        calls.append(fd)
+        if len(calls) == 3:  # shard 0's records, the header of shard 1's new segment, shard 1's records
+            raise OSError(28, 'No space left on device')
+        return real_write(fd, data)
+    monkeypatch.setattr(spool_module.os, 'write', failing_write)
+    with pytest.raises(OSError):
+        spool.write([(2, 2, bytes.fromhex(frame)), (3, 1, bytes.fromhex(frame))], [])
+    monkeypatch.setattr(spool_module.os, 'write', real_write)
+    assert {name: (tmp_path / name).stat().st_size for name in sizes} == sizes
+    assert [m.seq for m in spool.messages(2)] == [1] and spool.messages(3) == []
+
+    # The maintenance task expires spooled messages past the offline TTL
+    async def main():
+        db_session.configure_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+        await db_session.create_db_and_tables()
+        monkeypatch.setattr(config, 'OFFLINE_MESSAGE_TTL_DAYS', 0)
+        monkeypatch.setattr(config, 'MAINTENANCE_VACUUM_PAGES', 0)
+        maintenance = MaintenanceService(spool)
+        await maintenance.run_once()
+        assert maintenance.last_run['offline_messages'] == 1
+        await db_session.close_engine()
+
+    asyncio.run(main())
+    assert spool.stats()['pending_messages'] == 0 and OfflineSpool(str(tmp_path), shards=2).messages(2) == []
+    spool.close()
+
+
+def test_database_created_by_the_baseline_schema_is_migrated():
+    import sqlite3
+
+    def baseline(path):
+        with sqlite3.connect(path) as db:
+            db.executescript("""
+                CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL UNIQUE,
+                    password_hash VARCHAR NOT NULL, status INTEGER NOT NULL, is_admin BOOLEAN NOT NULL,
+                    auth_token VARCHAR, create_time DATETIME NOT NULL);
+                CREATE TABLE offline_messages (id INTEGER PRIMARY KEY, recipient_user_id INTEGER REFERENCES users (id),
+                    message_payload VARCHAR NOT NULL, timestamp DATETIME NOT NULL);
+                CREATE TABLE user_login_log (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id),
+                    username VARCHAR NOT NULL, login_time DATETIME NOT NULL, login_ip VARCHAR);
+            """)
+
+    async def scenario(port):
+        # A second run over an already migrated database is a no-op
+        await db_session.create_db_and_tables()
+        alice, bob = Peer(), Peer()
+        await alice.connect(port)
+        await bob.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await bob.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        await bob.login('bob', 'pw')
+        await bob.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        await bob.close()
+        await asyncio.sleep(0.1)
+        await alice.request('send', username='bob', message='after upgrade')
+
+        bob = Peer()
+        await bob.connect(port)
+        frames = [await bob.request('login', username='bob', password='pw'), await bob.receive()]
+        delivered = [m['payload'] for m in frames if m['type'] == 'usersend']
+        assert [(m['message'], m['seq']) for m in delivered] == [('after upgrade', 1)]
+
+    run_with_server(scenario, prepare=baseline)
+
+
+def test_transport_tuning_applies_per_socket_family(monkeypatch, tmp_path, caplog):
+    import socket
+    import sys
+    from common.transport import install_event_loop, tune_writer
+
+    async def tuned(server, connect):
+        accepted = asyncio.get_running_loop().create_future()
+        listener = await server(lambda reader, writer: accepted.set_result(writer))
+        async with listener:
+            reader, writer = await connect(listener)
+            tune_writer(writer, nodelay=True, sndbuf=65536, write_high=4096, write_low=1024)
+            sock = writer.get_extra_info('socket')
+            nodelay = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) if sock.family != socket.AF_UNIX else None
+            limits = writer.transport.get_write_buffer_limits()
+            writer.close()
+            (await accepted).close()
+        return nodelay, limits
+
+    async def main():
+        tcp = await tuned(lambda cb: asyncio.start_server(cb, '127.0.0.1', 0),
+                          lambda s: asyncio.open_connection('127.0.0.1', s.sockets[0].getsockname()[1]))
+        path = str(tmp_path / 'tune.sock')
+        unix = await tuned(lambda cb: asyncio.start_unix_server(cb, path), lambda s: asyncio.open_unix_connection(path))
+        return tcp, unix
+
+    with caplog.at_level('WARNING'):
+        tcp, unix = asyncio.run(main())
+    assert tcp[0] != 0 and tcp[1] == (1024, 4096)
+    # TCP_NODELAY is skipped on AF_UNIX instead of failing; the watermarks still apply
+    assert unix == (None, (1024, 4096)) and not caplog.records
+
+    # Without uvloop the default loop stays in place
+    policy = asyncio.get_event_loop_policy()
+    monkeypatch.setitem(sys.modules, 'uvloop', None)  # makes 'import uvloop' raise ImportError
+    assert install_event_loop(True) is False and install_event_loop(False) is False
+    assert asyncio.get_event_loop_policy() is policy
+
+
+def test_unix_socket_clients_share_the_server_with_tcp(monkeypatch, tmp_path):
+    from server import config
+    from client.sdk import AsyncChatClient
+    path = str(tmp_path / 'chat.sock')
+    monkeypatch.setattr(config, 'UNIX_SOCKET_PATHS', (path,))
+    backend = MemoryBackend()
+
+    async def scenario(port):
+        alice = Peer()
+        await alice.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await alice.login('alice', 'pw')
+        async with AsyncChatClient(path=path, reconnect=False) as bob:
+            await bob.register('bob', 'pw')
+            await bob.login('bob', 'pw')
+            await alice.request('add_friend', username='bob')
+            await bob.accept_friend('alice')
+            await alice.receive()  # acceptance notification
+            assert (await alice.request('myfriends'))['payload']['friends'] == [{'username': 'bob', 'online': True}]
+            await alice.request('send', username='bob', message='over tcp')
+            async def next_private():
+                async for event in bob.events():
+                    if event['type'] == 'usersend':
+                        return event
+            assert (await asyncio.wait_for(next_private(), timeout=5))['payload']['message'] == 'over tcp'
+            await bob.send('alice', 'over unix')
+            assert (await alice.receive())['payload']['message'] == 'over unix'
+        # Logins over the Unix socket are recorded with 'unix' as their address
+        user_id, username, _, ip = backend.login_log[-1]
+        assert (username, ip) == ('bob', 'unix')
+
+    run_with_server(scenario, backend)
+    assert not os.path.exists(path)
+
+
+def test_each_device_gets_the_message_and_the_oldest_session_is_closed_past_the_limit(monkeypatch):
+    from server import config
+    monkeypatch.setattr(config, 'MAX_SESSIONS_PER_USER', 2)
+    backend = MemoryBackend()
+
+    async def scenario(port):
+        alice, desktop, mobile, bot = Peer(), Peer(), Peer(), Peer()
+        for peer in (alice, desktop, mobile, bot):
+            await peer.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await alice.request('reg', username='bob', password='pw')
+        await alice.login('alice', 'pw')
+        await alice.request('add_friend', username='bob')
+        # The desktop acks deliveries, the mobile client does not
+        response = await desktop.request('login', username='bob', password='pw', last_seq=0)
+        desktop.auth_token = response['payload']['auth_token']
+        await desktop.request('accept_friend', username='alice')
+        await alice.receive()  # acceptance notification
+        await mobile.login('bob', 'pw')
+
+        await alice.request('send', username='bob', message='to every device')
+        for peer in (desktop, mobile):
+            message = await peer.receive()
+            assert (message['payload']['seq'], message['payload']['message']) == (1, 'to every device')
+        assert not backend.offline
+
+        # A third session closes the oldest one, whose unacked message the new session takes over
+        frames = [await bot.request('login', username='bob', password='pw', last_seq=0), await bot.receive()]
+        assert [m['payload']['seq'] for m in frames if m['type'] == 'usersend'] == [1]
+        assert (await desktop.receive())['type'] == 'sysmsg'
+        assert await desktop.receive() is None
+        # The replay is for the new session only: the mobile client already has seq 1
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(mobile.receive(), timeout=0.2)
+        # The closed session is signed out: its token no longer resumes
+        stale = Peer()
+        await stale.connect(port)
+        stale.auth_token = desktop.auth_token
+        assert (await stale.request('resume', last_seq=1))['payload']['message'] == "Authentication required."
+        await stale.close()
+        assert (await alice.request('myfriends'))['payload']['friends'] == [{'username': 'bob', 'online': True}]
+
+        # Offline storage only once the last session is gone
+        await mobile.close()
+        await asyncio.sleep(0.1)
+        await alice.request('send', username='bob', message='bot only')
+        assert (await bot.receive())['payload']['message'] == 'bot only'
+        assert not backend.offline
+        bot.writer.write(protocol.create_ack(2))
+        await bot.close()
+        await asyncio.sleep(0.1)
+        await alice.request('send', username='bob', message='nobody')
+        assert [m.seq for m in backend.offline[2]] == [3]
+
+    run_with_server(scenario, backend)
+
+
+def test_sdk_events_end_when_the_client_is_closed():
+    from client.sdk import AsyncChatClient
+
+    async def scenario(port):
+        client = AsyncChatClient('127.0.0.1', port, reconnect=False)
+        await client.connect()
+        await client.register('alice', 'pw')
+        await client.login('alice', 'pw')
+
+        async def consume():
+            return [event async for event in client.events()]
+        consumers = [asyncio.create_task(consume()) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        await client.close()
+        assert await asyncio.wait_for(asyncio.gather(*consumers), timeout=5) == [[], []]
+
+    run_with_server(scenario, MemoryBackend())
+
+
+def test_sdk_closes_the_connection_of_a_failed_relogin(monkeypatch):
+    from client import config as client_config
+    from client.sdk import AsyncChatClient
+    from server.services.admin_service import BAN_NOTICE
+    monkeypatch.setattr(client_config, 'RECONNECT_BASE_DELAY', 0.01)
+
+    async def main():
+        server = ChatServer(port=0, backend=MemoryBackend())
+        serve_task = asyncio.create_task(server.start())
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        try:
+            client = AsyncChatClient('127.0.0.1', server.server.sockets[0].getsockname()[1])
+            await client.connect()
+            await client.register('alice', 'pw')
+            await client.login('alice', 'pw')
+
+            # Logins are shed while the client reconnects: every attempt's connection must be closed again
+            server.admission.max_inflight_logins = 0
+            server.admission.retry_after = 0.02
+            server.handler.connection_manager.kick_users([client.user_id], BAN_NOTICE)
+            await asyncio.sleep(0.5)
+            assert server.admission.shed['login:max_inflight_logins'] > 2
+            assert server.admission.connections <= 1
+
+            # A request made meanwhile waits for the re-login instead of going out unauthenticated
+            friends = asyncio.create_task(client.friends())
+            await asyncio.sleep(0.1)
+            assert not friends.done()
+            server.admission.max_inflight_logins = 1
+            assert (await asyncio.wait_for(friends, timeout=5)) == []
+            await client.close()
+        finally:
+            serve_task.cancel()
+            await asyncio.gather(serve_task, return_exceptions=True)
+
+    asyncio.run(main())
+
+
+def test_profiler_samples_a_busy_coroutine_one_session_at_a_time(tmp_path):
+    from server.profiler import ProfilerBusyError, SamplingProfiler
+    profiler = SamplingProfiler(str(tmp_path), interval=0.001)
+    done = []
+
+    def spin(seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            pass
+
+    async def busy():
+        for _ in range(10):
+            spin(0.03)
+            await asyncio.sleep(0)
+
+    async def main():
+        path = profiler.start(0.2, on_done=lambda path, samples: done.append(samples))
+        with pytest.raises(ProfilerBusyError):
+            profiler.start(0.2)
+        await busy()
+        return path
+
+    path = asyncio.run(main())
+    profiler._thread.join(timeout=5)
+    assert done and done[0] > 0
+    with open(path, encoding='utf8') as f:
+        stacks = f.read().splitlines()
+    assert any(';busy (' in line and line.split(';')[-1].startswith('spin (') for line in stacks)
+    # The next session gets a file of its own even within the same second
+    second = profiler.start(0.01)
+    profiler._thread.join(timeout=5)
+    assert second != path and len(list(tmp_path.glob('profile-*.collapsed'))) == 2
+
+
+def test_metrics_render_counters_histograms_and_server_stats():
+    from server.metrics import MetricsRegistry
+    metrics = MetricsRegistry()
+    metrics.counter('frames_total', kind='in').inc(3)
+    latency = metrics.histogram('latency_seconds')
+    for ms in range(1, 101):
+        latency.record(ms / 1000)
+    text = metrics.render_text()
+    assert 'frames_total{kind="in"} 3\n' in text
+    assert 'latency_seconds_count 100\n' in text
+    p50 = latency.percentile(50)
+    assert 0.05 <= p50 <= 0.05 * 1.07  # within the bucket resolution
+    assert f'latency_seconds{{quantile="0.5"}} {p50:g}\n' in text
+
+    def series(text, name):
+        return [line for line in text.splitlines() if line.split(' ')[0] == name]
+
+    async def scenario(port):
+        admin = Peer()
+        await admin.connect(port)
+        await admin.request('reg', username='root', password='pw')
+        await admin.login('root', 'pw')
+        stats = (await admin.request('stats'))['payload']['message']
+        # Another ChatServer in the process adds no second set of series
+        assert series(stats, 'connections') == ['connections 1']
+        assert len(series(stats, 'loop_lag_seconds')) == 1
+
+    ChatServer(port=0, backend=MemoryBackend())
+    run_with_server(scenario, MemoryBackend(admins=('root',)))
+    assert series(registry.render_text(), 'connections') == []
+
+
+def test_per_user_limit_is_shared_by_all_connections_of_the_user():
+    async def scenario(port):
+        alice, other = Peer(), Peer()
+        await alice.connect(port)
+        await other.connect(port)
+        await alice.request('reg', username='alice', password='pw')
+        await alice.login('alice', 'pw')
+        for _ in range(10):  # the 'myfriends' burst
+            assert (await alice.request('myfriends'))['type'] != 'throttled'
+        # A second connection with the same token draws from the same bucket
+        other.auth_token = alice.auth_token
+        response = await other.request('myfriends', req_id=7)
+        assert response['type'] == 'throttled'
+        assert 0 < response['payload']['retry_after'] <= 0.5 and response['payload']['req_id'] == 7
+        # An unknown token gets no bucket of its own, and the connection's own bucket stops the lookups
+        other.auth_token = 'forged'
+        assert (await other.request('myfriends'))['payload']['message'] == "Authentication required."
+        replies = [(await other.request('myfriends'))['type'] for _ in range(10)]
+        assert replies[-1] == 'throttled' and replies.index('throttled') <= 8  # 10 - the 2 above
+
+    run_with_server(scenario, MemoryBackend())
+
+    # A request refused by one bucket takes no token from the other
+    from server.ratelimit import RateLimit, RateLimiter
+    limiter = RateLimiter(clock=lambda: 0.0)
+    limit = RateLimit(per_user=(1, 1), per_connection=(1, 5))
+    assert limiter.check('send', limit, user_key=1, conn_key='c') == 0
+    assert limiter.check('send', limit, user_key=1, conn_key='c') > 0
+    assert [limiter.check('send', limit, user_key=user, conn_key='c') for user in range(2, 7)] == [0, 0, 0, 0, 1.0]
+
+
+def test_overloaded_server_sheds_logins_and_connections(monkeypatch):
+    from server import config
+    monkeypatch.setattr(config, 'MAX_INFLIGHT_LOGINS', 0)
+    monkeypatch.setattr(config, 'MAX_CONNECTIONS', 1)
+
+    async def scenario(port):
+        first, second = Peer(), Peer()
+        await first.connect(port)
+        response = await first.request('reg', username='alice', password='pw', req_id=1)
+        assert response['type'] == 'shed'
+        assert response['payload']['retry_after'] == config.SHED_RETRY_AFTER and response['payload']['req_id'] == 1
+        # Past MAX_CONNECTIONS a new connection gets a shed notice and is closed
+        await second.connect(port)
+        notice = await second.receive()
+        assert notice['type'] == 'shed' and notice['payload']['retry_after'] == config.SHED_RETRY_AFTER
+        assert await second.receive() is None
+
+    run_with_server(scenario, MemoryBackend())
+
+
+@pytest.mark.parametrize('memory', [False, True], ids=['sqlalchemy', 'memory'])
+def test_logging_in_on_another_device_keeps_the_first_signed_in(memory):
+    async def scenario(port):
+        device_a, device_b, bob = Peer(), Peer(), Peer()
+        for peer in (device_a, device_b, bob):
+            await peer.connect(port)
+        await device_a.request('reg', username='alice', password='pw')
+        await device_a.request('reg', username='bob', password='pw')
+        await device_a.login('alice', 'pw')
+        await bob.login('bob', 'pw')
+        await device_a.request('add_friend', username='bob')
+        await bob.receive()  # friend request notification
+        await bob.request('accept_friend', username='alice')
+        await device_a.receive()  # acceptance notification
+
+        await device_b.login('alice', 'pw')
+        assert device_b.auth_token != device_a.auth_token
+        response = await device_a.request('send', username='bob', message='from device a')
+        assert response['payload']['ok'] is True
+        assert (await bob.receive())['payload']['message'] == 'from device a'
+        assert (await device_a.request('myfriends'))['payload']['friends'] == [{'username': 'bob', 'online': True}]
+        assert (await device_b.request('myfriends'))['payload']['ok'] is True
+
+    run_with_server(scenario, MemoryBackend() if memory else None)
@@ -0,0 +1,238 @@
+"""
+Replays a traffic capture written by the server (CAPTURE_DIR, see server/capture.py) against a server.
+
+Every captured connection is reopened and its frames are sent in their original order, each at its
+captured offset divided by --speed (0 sends as fast as the server answers). A frame waits for its reply
+before the next frame of the same connection is sent, so causal order within a connection is kept.
+Auth tokens in the capture are rewritten to the tokens the replay target hands out on login.
+The report compares, per command, the server handling time recorded in the capture with the
+round-trip latency observed during the replay.
+
+    python -m tools.replay captures/capture-20240101-120000-*.bin --port 18888
+    python -m tools.replay captures/capture-20240101-120000-*.bin --speed 10 --register-missing
+
+Redacted captures carry a fixed placeholder password, so 'reg' and 'login' still agree with each other;
+--register-missing registers users that log in without being registered in the capture.
+Pass the files of one capture only: connection ids restart with every server process.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from common.protocol import AsyncProtocol, protocol
+from server.capture import CLOSE, FRAME, OPEN, REDACTED, read_capture
+from tools.stats import percentile
+
+# Commands the server does not answer
+NO_REPLY = {'ack'}
+
+
+class ReplayConnection:
+    """One replayed client connection: sends frames, matches replies by req_id and ignores pushes."""
+    def __init__(self, tokens: Dict[str, str]):
+        self.tokens = tokens
+        self.token = None
+        self._req_ids = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._reader_task = None
+
+    async def open(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        buffer = b''
+        try:
+            while True:
+                message, buffer = await AsyncProtocol.deserialize_stream(self.reader, buffer)
+                if message is None:
+                    break
+                payload = message.get('payload') or {}
+                if message.get('type') == 'login_success':
+                    self.token = payload.get('auth_token')
+                future = self._pending.pop(payload.get('req_id'), None)
+                if future and not future.done():
+                    future.set_result(message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed by the server."))
+
+    def _rewrite(self, payload: dict):
+        token = payload.get('auth_token')
+        if not token:
+            return
+        if token not in self.tokens and self.token:
+            # First use of a captured token after a login on this connection: it is that login's token
+            self.tokens[token] = self.token
+        payload['auth_token'] = self.tokens.get(token, token)
+
+    async def send(self, message: dict, timeout: float):
+        """Sends a captured frame; returns the reply (None for frames without one)."""
+        msg_type = message.get('type')
+        payload = dict(message.get('payload') or {})
+        self._rewrite(payload)
+        future = None
+        if msg_type not in NO_REPLY:
+            self._req_ids += 1
+            payload['req_id'] = self._req_ids
+            future = asyncio.get_running_loop().create_future()
+            self._pending[self._req_ids] = future
+        self.writer.write(protocol.create_payload(msg_type, payload))
+        await self.writer.drain()
+        if future is None:
+            return None
+        return await asyncio.wait_for(future, timeout)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        if self._reader_task:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+
+def load(paths: List[str]) -> Dict[int, list]:
+    """Groups the capture's records by connection id, in recorded order."""
+    connections = defaultdict(list)
+    for record in read_capture(paths):
+        connections[record.conn_id].append(record)
+    return connections
+
+
+async def register_missing(connections: Dict[int, list], host: str, port: int, timeout: float) -> int:
+    """Registers users that log in somewhere in the capture but are never registered in it."""
+    registered, logins = set(), {}
+    for records in connections.values():
+        for record in records:
+            if record.kind != FRAME:
+                continue
+            payload = record.message.get('payload') or {}
+            if record.message.get('type') == 'reg':
+                registered.add(payload.get('username'))
+            elif record.message.get('type') == 'login':
+                logins.setdefault(payload.get('username'), payload.get('password') or REDACTED)
+    missing = {name: password for name, password in logins.items() if name and name not in registered}
+    if missing:
+        conn = ReplayConnection({})
+        await conn.open(host, port)
+        for username, password in missing.items():
+            await conn.send({'type': 'reg', 'payload': {'username': username, 'password': password}}, timeout)
+        await conn.close()
+    return len(missing)
+
+
+async def replay(paths: List[str], host: str = '127.0.0.1', port: int = 18888, speed: float = 1.0,
+                 register: bool = False, timeout: float = 10.0) -> dict:
+    """Replays the capture and returns the per-command comparison report."""
+    connections = load(paths)
+    if register:
+        await register_missing(connections, host, port, timeout)
+    tokens: Dict[str, str] = {}
+    original = defaultdict(list)
+    replayed = defaultdict(list)
+    failed = defaultdict(int)
+    timeouts = defaultdict(int)
+    first = min((records[0].offset for records in connections.values() if records), default=0.0)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def wait_until(offset: float):
+        if speed > 0:
+            delay = start + (offset - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def run(records):
+        conn = ReplayConnection(tokens)
+        opened = False
+        try:
+            for record in records:
+                await wait_until(record.offset)
+                if record.kind == CLOSE:
+                    break
+                if not opened:
+                    await conn.open(host, port)
+                    opened = True
+                if record.kind == OPEN:
+                    continue
+                msg_type = record.message.get('type')
+                sent = time.perf_counter()
+                try:
+                    reply = await conn.send(record.message, timeout)
+                except asyncio.TimeoutError:
+                    timeouts[msg_type] += 1
+                    continue
+                except ConnectionError:
+                    timeouts[msg_type] += 1
+                    break
+                if reply is None:
+                    continue
+                original[msg_type].append(record.duration)
+                replayed[msg_type].append(time.perf_counter() - sent)
+                if not (reply.get('payload') or {}).get('ok', True):
+                    failed[msg_type] += 1
+        finally:
+            if opened:
+                await conn.close()
+
+    wall = time.perf_counter()
+    await asyncio.gather(*(run(records) for records in connections.values()))
+    wall = time.perf_counter() - wall
+
+    commands = {}
+    for msg_type in sorted(set(original) | set(timeouts)):
+        before, after = sorted(original[msg_type]), sorted(replayed[msg_type])
+        commands[msg_type] = {
+            'count': len(after),
+            'original_p50_ms': round(percentile(before, 50) * 1000, 3),
+            'original_p99_ms': round(percentile(before, 99) * 1000, 3),
+            'replay_p50_ms': round(percentile(after, 50) * 1000, 3),
+            'replay_p99_ms': round(percentile(after, 99) * 1000, 3),
+            'failed': failed[msg_type],
+            'timeouts': timeouts[msg_type],
+        }
+    return {'connections': len(connections), 'seconds': round(wall, 3), 'speed': speed, 'commands': commands}
+
+
+def print_report(report: dict):
+    print(f"replayed {report['connections']} connections in {report['seconds']:.1f}s (speed {report['speed'] or 'max'})")
+    print(f"{'command':<16}{'count':>8}{'orig p50':>10}{'orig p99':>10}{'replay p50':>12}{'replay p99':>12}"
+          f"{'Δp50':>9}{'Δp99':>9}{'failed':>8}{'timeout':>9}")
+    for name, r in report['commands'].items():
+        print(f"{name:<16}{r['count']:>8}{r['original_p50_ms']:>10.2f}{r['original_p99_ms']:>10.2f}"
+              f"{r['replay_p50_ms']:>12.2f}{r['replay_p99_ms']:>12.2f}"
+              f"{r['replay_p50_ms'] - r['original_p50_ms']:>+9.2f}{r['replay_p99_ms'] - r['original_p99_ms']:>+9.2f}"
+              f"{r['failed']:>8}{r['timeouts']:>9}")
+    print("latencies in ms; 'orig' is server handling time, 'replay' the observed round trip")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='capture files of one capture, in order')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18888)
+    parser.add_argument('--speed', type=float, default=1.0, help='time scale, e.g. 1, 10; 0 = as fast as possible')
+    parser.add_argument('--register-missing', action='store_true', help='register users that only log in')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for each reply')
+    parser.add_argument('--output', help='write the report as JSON to this path')
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(sorted(args.files), args.host, args.port, args.speed,
+                                args.register_missing, args.timeout))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
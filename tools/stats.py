@@ -0,0 +1,8 @@
+"""Summary statistics shared by the benchmarks and tools/replay.py."""
+
+
+def percentile(sorted_values, p):
+    """The value at percentile p (0-100) of an ascending list, by the nearest-rank method; 0.0 when empty."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]